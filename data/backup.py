@@ -0,0 +1,338 @@
+"""
+Script to incrementally backup Twitter data, replacing rsync.py.
+
+rsync rescans and checksums the whole archive directory on every run, and
+its -z recompresses data that is already gzipped. Archives never change
+once written, so instead:
+
+    1) The local manifest (see manifest.py) hashes only new or changed files.
+    2) Files whose hash differs from the destination's manifest are copied,
+       several at a time, to a temporary name at the destination.
+    3) Each copy is read back and hashed, and must match the same number of
+       bytes at the start of the original before it is renamed into place
+       and added to the destination's manifest.
+
+Logs are appended to while they are copied, so the copy is a snapshot: it
+is verified as a prefix of the original, and its own hash is recorded. The
+rest of the log is copied on a later run.
+
+The destination is any mounted path, or a path on another machine, such as
+'username@hostname:path', which rsync reaches over ssh. For a remote
+destination:
+
+    - The destination's manifest is mirrored locally, in a file named after
+      the destination, e.g. '.manifest.3f2a9c01b7de.json', and pending files
+      are found from the mirror. Delete the mirror to copy everything again.
+    - Pending files are copied and verified into a local staging directory,
+      a batch at a time, and each batch is sent with one rsync call, which
+      checksums every file it transfers. Entries are only added to the
+      mirror once rsync succeeds.
+    - The mirror is then sent to the destination as its '.manifest.json'.
+
+Bytes transferred and elapsed time are reported for each run.
+
+A lockfile ensures that this script does not run until the previous run has
+finished.
+
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import errno
+import fcntl
+import fnmatch
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+from manifest import MANIFEST, Manifest, file_hash
+
+PATTERNS = ['*.gz', '*.zst', '*.log']
+
+# Where files are verified before being sent to a remote destination.
+STAGING = '.backup_staging'
+
+# The most bytes staged for a remote destination at once.
+BATCH_BYTES = 2**30
+
+def archive_names(path, patterns):
+    """
+    Returns the files within `path` matching any of `patterns`, relative to
+    `path`. Matching directories are included recursively.
+
+    """
+    names = []
+    for name in sorted(os.listdir(path)):
+        if name.startswith('.'):
+            continue
+        if not any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+            continue
+        full = os.path.join(path, name)
+        if os.path.isdir(full):
+            for root, dirs, files in os.walk(full):
+                dirs.sort()
+                for filename in sorted(files):
+                    names.append(os.path.relpath(os.path.join(root, filename),
+                                                 path))
+        else:
+            names.append(name)
+    return names
+
+def snapshot(source, target):
+    """
+    Copies `source` to `target` and returns the hash and size of the copy.
+
+    The copy must match the start of `source`, so files that are only
+    appended to, such as logs, can be copied while they are written. Raises
+    IOError if `source` was otherwise changed during the copy.
+
+    """
+    shutil.copyfile(source, target)
+    shutil.copystat(source, target)
+    size = os.path.getsize(target)
+    digest = file_hash(target)
+    if file_hash(source, size=size) != digest:
+        os.unlink(target)
+        raise IOError('Verification failed: {0}'.format(source))
+    return digest, size
+
+def copy_verified(src, dest, name):
+    """
+    Copies `name` from `src` to `dest`, verifying the copy.
+
+    Returns the hash and size of the copy. Raises IOError if the copy does
+    not match.
+
+    """
+    source = os.path.join(src, name)
+    target = os.path.join(dest, name)
+    directory = os.path.dirname(target)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            # Another thread created it.
+            if e.errno != errno.EEXIST:
+                raise
+
+    tmpname = os.path.join(directory, '.' + os.path.basename(target) + '.tmp')
+    digest, size = snapshot(source, tmpname)
+    os.rename(tmpname, target)
+    return digest, size
+
+def is_remote(dest):
+    """
+    Returns `True` if `dest` is on another machine, e.g. 'hostname:path'.
+
+    """
+    return re.match(r'^[^/:]+:', dest) is not None
+
+def _remote_dir(dest):
+    # rsync copies into a directory only with a trailing slash. An empty
+    # remote path, as in 'hostname:', is the home directory.
+    if dest.endswith('/') or dest.endswith(':'):
+        return dest
+    return dest + '/'
+
+def mirror_filename(dest):
+    """
+    Returns the name of the local mirror of a remote destination's manifest.
+
+    """
+    digest = hashlib.sha1(dest.rstrip('/').encode('utf-8')).hexdigest()
+    return '.manifest.{0}.json'.format(digest[:12])
+
+def rsync(src, dest, names):
+    """
+    Sends `names`, relative to the directory `src`, to `dest` with rsync.
+
+    Returns `True` if rsync succeeded.
+
+    """
+    cmd = ['rsync', '-t', '--files-from=-', _remote_dir(src),
+           _remote_dir(dest)]
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    proc.communicate('\n'.join(names).encode('utf-8'))
+    if proc.returncode != 0:
+        print('rsync to {0} failed with code {1}'.format(dest,
+                                                          proc.returncode))
+    return proc.returncode == 0
+
+def _copies(src, dest, names, local, threads):
+    """
+    Copies `names` from `src` to the local directory `dest`, and yields
+    each name with the hash and size of its copy, 'busy', or `None` if the
+    copy failed.
+
+    """
+    def job(name):
+        try:
+            return name, copy_verified(src, dest, name)
+        except (IOError, OSError) as e:
+            if not local.is_current(name):
+                # Rewritten since it was hashed. It is copied on the next
+                # run.
+                return name, 'busy'
+            print(e)
+            return name, None
+
+    pool = ThreadPool(threads)
+    try:
+        for item in pool.imap_unordered(job, names):
+            yield item
+    finally:
+        pool.close()
+        pool.join()
+
+def _batches(names, local, batch_bytes):
+    batch, nbytes = [], 0
+    for name in names:
+        if batch and nbytes + local[name]['size'] > batch_bytes:
+            yield batch
+            batch, nbytes = [], 0
+        batch.append(name)
+        nbytes += local[name]['size']
+    if batch:
+        yield batch
+
+def _remote_copies(src, dest, names, local, threads, batch_bytes):
+    """
+    Like `_copies`, for a remote `dest`: each batch of files is verified
+    into a staging directory and then sent with rsync.
+
+    """
+    staging = os.path.join(src, STAGING)
+    for batch in _batches(names, local, batch_bytes):
+        staged = []
+        try:
+            for name, result in _copies(src, staging, batch, local, threads):
+                if isinstance(result, tuple):
+                    staged.append((name, result))
+                else:
+                    yield name, result
+            if staged and not rsync(staging, dest,
+                                    [name for name, result in staged]):
+                staged = [(name, None) for name, result in staged]
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+        for item in staged:
+            yield item
+
+def backup(src, dest, patterns=None, threads=4, batch_bytes=BATCH_BYTES):
+    """
+    Copies new and changed archives from `src` to `dest`.
+
+    Parameters
+    ----------
+    src : str
+        The directory of archives.
+    dest : str
+        The backup directory, either a local path or a remote one, such as
+        'username@hostname:path', which is reached with rsync.
+    patterns : list
+        Glob patterns of the files and directories to backup.
+    threads : int
+        The number of files copied at the same time.
+    batch_bytes : int
+        For a remote `dest`, the most bytes staged and sent at once.
+
+    Returns
+    -------
+    report : dict
+        The numbers of files 'hashed' into the local manifest, and 'copied',
+        'skipped' as already backed up, 'busy' as rewritten during the copy,
+        and 'failed', and the 'bytes' copied and 'elapsed' seconds.
+
+    """
+    if patterns is None:
+        patterns = PATTERNS
+    start = time.time()
+    remote_dest = is_remote(dest)
+    if remote_dest:
+        remote = Manifest(src, filename=mirror_filename(dest))
+    else:
+        if not os.path.isdir(dest):
+            os.makedirs(dest)
+        remote = Manifest(dest)
+
+    names = archive_names(src, patterns)
+    local = Manifest(src)
+    hashed = local.update(names)
+    local.save()
+
+    pending = []
+    for name in names:
+        entry = remote.get(name)
+        if entry is None or entry['sha1'] != local[name]['sha1']:
+            pending.append(name)
+        elif not remote_dest and not os.path.exists(os.path.join(dest, name)):
+            pending.append(name)
+
+    if remote_dest:
+        copies = _remote_copies(src, dest, pending, local, threads,
+                                batch_bytes)
+    else:
+        copies = _copies(src, dest, pending, local, threads)
+
+    report = {'copied': 0, 'skipped': len(names) - len(pending), 'failed': 0,
+              'busy': 0, 'bytes': 0, 'hashed': len(hashed)}
+    try:
+        for name, result in copies:
+            if result is None:
+                report['failed'] += 1
+                continue
+            elif result == 'busy':
+                report['busy'] += 1
+                continue
+            digest, size = result
+            remote.set(name, digest, size, local[name]['mtime'])
+            report['copied'] += 1
+            report['bytes'] += size
+    finally:
+        remote.save()
+        if remote_dest:
+            # Send the mirror on every run, in case the last send failed.
+            subprocess.call(['rsync', '-t', remote.filename,
+                             _remote_dir(dest) + MANIFEST])
+
+    report['elapsed'] = time.time() - start
+    return report
+
+def print_report(report):
+    rate = report['bytes'] / report['elapsed'] / 2**20 if report['elapsed'] else 0
+    msg = ("[{0}] Copied {copied} files ({mb:.1f} MiB) in {elapsed:.1f} s "
+           "({rate:.1f} MiB/s). Skipped {skipped}, busy {busy}, "
+           "failed {failed}, hashed {hashed}.")
+    print(msg.format(time.strftime('%c'), mb=report['bytes'] / 2**20,
+                     rate=rate, **report))
+
+def main():
+    import configparser
+    config = configparser.ConfigParser()
+    config.read('../project.cfg')
+    backup_path = config['Locations']['BACKUP_PATH']
+    mongo_prefix = config['Prefixes']['MONGO_PREFIX']
+
+    with open('.lock_backup', 'w') as f:
+        try:
+            fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno == errno.EAGAIN:
+                msg = '[{0}] backup script already running.\n'
+                msg = msg.format(time.strftime('%c'))
+                sys.stderr.write(msg)
+                sys.exit(-1)
+            raise
+        if len(sys.argv) > 1:
+            backup_path = sys.argv[1]
+        report = backup('.', backup_path, PATTERNS + [mongo_prefix + '*'])
+        print_report(report)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""
+Benchmark the collector against a local replay of archived tweets.
+
+A `replay.ReplayServer` streams the archives to a tweepy `Stream`, whose
+host is pointed at the server over plain HTTP, and a listener from stream.py
+handles the tweets as it would in production. Reported are:
+
+    - the sustained rate, in messages per second, handled by the listener,
+    - the latency of each `on_data` call, which includes the write,
+    - the number of messages sent but not received, and, for the rotating
+      listener, received but not found in the written archives.
+
+Any shortfall is dropped data. With `--rate`, the server paces messages, to
+check that the collector keeps up at a given stream volume. Without it, the
+collector's maximum rate is measured.
+
+Usage:
+
+    $ python bench_stream.py tweets.2014-08-09_12.gz [--rate 5000]
+                             [--listener rotating|stdout] [--split-us]
+
+"""
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import glob
+import gzip
+import os
+import shutil
+import tempfile
+import time
+
+from requests.adapters import HTTPAdapter
+from tweepy.auth import OAuthHandler
+from tweepy.streaming import Stream
+
+from replay import ReplayServer
+from stream import RotatingLogListener, StdOutListener
+
+class PlainHTTPAdapter(HTTPAdapter):
+    """
+    Sends https:// requests over plain HTTP, as tweepy always uses https.
+
+    """
+    def send(self, request, **kwargs):
+        if request.url.startswith('https://'):
+            request.url = 'http://' + request.url[len('https://'):]
+        return HTTPAdapter.send(self, request, **kwargs)
+
+def _timed(listener, latencies):
+    on_data = listener.on_data
+    def timed_on_data(raw_data):
+        start = time.time()
+        result = on_data(raw_data)
+        latencies.append(time.time() - start)
+        return result
+    listener.on_data = timed_on_data
+
+def _percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def _count_lines(pattern):
+    total = 0
+    for filename in glob.glob(pattern):
+        with gzip.open(filename, 'rb') as f:
+            total += sum(1 for line in f if line.strip())
+    return total
+
+def benchmark(filenames, rate=None, listener='rotating', split_us=False):
+    """
+    Streams archives through a listener and returns the measurements.
+
+    The listener writes into a temporary directory, which is removed.
+
+    """
+    filenames = [os.path.abspath(filename) for filename in filenames]
+    server = ReplayServer(('localhost', 0), filenames, rate=rate)
+    server.start()
+    host, port = server.server_address
+
+    cwd = os.getcwd()
+    tmpdir = tempfile.mkdtemp()
+    os.chdir(tmpdir)
+    try:
+        if listener == 'rotating':
+            us_basename = 'tweets_us' if split_us else None
+            l = RotatingLogListener(basename='tweets', us_basename=us_basename)
+        else:
+            l = StdOutListener(fobj=open(os.devnull, 'w'))
+        latencies = []
+        _timed(l, latencies)
+
+        auth = OAuthHandler('consumer_key', 'consumer_secret')
+        auth.set_access_token('access_token', 'access_token_secret')
+        address = '{0}:{1}'.format(host, port)
+        stream = Stream(auth, l, host=address)
+        stream.session.mount('https://' + address, PlainHTTPAdapter())
+        # Stop, rather than reconnect, once the replay ends.
+        def on_closed(resp):
+            stream.running = False
+        stream.on_closed = on_closed
+
+        start = time.time()
+        try:
+            stream.filter(locations=[-180,-90,180,90])
+        except Exception as e:
+            print("Stream ended with: {0!r}".format(e))
+        elapsed = time.time() - start
+        if listener == 'rotating':
+            l.close()
+            written = _count_lines('tweets*.gz')
+        else:
+            written = None
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+        server.stop()
+
+    results = {
+        'sent': server.stats['messages'],
+        'received': len(latencies),
+        'written': written,
+        'elapsed': elapsed,
+        'rate': len(latencies) / elapsed if elapsed else float('nan'),
+        'latency_p50': _percentile(latencies, 0.5),
+        'latency_p99': _percentile(latencies, 0.99),
+        'latency_max': max(latencies) if latencies else float('nan'),
+    }
+    return results
+
+def print_results(results):
+    print("Sent:      {0}".format(results['sent']))
+    print("Received:  {0}".format(results['received']))
+    if results['written'] is not None:
+        print("Written:   {0}".format(results['written']))
+    dropped = results['sent'] - results['received']
+    if results['written'] is not None:
+        dropped += results['received'] - results['written']
+    print("Dropped:   {0}".format(dropped))
+    print("Elapsed:   {0:.2f} s".format(results['elapsed']))
+    print("Rate:      {0:.0f} messages/s".format(results['rate']))
+    print("Latency:   p50 {0:.1f} us, p99 {1:.1f} us, max {2:.1f} ms".format(
+          1e6 * results['latency_p50'], 1e6 * results['latency_p99'],
+          1e3 * results['latency_max']))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the collector.')
+    parser.add_argument('filenames', nargs='+')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='messages per second (default: unlimited)')
+    parser.add_argument('--listener', default='rotating',
+                        choices=['rotating', 'stdout'])
+    parser.add_argument('--split-us', action='store_true')
+    args = parser.parse_args()
+    results = benchmark(args.filenames, rate=args.rate,
+                        listener=args.listener, split_us=args.split_us)
+    print_results(results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""
+A manifest of archived files: their size, modification time, and hash.
+
+The manifest is a JSON file within the directory it describes, mapping each
+file's path, relative to the directory, to its entry:
+
+    {"tweets.2014-08-09_12.gz": {"size": 1523, "mtime": 1407600000.0,
+                                 "sha1": "..."}}
+
+Archives do not change once written, so a file is only hashed when it is
+new or its size or modification time has changed.
+
+Several scripts (zipper.py and backup.py) update the same manifest. Loading
+and saving hold an fcntl lock on a lock file beside the manifest, and saving
+reloads the manifest and applies only this instance's changes, so that
+concurrent runs do not lose each other's entries.
+
+"""
+from __future__ import print_function
+
+import contextlib
+import fcntl
+import hashlib
+import io
+import json
+import os
+
+MANIFEST = '.manifest.json'
+ALGORITHM = 'sha1'
+BLOCK_SIZE = 2**20
+
+def file_hash(filename, algorithm=ALGORITHM, block_size=BLOCK_SIZE,
+              size=None):
+    """
+    Returns the hex digest of a file's contents.
+
+    If `size` is given, only the first `size` bytes are hashed.
+
+    """
+    h = hashlib.new(algorithm)
+    remaining = size
+    with io.open(filename, 'rb') as f:
+        while remaining is None or remaining > 0:
+            n = block_size if remaining is None else min(block_size, remaining)
+            block = f.read(n)
+            if not block:
+                break
+            h.update(block)
+            if remaining is not None:
+                remaining -= len(block)
+    return h.hexdigest()
+
+@contextlib.contextmanager
+def locked(filename, exclusive=True):
+    """
+    Holds an fcntl lock on `filename` + '.lock' while in the block.
+
+    The manifest itself is replaced on each save, so the lock is taken on a
+    separate file that is never replaced.
+
+    """
+    # Shared locks need a readable file.
+    with open(filename + '.lock', 'a+') as f:
+        fcntl.lockf(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.lockf(f, fcntl.LOCK_UN)
+
+class Manifest(object):
+    """
+    The manifest of a directory.
+
+    Examples
+    --------
+    >>> manifest = Manifest('.')
+    >>> changed = manifest.update(['tweets.2014-08-09_12.gz'])
+    >>> manifest.save()
+
+    """
+    def __init__(self, path, filename=MANIFEST):
+        self.path = path
+        self.filename = os.path.join(path, filename)
+        # Names set or removed since loading, applied again on save.
+        self._changed = set()
+        with locked(self.filename, exclusive=False):
+            self.entries = self._read()
+
+    def _read(self):
+        if not os.path.isfile(self.filename):
+            return {}
+        with io.open(self.filename, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __getitem__(self, name):
+        return self.entries[name]
+
+    def get(self, name, default=None):
+        return self.entries.get(name, default)
+
+    def set(self, name, digest, size=None, mtime=None, **extra):
+        """
+        Records a file whose hash is already known, e.g. from writing it.
+
+        The size and modification time are read from the file if not given.
+        Any `extra` fields are stored in the entry as well.
+
+        """
+        if size is None or mtime is None:
+            st = os.stat(os.path.join(self.path, name))
+            size, mtime = st.st_size, st.st_mtime
+        entry = {'size': size, 'mtime': mtime, ALGORITHM: digest}
+        entry.update(extra)
+        self.entries[name] = entry
+        self._changed.add(name)
+
+    def remove(self, name):
+        self.entries.pop(name, None)
+        self._changed.add(name)
+
+    def is_current(self, name):
+        """
+        Returns `True` if the entry for `name` matches the file's size and
+        modification time.
+
+        """
+        entry = self.entries.get(name)
+        if entry is None:
+            return False
+        try:
+            st = os.stat(os.path.join(self.path, name))
+        except OSError:
+            return False
+        return entry['size'] == st.st_size and entry['mtime'] == st.st_mtime
+
+    def update(self, names):
+        """
+        Hashes the files that are new or changed and returns their names.
+
+        Entries for files that no longer exist are removed.
+
+        """
+        changed = []
+        for name in names:
+            if not self.is_current(name):
+                filename = os.path.join(self.path, name)
+                st = os.stat(filename)
+                self.set(name, file_hash(filename), st.st_size, st.st_mtime)
+                changed.append(name)
+        for name in list(self.entries):
+            if not os.path.exists(os.path.join(self.path, name)):
+                self.remove(name)
+        return changed
+
+    def save(self):
+        """
+        Writes this instance's changes into the manifest on disk.
+
+        Entries changed by other processes since this one was loaded are
+        kept.
+
+        """
+        with locked(self.filename):
+            entries = self._read()
+            for name in self._changed:
+                if name in self.entries:
+                    entries[name] = self.entries[name]
+                else:
+                    entries.pop(name, None)
+            tmpname = self.filename + '.tmp'
+            with open(tmpname, 'w') as f:
+                json.dump(entries, f, indent=1, sort_keys=True)
+            os.rename(tmpname, self.filename)
+        self.entries = entries
+        self._changed = set()
@@ -0,0 +1,187 @@
+"""
+Reconnecting to the streaming API, with backoff, from within the process.
+
+Previously, any error from the stream ended stream.py, and cron restarted
+it within a minute or two, losing the tweets in between (see events.txt).
+Now `run_forever` reconnects as soon as it is allowed to, following
+Twitter's reconnection guidelines:
+
+    - Network errors: back off from 250ms, up to 16 seconds.
+    - HTTP errors: back off from 5 seconds, up to 320 seconds.
+    - HTTP 420 (rate limited): back off from 1 minute.
+
+The delays grow exponentially and are randomized, so that clients do not
+reconnect in lockstep. Network delays are drawn between zero and the current
+limit ("full jitter"). HTTP and 420 delays are drawn between half the limit
+and the limit, but never below the starting delay ("equal jitter"), so that
+the waits Twitter asks for are always respected.
+The delays start over once a connection has stayed up for `stable` seconds.
+
+Each disconnect and reconnect is appended to a metrics file, one event per
+line, as tab-separated `key=value` fields:
+
+    time=2014-05-18T09:33:00  event=disconnect  reason=...  uptime=28800.100
+    time=2014-05-18T09:33:02  event=connect  attempts=1  latency=1.930
+    time=2014-05-18T09:33:02  event=gap  gap=2.510
+
+`latency` is the time from the disconnect to the new connection, and `gap`
+is the time between the last data received before the disconnect and the
+first data received after it: the window of tweets that were missed.
+
+"""
+from __future__ import print_function
+from __future__ import division
+
+import io
+import random
+import time
+
+NETWORK = (0.25, 16)
+HTTP = (5, 320)
+RATE_LIMITED = (60, 960)
+
+class Backoff(object):
+    """
+    Exponential backoff with jitter.
+
+    Parameters
+    ----------
+    base, cap : float
+        The first and largest limits on the delay, in seconds. The limit
+        doubles after each attempt.
+    jitter : {'full', 'equal'}
+        With 'full', delays are drawn between zero and the limit. With
+        'equal', between half the limit and the limit, and at least `base`.
+
+    """
+    def __init__(self, base, cap, prng=None, jitter='full'):
+        if jitter not in ('full', 'equal'):
+            raise ValueError('Unknown jitter: {0!r}'.format(jitter))
+        self.base = base
+        self.cap = cap
+        self.jitter = jitter
+        self.attempts = 0
+        if prng is None:
+            prng = random.Random()
+        self.prng = prng
+
+    def next(self):
+        """
+        Returns the number of seconds to wait before the next attempt.
+
+        """
+        limit = min(self.cap, self.base * 2**self.attempts)
+        self.attempts += 1
+        if self.jitter == 'full':
+            return self.prng.uniform(0, limit)
+        return self.prng.uniform(max(self.base, limit / 2), limit)
+
+    def reset(self):
+        self.attempts = 0
+
+class StreamMetrics(object):
+    """
+    Tracks stream uptime and capture gaps and logs them to a file.
+
+    A listener calls `connected` from `on_connect` and `received` from
+    `on_data`. `run_forever` calls `disconnected`.
+
+    """
+    def __init__(self, filename='stream_metrics.log'):
+        self.filename = filename
+        self.connected_at = None
+        self.disconnected_at = None
+        self.last_data = None
+        self.gap_start = None
+        self.attempts = 0
+
+    def log(self, event, **fields):
+        items = [('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+                 ('event', event)]
+        items.extend(sorted(fields.items()))
+        line = '\t'.join('{0}={1}'.format(k, v) for k, v in items)
+        with io.open(self.filename, 'a', encoding='utf-8') as f:
+            f.write(line + u'\n')
+
+    def connected(self):
+        now = time.time()
+        self.connected_at = now
+        fields = {'attempts': self.attempts}
+        if self.disconnected_at is not None:
+            fields['latency'] = '{0:.3f}'.format(now - self.disconnected_at)
+        self.log('connect', **fields)
+        self.attempts = 0
+
+    def received(self):
+        now = time.time()
+        if self.gap_start is not None:
+            self.log('gap', gap='{0:.3f}'.format(now - self.gap_start))
+            self.gap_start = None
+        self.last_data = now
+
+    def disconnected(self, reason):
+        now = time.time()
+        fields = {'reason': repr(reason)}
+        if self.connected_at is not None:
+            fields['uptime'] = '{0:.3f}'.format(now - self.connected_at)
+            self.connected_at = None
+            # Only the first failure of a reconnection attempt starts a gap.
+            self.disconnected_at = now
+            if self.last_data is not None:
+                self.gap_start = self.last_data
+        self.attempts += 1
+        self.log('disconnect', **fields)
+
+    def uptime(self):
+        if self.connected_at is None:
+            return 0
+        return time.time() - self.connected_at
+
+def run_forever(connect, metrics, status=None, stable=60, sleep=time.sleep,
+                prng=None):
+    """
+    Runs a stream, reconnecting with backoff whenever it ends.
+
+    Parameters
+    ----------
+    connect : callable
+        Connects and streams until the connection ends, e.g. by calling
+        `Stream.filter`. It may raise or return.
+    metrics : StreamMetrics
+        Records the disconnects. Its `connected` method must be called when
+        the stream connects.
+    status : callable
+        Returns, and forgets, the HTTP status of the last failed connection,
+        or `None` if the connection failed for any other reason.
+    stable : float
+        A connection that stayed up for this many seconds resets the
+        backoff delays.
+
+    KeyboardInterrupt and SystemExit are not caught.
+
+    """
+    backoffs = {
+        'network': Backoff(*NETWORK, prng=prng),
+        'http': Backoff(*HTTP, prng=prng, jitter='equal'),
+        420: Backoff(*RATE_LIMITED, prng=prng, jitter='equal'),
+    }
+    while True:
+        try:
+            connect()
+        except Exception as e:
+            reason = e
+        else:
+            reason = 'stream ended'
+
+        code = status() if status is not None else None
+        if code is not None:
+            reason = 'HTTP {0}'.format(code)
+            kind = 420 if code == 420 else 'http'
+        else:
+            kind = 'network'
+
+        if metrics.uptime() >= stable:
+            for backoff in backoffs.values():
+                backoff.reset()
+        metrics.disconnected(reason)
+        sleep(backoffs[kind].next())
@@ -0,0 +1,211 @@
+"""
+A local stand-in for Twitter's streaming endpoint, replaying archived tweets.
+
+The server answers any GET or POST, such as tweepy's request to
+/1.1/statuses/filter.json, by streaming the lines of the given archives,
+rate-limit messages included, with the framing of the streaming API:
+
+    - The response uses chunked transfer encoding.
+    - Each message ends with '\\r\\n'.
+    - With `delimited=length`, as tweepy requests, each message is preceded
+      by its length in bytes on a line of its own.
+
+Messages are sent as fast as possible, or at `rate` messages per second.
+When the archives are exhausted, the response ends, unless `loop` is set.
+
+Usage:
+
+    $ python replay.py tweets.2014-08-09_12.gz [--port 8080] [--rate 5000]
+
+See bench_stream.py for a benchmark of the collector against this server.
+
+"""
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+from twitterproj.helpers import open_archive
+
+# Messages are grouped into HTTP chunks of up to this many bytes.
+CHUNK_SIZE = 2**14
+
+# Bytes of keep-alive newlines sent before closing the response.
+KEEP_ALIVE_PADDING = 2**12
+
+def messages(filenames, loop=False):
+    """
+    Yields the messages of archives as bytes, each ending with '\\r\\n'.
+
+    Archives are opened with `twitterproj.helpers.open_archive`, so they may
+    be raw, gzipped or zstd.
+
+    """
+    while True:
+        for filename in filenames:
+            with open_archive(filename) as fobj:
+                for line in fobj:
+                    line = line.rstrip(b'\r\n')
+                    if line:
+                        yield line + b'\r\n'
+        if not loop:
+            break
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _params(self):
+        params = parse_qs(urlparse(self.path).query)
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length).decode('utf-8')
+            params.update(parse_qs(body))
+        return params
+
+    def _write_chunk(self, data):
+        self.wfile.write('{0:x}\r\n'.format(len(data)).encode('ascii'))
+        self.wfile.write(data)
+        self.wfile.write(b'\r\n')
+
+    def do_GET(self):
+        self.stream(self._params())
+
+    def do_POST(self):
+        self.stream(self._params())
+
+    def stream(self, params):
+        server = self.server
+        delimited = params.get('delimited', [None])[0] == 'length'
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        server.count('connections')
+        start = time.time()
+        buf = []
+        buffered = 0
+
+        def flush():
+            self._write_chunk(b''.join(buf))
+            server.count('messages', len(buf))
+            del buf[:]
+
+        try:
+            items = messages(server.filenames, server.loop)
+            for i, message in enumerate(items):
+                if delimited:
+                    message = str(len(message)).encode('ascii') + b'\r\n' + message
+                buf.append(message)
+                buffered += len(message)
+
+                if server.rate:
+                    # Send each message no earlier than its scheduled time.
+                    delay = start + i / server.rate - time.time()
+                    if delay > 0:
+                        flush()
+                        buffered = 0
+                        time.sleep(delay)
+                if buffered >= CHUNK_SIZE:
+                    flush()
+                    buffered = 0
+                if server.stopped.is_set():
+                    break
+            if buf:
+                flush()
+            # Keep-alive newlines, as the streaming API sends when idle.
+            # tweepy discards what it has read ahead once the connection
+            # closes, so these make sure it handles the last message.
+            self._write_chunk(b'\r\n' * (KEEP_ALIVE_PADDING // 2))
+            # The last chunk.
+            self.wfile.write(b'0\r\n\r\n')
+            self.wfile.flush()
+        except (IOError, OSError):
+            # The client disconnected.
+            server.count('disconnects')
+        finally:
+            self.close_connection = True
+
+class ReplayServer(ThreadingMixIn, HTTPServer):
+    """
+    Replays archives to any client that connects.
+
+    Parameters
+    ----------
+    address : tuple
+        The (host, port) to listen on. Port 0 picks a free port.
+    filenames : list
+        The archives to replay, raw, gzipped or zstd.
+    rate : float
+        Messages per second. If `None`, as fast as possible.
+    loop : bool
+        If `True`, replay the archives forever.
+
+    """
+    daemon_threads = True
+
+    def __init__(self, address, filenames, rate=None, loop=False, quiet=True):
+        HTTPServer.__init__(self, address, ReplayHandler)
+        self.filenames = filenames
+        self.rate = rate
+        self.loop = loop
+        self.quiet = quiet
+        self.stats = {'connections': 0, 'messages': 0, 'disconnects': 0}
+        self.stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    def count(self, key, n=1):
+        with self._lock:
+            self.stats[key] += n
+
+    def start(self):
+        """
+        Serves from a background thread and returns it.
+
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.stopped.set()
+        self.shutdown()
+        self.server_close()
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay archived tweets.')
+    parser.add_argument('filenames', nargs='+')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--rate', type=float, default=None,
+                        help='messages per second (default: unlimited)')
+    parser.add_argument('--loop', action='store_true')
+    args = parser.parse_args()
+
+    server = ReplayServer((args.host, args.port), args.filenames,
+                          rate=args.rate, loop=args.loop, quiet=False)
+    print("Replaying on http://{0}:{1}".format(*server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+"""
+A rotating tweet writer that compresses as it writes.
+
+Tweets are buffered as raw bytes and written as a series of independent
+gzip members, one for every few megabytes of tweets. The concatenated
+members form an ordinary gzip file, which `gzip`, `zcat`, and
+`twitterproj.helpers.tweets` read as usual, and each member start is a point
+where decompression can begin, as used by `twitterproj.tweetindex`.
+
+The active file is named with a '.part' suffix. On rotation, it is renamed
+to its final name, which matches the names `TimedRotatingFileHandler` gave
+the uncompressed archives, plus '.gz':
+
+    tweets.2014-08-09_16.gz
+
+If the writer is killed, at most the unwritten buffer is lost. `recover`
+truncates a leftover '.part' file to its last complete member and renames it.
+
+"""
+from __future__ import print_function
+from __future__ import division
+
+import glob
+import io
+import os
+import time
+import zlib
+
+PART_SUFFIX = '.part'
+SUFFIX_FORMAT = '%Y-%m-%d_%H'
+
+# Write a gzip member after this many uncompressed bytes...
+MEMBER_SIZE = 2**22
+# ...or after this many seconds, whichever comes first.
+FLUSH_INTERVAL = 60
+
+def gzip_member(data, level=6):
+    # wbits=31 writes a gzip header and trailer, making a complete member.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+def complete_length(filename, block_size=2**20):
+    """
+    Returns the length of the complete gzip members at the start of a file.
+
+    """
+    length = 0
+    position = 0
+    decompressor = zlib.decompressobj(31)
+    with io.open(filename, 'rb') as f:
+        data = f.read(block_size)
+        while data:
+            try:
+                decompressor.decompress(data)
+            except zlib.error:
+                break
+            if decompressor.eof:
+                # A member ended; continue with the data after it.
+                unused = decompressor.unused_data
+                length = position + len(data) - len(unused)
+                position = length
+                decompressor = zlib.decompressobj(31)
+                data = unused or f.read(block_size)
+            else:
+                position += len(data)
+                data = f.read(block_size)
+    return length
+
+def recover(filename):
+    """
+    Finalizes a '.part' file left by a writer that did not close.
+
+    The file is truncated to its last complete gzip member and renamed
+    without the '.part' suffix. The final name is returned.
+
+    """
+    length = complete_length(filename)
+    with io.open(filename, 'r+b') as f:
+        f.truncate(length)
+    final = _unique(filename[:-len(PART_SUFFIX)])
+    os.rename(filename, final)
+    return final
+
+def _unique(filename):
+    if not os.path.exists(filename):
+        return filename
+    root, ext = os.path.splitext(filename)
+    i = 1
+    while os.path.exists('{0}.{1}{2}'.format(root, i, ext)):
+        i += 1
+    return '{0}.{1}{2}'.format(root, i, ext)
+
+class RotatingGzipWriter(object):
+    """
+    Writes raw tweets to gzipped files, rotating by time and by size.
+
+    Examples
+    --------
+    >>> writer = RotatingGzipWriter('tweets', interval=8 * 3600)
+    >>> writer.write(raw_data)
+    >>> writer.close()
+
+    """
+    def __init__(self, basename='tweets', interval=8 * 3600, max_bytes=None,
+                 member_size=MEMBER_SIZE, flush_interval=FLUSH_INTERVAL,
+                 compresslevel=6):
+        """
+        Parameters
+        ----------
+        basename : str
+            The prefix of the archive filenames.
+        interval : int
+            Rotate every `interval` seconds. Rotations are aligned to
+            multiples of `interval` since the epoch, so with 8 hours they
+            happen at 0:00, 8:00 and 16:00 UTC.
+        max_bytes : int
+            Also rotate once a file has this many compressed bytes. If
+            `None`, files are rotated only by time.
+        member_size : int
+            The number of uncompressed bytes buffered per gzip member.
+        flush_interval : float
+            The longest time, in seconds, that tweets are buffered.
+        compresslevel : int
+            The zlib compression level.
+
+        """
+        self.basename = basename
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.member_size = member_size
+        self.flush_interval = flush_interval
+        self.compresslevel = compresslevel
+
+        self.fobj = None
+        self.filename = None
+        self.buffer = []
+        self.buffered = 0
+        self.written = 0
+        self.rollover_at = None
+        self.flushed_at = time.time()
+
+        for part in glob.glob(basename + '.*' + PART_SUFFIX):
+            recover(part)
+
+    def _open(self, now):
+        suffix = time.strftime(SUFFIX_FORMAT, time.localtime(now))
+        final = '{0}.{1}.gz'.format(self.basename, suffix)
+        if os.path.exists(final):
+            # Rotated by size within the hour. Add the minutes and seconds,
+            # which sort the files by name in the order they were written.
+            suffix = time.strftime(SUFFIX_FORMAT + '_%M%S', time.localtime(now))
+            final = _unique('{0}.{1}.gz'.format(self.basename, suffix))
+        self.filename = final + PART_SUFFIX
+        self.fobj = io.open(self.filename, 'wb')
+        self.written = 0
+        self.rollover_at = (now // self.interval + 1) * self.interval
+
+    def write(self, data):
+        """
+        Buffers one raw tweet, including its trailing newline.
+
+        """
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        now = time.time()
+        if self.fobj is None:
+            self._open(now)
+        elif now >= self.rollover_at:
+            self.rotate(now)
+
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.member_size or \
+           now - self.flushed_at >= self.flush_interval:
+            self.flush()
+            if self.max_bytes is not None and self.written >= self.max_bytes:
+                self.rotate(now)
+
+    def flush(self):
+        """
+        Compresses the buffered tweets as one gzip member and writes it.
+
+        """
+        self.flushed_at = time.time()
+        if not self.buffer or self.fobj is None:
+            return
+        member = gzip_member(b''.join(self.buffer), self.compresslevel)
+        self.buffer = []
+        self.buffered = 0
+        self.fobj.write(member)
+        self.fobj.flush()
+        self.written += len(member)
+
+    def rotate(self, now=None):
+        """
+        Finishes the current file and starts a new one.
+
+        """
+        if now is None:
+            now = time.time()
+        self.close()
+        self._open(now)
+
+    def close(self):
+        """
+        Writes any buffered tweets and gives the file its final name.
+
+        """
+        if self.fobj is None:
+            return
+        self.flush()
+        self.fobj.close()
+        final = self.filename[:-len(PART_SUFFIX)]
+        if self.written:
+            os.rename(self.filename, final)
+        else:
+            os.unlink(self.filename)
+        self.fobj = None
+        self.filename = None
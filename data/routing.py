@@ -0,0 +1,71 @@
+"""
+Capture-time routing of tweets by their GPS coordinates.
+
+Only tweets with GPS coordinates inside the contiguous US are ingested by
+`twitterproj.helpers.us_geocoded_tweets`. Testing for these while streaming
+lets them be written to their own, much smaller, archives. The test reads
+the coordinates from the raw bytes of the tweet, without decoding the JSON.
+
+"""
+from __future__ import print_function
+
+import json
+import re
+
+# The same box as twitterproj.helpers.USA: [left, bottom, right, top]
+US_BBOX = (-124.7625, 24.5210, -66.9326, 49.3845)
+
+# The first "coordinates" key followed by null or an object is the tweet's
+# own coordinates field. The key also appears in the deprecated geo field
+# and in place bounding boxes, but followed by a list, and those of any
+# retweeted or quoted tweet come after the tweet's own fields.
+COORDINATES = re.compile(br'"coordinates":(null|\{)')
+POINT = re.compile(br'\{"type":"Point","coordinates":\[([^,\]]+),([^,\]]+)\]\}')
+
+def point_coordinates(raw):
+    """
+    Returns the (longitude, latitude) of a raw tweet, or `None`.
+
+    Parameters
+    ----------
+    raw : bytes
+        The UTF-8 encoded JSON of the tweet.
+
+    """
+    if not isinstance(raw, bytes):
+        raw = raw.encode('utf-8')
+    match = COORDINATES.search(raw)
+    if match is None or match.group(1) == b'null':
+        return None
+    point = POINT.match(raw, match.start(1))
+    if point is not None:
+        try:
+            return float(point.group(1)), float(point.group(2))
+        except ValueError:
+            pass
+    # Formatted in an unexpected way. Decode it.
+    try:
+        coordinates = json.loads(raw.decode('utf-8')).get('coordinates')
+    except ValueError:
+        return None
+    if coordinates and coordinates.get('type') == 'Point':
+        lon, lat = coordinates['coordinates']
+        return lon, lat
+    return None
+
+def in_bbox(point, bbox=US_BBOX):
+    """
+    Returns `True` if the point is within the bounding box, inclusive.
+
+    """
+    if point is None:
+        return False
+    lon, lat = point
+    return bbox[0] <= lon <= bbox[2] and bbox[1] <= lat <= bbox[3]
+
+def is_us_gps(raw):
+    """
+    Returns `True` if the raw tweet has GPS coordinates within `US_BBOX`.
+
+    """
+    return in_bbox(point_coordinates(raw))
@@ -1,6 +1,8 @@
 """
 Script to backup Twitter data using rsync.
 
+Superseded by backup.py, which copies only new or changed files.
+
 A lockfile ensures that this script does not run until the previous run has
 finished.
 
@@ -2,11 +2,23 @@
 Script used to store tweets using Twitter's streaming API.
 
 A lockfile ensures that the script is not started again
-if it is already running.
+if it is already running. The script reconnects by itself, with backoff,
+when the stream fails, and logs disconnects, reconnection latency, and
+capture gaps to `stream_metrics.log`. See `reconnect.py`.
 
 During streaming, a separate file `ratelimits.log` holds any received data
 on ratelimits.
 
+Tweets are written to gzipped files that are compressed as they are written,
+so they do not need to be zipped afterwards. The file being written has a
+'.part' suffix until it is rotated.
+
+With `--split-us`, tweets with GPS coordinates in the contiguous US are
+written to separate `tweets_us.*.gz` archives, and all other data to the
+usual `tweets.*.gz` archives. Only the former need to be ingested:
+
+    >>> populate_db('data', pattern='tweets_us.*.gz')
+
 """
 
 from __future__ import print_function
@@ -16,9 +28,6 @@ import fcntl
 import sys
 import time
 
-import logging
-from logging.handlers import TimedRotatingFileHandler
-
 import tweepy
 from tweepy.auth import OAuthHandler
 from tweepy.streaming import StreamListener, Stream
@@ -27,12 +36,20 @@ import json
 
 import configparser
 
-config = configparser.ConfigParser()
-config.read('../project.cfg')
-consumer_key = config['Twitter']['consumer_key']
-consumer_secret = config['Twitter']['consumer_secret']
-access_token = config['Twitter']['access_token']
-access_token_secret = config['Twitter']['access_token_secret']
+from reconnect import StreamMetrics, run_forever
+from rotating import RotatingGzipWriter
+from routing import is_us_gps
+
+def credentials(filename='../project.cfg'):
+    """
+    Returns the consumer key and secret and the access token and secret.
+
+    """
+    config = configparser.ConfigParser()
+    config.read(filename)
+    twitter = config['Twitter']
+    return (twitter['consumer_key'], twitter['consumer_secret'],
+            twitter['access_token'], twitter['access_token_secret'])
 
 def is_ratelimit(tweet):
     """
@@ -54,6 +71,13 @@ def is_ratelimit(tweet):
         else:
             return False
 
+def is_disconnect(data):
+    """
+    Returns True if the raw data is a disconnect message from Twitter.
+
+    """
+    return data.startswith('{"disconnect"')
+
 class StdOutListener(StreamListener):
     """
     A listener handles tweets that are the received from the stream.
@@ -83,33 +107,50 @@ class StdOutListener(StreamListener):
 
 class RotatingLogListener(StreamListener):
     """
-    A listener that writes UTF-8 encoded JSON tweets to rotating log files.
+    A listener that writes UTF-8 encoded JSON tweets to rotating gzip files.
 
-    Logs are rotated every 8 hours. Hardcoded. :)
+    Files are rotated every 8 hours, or after `max_bytes` compressed bytes,
+    and compressed as they are written. See `rotating.RotatingGzipWriter`.
 
     """
-    def __init__(self, api=None, basename=None):
+    def __init__(self, api=None, basename=None, max_bytes=None,
+                 us_basename=None):
         StreamListener.__init__(self, api)
         if basename is None:
             basename = 'tweets'
 
-        logHandler = TimedRotatingFileHandler("tweets", when="H", interval=8)
-        logFormatter = logging.Formatter('%(message)s')
-        logHandler.setFormatter(logFormatter)
-        logger = logging.getLogger('MyLogger')
-        logger.addHandler(logHandler)
-        logger.setLevel(logging.INFO)
-
-        self.logHandler = logHandler
-        self.logger = logger
+        self.writer = RotatingGzipWriter(basename, interval=8 * 3600,
+                                         max_bytes=max_bytes)
+        if us_basename is not None:
+            # Tweets with GPS coordinates in the contiguous US are written
+            # to their own archives, and everything else to `basename`.
+            self.us_writer = RotatingGzipWriter(us_basename, interval=8 * 3600,
+                                                max_bytes=max_bytes)
+        else:
+            self.us_writer = None
+        self.metrics = StreamMetrics()
+        self.status = None
         self.ratelimit = open('ratelimit.log', 'a')
         data = "\n\n# Stream restarted: {0}\n".format(time.strftime('%c'))
         print(data, file=self.ratelimit)
 
+    def on_connect(self):
+        self.metrics.connected()
+        data = "# Stream connected: {0}\n".format(time.strftime('%c'))
+        print(data, file=self.ratelimit)
+
     def on_data(self, raw_data):
-        # Note, the raw data is a utf-8 encoded json string.
-        # We strip off the trailing newline since the logger adds one for us.
-        self.logger.info(raw_data[:-1])
+        # Note, the raw data is a utf-8 encoded json string, with its
+        # trailing newline.
+        self.metrics.received()
+        if is_disconnect(raw_data):
+            # StreamListener.on_data would dispatch this, but it is
+            # overridden here.
+            return self.on_disconnect(json.loads(raw_data)['disconnect'])
+        if self.us_writer is not None and is_us_gps(raw_data):
+            self.us_writer.write(raw_data)
+        else:
+            self.writer.write(raw_data)
 
         if is_ratelimit(raw_data):
             data = '{0}\t{1}'.format(time.strftime("%c"), raw_data)
@@ -117,23 +158,60 @@ class RotatingLogListener(StreamListener):
 
     def on_error(self, status):
         print(status)
-
-def main_logger(basename=None):
-        l = RotatingLogListener(basename=basename)
+        self.status = status
+        # Disconnect, and let run_forever decide when to reconnect.
+        return False
+
+    def on_disconnect(self, notice):
+        print(notice)
+        return False
+
+    def pop_status(self):
+        status, self.status = self.status, None
+        return status
+
+    def flush(self):
+        self.writer.flush()
+        if self.us_writer is not None:
+            self.us_writer.flush()
+
+    def close(self):
+        self.writer.close()
+        if self.us_writer is not None:
+            self.us_writer.close()
+        self.ratelimit.close()
+
+def main_logger(basename=None, us_basename=None):
+        l = RotatingLogListener(basename=basename, us_basename=us_basename)
+        consumer_key, consumer_secret, access_token, access_token_secret = \
+            credentials()
         auth = OAuthHandler(consumer_key, consumer_secret)
         auth.set_access_token(access_token, access_token_secret)
         stream = Stream(auth, l)
 
-        # This fetches ANY geotagged tweet:
-        # https://dev.twitter.com/docs/streaming-apis/parameters#locations
-        stream.filter(locations=[-180,-90,180,90])
+        def connect():
+            try:
+                # This fetches ANY geotagged tweet:
+                # https://dev.twitter.com/docs/streaming-apis/parameters#locations
+                stream.filter(locations=[-180,-90,180,90])
+            finally:
+                # Write out tweets buffered before the disconnect.
+                l.flush()
+
+        # Reconnect from within the process, keeping the lock, rather than
+        # exiting and waiting for cron.
+        try:
+            run_forever(connect, l.metrics, status=l.pop_status)
+        finally:
+            # Write out buffered tweets and finish the current file.
+            l.close()
 
 if __name__ == '__main__':
     # http://stackoverflow.com/questions/6146523/running-python-script-with-cron-only-if-not-running
     with open('.lock', 'w') as f:
         try:
             fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
-        except IOError, e:
+        except IOError as e:
             if e.errno == errno.EAGAIN:
                 msg = '[{0}] Script already running.\n'.format(time.strftime('%c'))
                 sys.stderr.write(msg)
@@ -142,5 +220,8 @@ if __name__ == '__main__':
         else:
             msg = '\n[{0}] Restarting script.\n'.format(time.strftime('%c'))
             sys.stderr.write(msg)
-        main_logger()
+        if '--split-us' in sys.argv:
+            main_logger(us_basename='tweets_us')
+        else:
+            main_logger()
 
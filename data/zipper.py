@@ -1,29 +1,253 @@
 """
 Script to zip archived tweet files.
 
+Tweets are now compressed as they are written by stream.py. This is kept
+for archives written uncompressed.
+
+Each file is cut into blocks of whole lines, and the blocks of all files are
+compressed in parallel, one process per core, as independent gzip members
+(or zstd frames). The concatenated members are an ordinary gzip file, and
+each member start is a point where decompression can begin.
+
+Before an original is deleted, its compressed file is decompressed again
+and must match the original's length and sha1. The compressed file's hash
+is then recorded in the manifest used by backup.py, which need not hash it
+again.
+
+Usage:
+
+    $ python zipper.py [--zstd] [--processes N]
+
 A lockfile ensures that this script does not run until the previous run
 has finished.
 
 """
+from __future__ import print_function
+from __future__ import division
 
+import argparse
+import collections
 import errno
 import fcntl
 import glob
-import subprocess
+import gzip
+import hashlib
+import io
+import os
 import sys
 import time
+from multiprocessing import Pool, cpu_count
+
+from manifest import ALGORITHM, Manifest
+from rotating import gzip_member
+
+BLOCK_SIZE = 2**24
+
+# Suffixes of files that are already compressed, being written, or indexes.
+SKIP_SUFFIXES = ('.gz', '.zst', '.part', '.tmp', '.npy', '.gzidx')
 
-def gzip():
-    for filename in glob.glob('tweets.*'):
-        if filename.endswith('gz'):
+def archive_filenames(path='.'):
+    """
+    Returns the uncompressed archives in `path`.
+
+    """
+    filenames = []
+    for filename in sorted(glob.glob(os.path.join(path, 'tweets.*'))):
+        if filename.endswith(SKIP_SUFFIXES):
             continue
-        subprocess.call(['gzip', filename])
+        filenames.append(filename)
+    return filenames
+
+def blocks(filename, block_size=BLOCK_SIZE):
+    """
+    Yields blocks of about `block_size` bytes, each ending with a newline.
+
+    """
+    rest = b''
+    with io.open(filename, 'rb') as f:
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            data = rest + data
+            cut = data.rfind(b'\n') + 1
+            if cut == 0:
+                # A very long line. Keep reading.
+                rest = data
+                continue
+            rest = data[cut:]
+            yield data[:cut]
+    if rest:
+        yield rest
+
+def zstd_frame(data, level=3):
+    import zstandard
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+CODECS = {
+    'gzip': ('.gz', gzip_member, 6),
+    'zstd': ('.zst', zstd_frame, 3),
+}
+
+def open_compressed(filename, codec=None):
+    """
+    Opens a compressed archive for binary reading.
+
+    The codec is taken from the filename if not given.
+
+    """
+    if codec is None:
+        codec = 'zstd' if filename.endswith('.zst') else 'gzip'
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().stream_reader(
+            io.open(filename, 'rb'), read_across_frames=True, closefd=True)
+    return gzip.open(filename, 'rb')
+
+def verify(filename, digest, size, codec=None):
+    """
+    Returns `True` if `filename` decompresses to `size` bytes with `digest`.
+
+    """
+    h = hashlib.new(ALGORITHM)
+    total = 0
+    with open_compressed(filename, codec) as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+            total += len(block)
+    return total == size and h.hexdigest() == digest
+
+class _Output(object):
+    """
+    The compressed file being written for one archive.
+
+    """
+    def __init__(self, filename, codec):
+        self.filename = filename
+        self.codec = codec
+        self.final = filename + CODECS[codec][0]
+        self.tmpname = self.final + '.tmp'
+        self.fobj = io.open(self.tmpname, 'wb')
+        self.source = hashlib.new(ALGORITHM)
+        self.compressed = hashlib.new(ALGORITHM)
+        self.size = 0
+        self.blocks = 0
+
+    def write(self, data):
+        self.fobj.write(data)
+        self.compressed.update(data)
+        self.blocks += 1
+
+def _finish(output, manifest, compress, level):
+    if not output.blocks:
+        # An empty archive still needs a valid compressed file.
+        output.write(compress(b'', level))
+    output.fobj.close()
+    digest = output.source.hexdigest()
+    if not verify(output.tmpname, digest, output.size, output.codec):
+        os.unlink(output.tmpname)
+        print("Verification failed, keeping {0}".format(output.filename))
+        return False
+
+    os.rename(output.tmpname, output.final)
+    os.unlink(output.filename)
+    name = os.path.relpath(output.final, manifest.path)
+    extra = {'source_' + ALGORITHM: digest,
+             'source_size': output.size}
+    manifest.set(name, output.compressed.hexdigest(), **extra)
+    manifest.remove(os.path.relpath(output.filename, manifest.path))
+    manifest.save()
+    return True
+
+def compress(filenames=None, codec='gzip', processes=None, level=None,
+             block_size=BLOCK_SIZE, path='.'):
+    """
+    Compresses archives in parallel, verifying each before deleting it.
+
+    Parameters
+    ----------
+    filenames : list
+        The archives to compress. If `None`, all uncompressed archives in
+        `path`.
+    codec : str
+        'gzip', or 'zstd' for faster compression with the `zstandard`
+        package. zstd archives end in '.zst'; see `helpers.open_archive`.
+    processes : int
+        The number of compressing processes. If `None`, one per core.
+    level : int
+        The compression level. If `None`, the codec's default.
+    block_size : int
+        The uncompressed size of each independently compressed block.
+    path : str
+        The directory of the archives and of the manifest.
+
+    Returns
+    -------
+    report : dict
+        The numbers of files 'compressed' and 'failed', the bytes 'read' and
+        'written', and the 'elapsed' seconds.
+
+    """
+    if filenames is None:
+        filenames = archive_filenames(path)
+    compress_block, default_level = CODECS[codec][1:]
+    if level is None:
+        level = default_level
+
+    start = time.time()
+    manifest = Manifest(path)
+    report = {'compressed': 0, 'failed': 0, 'read': 0, 'written': 0}
+    pending = collections.deque()
+    pool = Pool(processes)
+    # Keep enough blocks in flight to use every process, but no more, so
+    # memory stays bounded.
+    window = 2 * (processes or cpu_count())
+
+    def drain(limit):
+        while len(pending) > limit:
+            output, result = pending.popleft()
+            if result is None:
+                if _finish(output, manifest, compress_block, level):
+                    report['compressed'] += 1
+                    report['written'] += os.path.getsize(output.final)
+                    print("Compressed {0}".format(output.filename))
+                    sys.stdout.flush()
+                else:
+                    report['failed'] += 1
+            else:
+                output.write(result.get())
+
+    try:
+        for filename in filenames:
+            output = _Output(filename, codec)
+            for block in blocks(filename, block_size):
+                output.source.update(block)
+                output.size += len(block)
+                result = pool.apply_async(compress_block, (block, level))
+                pending.append((output, result))
+                drain(window)
+            report['read'] += output.size
+            # Marks the end of the file.
+            pending.append((output, None))
+        drain(0)
+    finally:
+        pool.close()
+        pool.join()
+
+    report['elapsed'] = time.time() - start
+    return report
 
 def main():
+    parser = argparse.ArgumentParser(description='Compress tweet archives.')
+    parser.add_argument('--zstd', action='store_true',
+                        help='compress with zstd instead of gzip')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+
     with open('.lock_gzip', 'w') as f:
         try:
             fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
-        except IOError, e:
+        except IOError as e:
             if e.errno == errno.EAGAIN:
                 msg = '[{0}] Gzip script already running.\n'
                 msg = msg.format(time.strftime('%c'))
@@ -33,7 +257,11 @@ def main():
         else:
             msg = '[{0}] Starting gzip script.\n'.format(time.strftime('%c'))
             sys.stderr.write(msg)
-        gzip()
+        codec = 'zstd' if args.zstd else 'gzip'
+        report = compress(codec=codec, processes=args.processes)
+        msg = ("[{0}] Compressed {compressed} files, {read} to {written} "
+               "bytes, in {elapsed:.1f} s. Failed: {failed}.")
+        print(msg.format(time.strftime('%c'), **report))
 
 if __name__ == '__main__':
     main()
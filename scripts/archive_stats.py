@@ -0,0 +1,24 @@
+"""
+Print per-day (and per-file) category counts for a directory of archives.
+
+Results are cached in the archive directory, so reruns only count new
+archives.
+
+Usage:
+
+    $ python archive_stats.py ../data [processes] [--files]
+
+"""
+import sys
+
+from twitterproj.archivestats import archive_stats, print_archive_stats
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    path = args[0]
+    if len(args) > 1:
+        processes = int(args[1])
+    else:
+        processes = None
+    stats = archive_stats(path, processes=processes)
+    print_archive_stats(stats, per_file='--files' in sys.argv)
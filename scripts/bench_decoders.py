@@ -0,0 +1,19 @@
+"""
+Compare the available JSON decoders on a sample of a tweet archive.
+
+Usage:
+
+    $ python bench_decoders.py ../data/tweets.2014-08-09_12.gz [count]
+
+"""
+import sys
+
+from twitterproj.decoders import benchmark
+
+if __name__ == '__main__':
+    filename = sys.argv[1]
+    if len(sys.argv) > 2:
+        count = int(sys.argv[2])
+    else:
+        count = 10**5
+    benchmark(filename, count=count)
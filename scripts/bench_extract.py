@@ -0,0 +1,20 @@
+"""
+Compare the time to extract stored fields with `extract` and
+`extract_fields` on US geocoded tweets from an archive.
+
+Usage:
+
+    $ python bench_extract.py ../data/tweets.2014-08-09_12.gz [count]
+
+"""
+import sys
+
+from twitterproj.helpers import benchmark_extract
+
+if __name__ == '__main__':
+    filename = sys.argv[1]
+    if len(sys.argv) > 2:
+        count = int(sys.argv[2])
+    else:
+        count = 10**5
+    benchmark_extract(filename, count=count)
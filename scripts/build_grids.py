@@ -0,0 +1,41 @@
+"""
+Build hashtag counts for counties, states, and squares in a single pass,
+with and without bot filtration.
+
+Takes one scan of the tweet collection per call, instead of one geo query
+per region.
+
+"""
+import twitterproj as t
+from usoutline import square_grid
+
+def build_grids(bot_filtered=True, dry_run=True):
+    db = t.connect()
+    if bot_filtered:
+        skip = t.subcollections.get_skip_users()
+        collections = {
+            'counties': db.grids.counties.bot_filtered,
+            'states': db.grids.states.bot_filtered,
+            'squares': db.grids.squares.bot_filtered,
+        }
+    else:
+        skip = None
+        collections = {
+            'counties': db.grids.counties,
+            'states': db.grids.states,
+            'squares': db.grids.squares,
+        }
+
+    t.build_hashtag_grids(
+        db.tweets.with_hashtags,
+        collections,
+        county_shp='../tiger/tl_2014_us_county.shp',
+        state_shp='../tiger/tl_2014_us_state.shp',
+        cells=square_grid(),
+        skip_users=skip,
+        dry_run=dry_run
+    )
+
+if __name__ == '__main__':
+    build_grids(bot_filtered=True, dry_run=True)
+    build_grids(bot_filtered=False, dry_run=True)
@@ -0,0 +1,31 @@
+"""
+Build the square-grid count pyramid, with and without bot filtration.
+
+Tweets are counted once at 0.25 degrees, and the 0.5, 1, 2, 4, 8 and 16
+degree levels are summed from it. Any of these resolutions can then be read
+with `twitterproj.query_pyramid` instead of rebuilding a grid.
+
+"""
+import twitterproj as t
+
+def build_pyramid(bot_filtered=True, dry_run=True):
+    db = t.connect()
+    if bot_filtered:
+        skip = t.subcollections.get_skip_users()
+        collection = db.grids.pyramid.bot_filtered
+    else:
+        skip = None
+        collection = db.grids.pyramid
+
+    t.build_pyramid(
+        db.tweets.with_hashtags,
+        collection,
+        resolution=0.25,
+        levels=7,
+        skip_users=skip,
+        dry_run=dry_run
+    )
+
+if __name__ == '__main__':
+    build_pyramid(bot_filtered=True, dry_run=True)
+    build_pyramid(bot_filtered=False, dry_run=True)
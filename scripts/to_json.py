@@ -60,13 +60,15 @@ Properties:
 """
 from collections import OrderedDict, defaultdict
 import us
-import fiona
 import pandas
 import dit
 import twitterproj
 import numpy as np
 import json
 
+STATE_SHP = '../tiger/tl_2014_us_state.shp'
+COUNTY_SHP = '../tiger/tl_2014_us_county.shp'
+
 def entropy(place):
     """
     Return the entropy of a county's hashtag counts.
@@ -84,31 +86,17 @@ def names():
     # We use a single file for this one.
     data = defaultdict(dict)
 
-    # The abbreviations of the contiguous states
-    desired = us.states.mapping('abbr', 'fips', us.STATES_CONTIGUOUS)
-
     # States
-    with fiona.open('../tiger/tl_2014_us_state.shp') as f:
-        for state in f:
-            state = state['properties']
-            fips = state['STATEFP']
-            abbr = state['STUSPS']
-            if abbr not in desired:
-                continue
-            data[fips]['name'] = state['NAME']
-            data[fips]['abbr'] = abbr
-
-    # Counties
-    with fiona.open('../tiger/tl_2014_us_county.shp') as f:
-        for county in f:
-            county = county['properties']
-            # Keep only counties in contiguous states.
-            state_fips = county['STATEFP']
-            if state_fips not in data:
-                continue
-            geoid = county['GEOID']
-            data[geoid]['name'] = county['NAMELSAD']
-            data[geoid]['state'] = state_fips
+    states = twitterproj.state_cache(STATE_SHP)
+    for fips, state in states.properties.items():
+        data[fips]['name'] = state['NAME']
+        data[fips]['abbr'] = state['STUSPS']
+
+    # Counties, in contiguous states.
+    counties = twitterproj.county_cache(COUNTY_SHP)
+    for geoid, county in counties.properties.items():
+        data[geoid]['name'] = county['NAMELSAD']
+        data[geoid]['state'] = county['STATEFP']
 
     with open('json/names.json', 'w') as f:
         json.dump(data, f)
@@ -151,19 +139,11 @@ def population():
 
 def landarea():
 
-    # The abbreviations of the contiguous states
-    desired = us.states.mapping('abbr', 'fips', us.STATES_CONTIGUOUS)
-
     # State
+    states = twitterproj.state_cache(STATE_SHP)
     data_state = {}
-    with fiona.open('../tiger/tl_2014_us_state.shp') as f:
-        for state in f:
-            state = state['properties']
-            fips = state['STATEFP']
-            abbr = state['STUSPS']
-            if abbr not in desired:
-                continue
-            data_state[fips] = state['ALAND']
+    for fips, state in states.properties.items():
+        data_state[fips] = state['ALAND']
 
     vals = np.array(data_state.values())
     data_state['norm'] = vals.sum()
@@ -174,16 +154,10 @@ def landarea():
         json.dump(data_state, f)
 
     # County
+    counties = twitterproj.county_cache(COUNTY_SHP)
     data_county = {}
-    with fiona.open('../tiger/tl_2014_us_county.shp') as f:
-        for county in f:
-            county = county['properties']
-            # Keep only counties in contiguous states.
-            state_fips = county['STATEFP']
-            if state_fips not in data_state:
-                continue
-            geoid = county['GEOID']
-            data_county[geoid] = county['ALAND']
+    for geoid, county in counties.properties.items():
+        data_county[geoid] = county['ALAND']
 
     vals = np.array(data_county.values())
     data_county['norm'] = vals.sum()
@@ -399,44 +373,40 @@ def users():
 
     def user_states():
         # States
-        # The abbreviations of the contiguous states
-        desired = us.states.mapping('abbr', 'fips', us.STATES_CONTIGUOUS)
-
-        with fiona.open('../tiger/tl_2014_us_state.shp') as f:
-            for state in f:
-                users = set([])
-                fips = state['properties']['STATEFP']
-                abbr = state['properties']['STUSPS']
-                if abbr not in desired:
-                    continue
-                for tweet in twitterproj.tweets_in_region(db.tweets.with_hashtags,
-                                                          state['geometry']):
-                    userid = tweet['user']['id']
-                    if userid not in skip_users:
-                        users.add(userid)
-                else:
-                    counts[0][fips] = len(users)
-                    print(fips, counts[0][fips])
+        states = twitterproj.state_cache(STATE_SHP).regions()
+        for fips, state in states.items():
+            users = set([])
+            for tweet in twitterproj.tweets_in_region(db.tweets.with_hashtags,
+                                                      state['geometry'],
+                                                      fields={'user.id': True},
+                                                      skip_users=skip_users):
+                userid = tweet['user']['id']
+                if userid not in skip_users:
+                    users.add(userid)
+            else:
+                counts[0][fips] = len(users)
+                print(fips, counts[0][fips])
 
     def user_counties():
         # Counties
         geoids = db.grids.counties.bot_filtered.find({}, {'geoid': True})
         geoids = [g['geoid'] for g in geoids]
         geoids = set(geoids)
-        with fiona.open('../tiger/tl_2014_us_county.shp') as f:
-            for region in f:
-                users = set([])
-                key = region['properties']['GEOID']
-                if key not in geoids:
-                    continue
-                for tweet in twitterproj.tweets_in_region(db.tweets.with_hashtags,
-                                                          region['geometry']):
-                    userid = tweet['user']['id']
-                    if userid not in skip_users:
-                        users.add(userid)
-                else:
-                    counts[1][key] = len(users)
-                    print(key, counts[1][key])
+        counties = twitterproj.county_cache(COUNTY_SHP).regions()
+        for key, region in counties.items():
+            users = set([])
+            if key not in geoids:
+                continue
+            for tweet in twitterproj.tweets_in_region(db.tweets.with_hashtags,
+                                                      region['geometry'],
+                                                      fields={'user.id': True},
+                                                      skip_users=skip_users):
+                userid = tweet['user']['id']
+                if userid not in skip_users:
+                    users.add(userid)
+            else:
+                counts[1][key] = len(users)
+                print(key, counts[1][key])
 
     def user_squares():
         # Squares
@@ -444,7 +414,9 @@ def users():
             users = set([])
             key = region['_id']
             for tweet in twitterproj.tweets_in_region(db.tweets.with_hashtags,
-                                                      region['geometry']):
+                                                      region['geometry'],
+                                                      fields={'user.id': True},
+                                                      skip_users=skip_users):
                 userid = tweet['user']['id']
                 if userid not in skip_users:
                     users.add(userid)
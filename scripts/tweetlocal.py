@@ -9,7 +9,6 @@ import twitterproj
 from collections import defaultdict, OrderedDict
 import json
 import datetime
-import fiona
 import us
 import pytz
 
@@ -31,9 +30,10 @@ z = tzwhere()
 county_shp = '../tiger/tl_2014_us_county.shp'
 class JobManager(twitterproj.JobManager):
     def parent(self):
-        with fiona.open(county_shp, 'r') as f:
-            for i, feature in enumerate(f):
-                self.launch_child(i, feature, wait=60)
+        # Job ids are shapefile positions, so they match earlier runs.
+        regions = twitterproj.county_cache(county_shp).regions()
+        for feature in regions.values():
+            self.launch_child(int(feature['id']), feature, wait=60)
 
     def child(self, job_id, feature):
         state_fips = feature['properties']['STATEFP']
@@ -22,73 +22,44 @@ USA = box(-124.7625, 24.5210, -66.9326, 49.3845) # contiguous
 def build_sparse_grid(tweet_collection,
                       grid_collection,
                       skip_users=True,
-                      drop=True):
+                      drop=True,
+                      resolution=.5):
     """
-    Takes about 30 minutes.
+    Builds the squares grid in one pass over the tweets.
 
     """
-    if drop:
-        grid_collection.drop()
-
-    hci = twitterproj.hashtag_counts_in
     if skip_users:
         uids = twitterproj.subcollections.get_skip_users()
     else:
         uids = None
 
-    for i, cell in enumerate(us_grid()):
-        counts, skipped = hci(tweet_collection, cell, uids)
-        doc = OrderedDict()
-        doc['geometry'] = mapping(cell)
-        doc['counts'] = counts
-        # increase latitudes to max lat, then increases longitude
-        doc['_id'] = i
-        try:
-            grid_collection.insert(doc)
-        except pymongo.errors.DocumentTooLarge:
-            # Since we are specifying a unique id, let the error raise.
-            raise
+    twitterproj.build_square_grid(tweet_collection, grid_collection,
+                                  square_grid(resolution),
+                                  skip_users=uids, drop=drop)
 
+def square_grid(resolution=.5, sparse=True):
+    """
+    Returns the grid over the contiguous USA as a SquareGrid.
 
-def us_grid(resolution=.5, sparse=True):
-    resolution = .5
-    bounds = USA.bounds
-    # Grid boundaries are determined by nearest degree.
-    min_long = np.floor(bounds[0])
-    min_lat  = np.floor(bounds[1])
-    max_long = np.ceil(bounds[2])
-    max_lat  = np.ceil(bounds[3])
-    # Division should be close to an integer.
-    # Add one to number of points to include the end
-    # This is robust only to resolutions that "evenly" divide the range.
-    nPointsLong = np.around((max_long - min_long) / resolution) + 1
-    nPointsLat  = np.around((max_lat  - min_lat ) / resolution) + 1
-    long_points = np.linspace(min_long, max_long, nPointsLong)
-    lat_points  = np.linspace(min_lat,  max_lat,  nPointsLat )
+    With `sparse`, only cells intersecting the contiguous USA are kept.
 
-    outline = contiguous_outline2('../tiger/cb_2013_us_nation_20m.shp')
+    """
+    outline = None
+    if sparse:
+        outline = contiguous_outline2('../tiger/cb_2013_us_nation_20m.shp')
+    return twitterproj.SquareGrid(resolution, USA.bounds, outline)
 
-    for i, (xi, yi) in enumerate(product(range(len(long_points)-1),
-                                         range(len(lat_points)-1))):
-        cell = box(long_points[xi], lat_points[yi],
-                   long_points[xi+1], lat_points[yi+1])
-        if sparse:
-            # Add cell only if it intersects contiguous USA
-            if cell.intersects(outline):
-                yield cell
-        else:
-            yield cell
+def us_grid(resolution=.5, sparse=True):
+    """
+    Yields the cells of the grid, with latitude increasing, then longitude.
+
+    """
+    return square_grid(resolution, sparse).cells()
 
 def contiguous_outline(countyshp):
-    fips = set([state.fips for state in us.STATES_CONTIGUOUS])
-    shapes = []
-    with fiona.open(countyshp) as f:
-        for county in f:
-            statefp = county['properties']['STATEFP']
-            if statefp in fips:
-                shapes.append(asShape(county['geometry']))
-
-    outline = unary_union(shapes)
+    # The cache holds only counties in the contiguous states.
+    shapes = twitterproj.county_cache(countyshp).geometries().values()
+    outline = unary_union(list(shapes))
     return outline
 
 def contiguous_outline2(usshp):
@@ -7,3 +7,12 @@ from .jobmanager import grouper, JobManager
 from .localtime import *
 from .tweetrates import *
 from .fisher import *
+from .squaregrid import *
+from .partition import *
+from .pyramid import *
+from .tweetindex import *
+from .columnar import *
+from .archivestats import *
+from .regioncache import *
+from .raster import *
+from .regionfields import *
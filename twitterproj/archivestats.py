@@ -0,0 +1,243 @@
+"""
+Archive-wide statistics, for monitoring the health of the collection.
+
+`helpers.counts` categorizes the tweets of one file. Here, the files of an
+archive directory are categorized in parallel, one file per process, and
+the results are reduced into per-file and per-day tables.
+
+Results are cached in a JSON file, keyed by filename and validated against
+the size and modification time of the file. Reruns only read archives that
+are new or have changed since they were last counted.
+
+"""
+from __future__ import print_function
+from __future__ import division
+
+from collections import Counter, OrderedDict
+import glob
+import io
+import json
+import os
+import re
+import sys
+import time
+
+from .helpers import COUNT_CATEGORIES, count_categories
+from .tweetindex import CHECKPOINT_SUFFIX, INDEX_SUFFIX, ZRAN_SUFFIX
+
+__all__ = [
+    'archive_date',
+    'archive_stats',
+    'daily_stats',
+    'print_archive_stats',
+]
+
+CACHE_FILENAME = '.archivestats.json'
+
+# data/stream.py writes 'tweets.*', and with --split-us the US GPS tweets go
+# to 'tweets_us.*' instead. Both are needed for the full counts of a day.
+ARCHIVE_PATTERNS = ('tweets.*', 'tweets_us.*')
+
+# Archives are named by TimedRotatingFileHandler, e.g. tweets.2014-08-09_12
+DATE_PATTERN = re.compile(r'(\d{4}-\d{2}-\d{2})')
+
+def archive_date(filename):
+    """
+    Returns the day, as 'YYYY-MM-DD', that an archive was started.
+
+    The day is taken from the filename, or from the modification time of the
+    file if the filename has no date.
+
+    """
+    match = DATE_PATTERN.search(os.path.basename(filename))
+    if match:
+        return match.group(1)
+    return time.strftime('%Y-%m-%d', time.localtime(os.path.getmtime(filename)))
+
+def _file_key(filename):
+    st = os.stat(filename)
+    return st.st_size, st.st_mtime
+
+def _load_cache(filename):
+    if filename is None or not os.path.isfile(filename):
+        return {}
+    with io.open(filename, 'r', encoding='utf-8') as f:
+        try:
+            return json.load(f)
+        except ValueError:
+            # A corrupt cache is rebuilt.
+            return {}
+
+def _save_cache(filename, cache):
+    if filename is None:
+        return
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'w') as f:
+        json.dump(cache, f, sort_keys=True)
+    os.rename(tmpname, filename)
+
+def _stats_worker(filename):
+    size, mtime = _file_key(filename)
+    counts = count_categories(filename, raise_on_error=False)
+    entry = OrderedDict()
+    entry['size'] = size
+    entry['mtime'] = mtime
+    entry['date'] = archive_date(filename)
+    entry['counts'] = counts
+    return filename, entry
+
+def archive_stats(path, processes=None, cache=True, save_every=50):
+    """
+    Returns category counts for every archive in a directory.
+
+    Parameters
+    ----------
+    path : str or list
+        The directory of archives, or a list of archive filenames. For a
+        directory, all files named 'tweets.*' or 'tweets_us.*' are counted,
+        except for the indexes of `tweetindex`.
+    processes : int
+        The number of worker processes. If `None`, the number of CPUs.
+    cache : bool or str
+        The JSON file caching the results. If `True`, '.archivestats.json'
+        in the directory of the archives. If `False`, nothing is cached.
+    save_every : int
+        Save the cache after this many newly counted archives, so that
+        an interrupted run does not lose its progress.
+
+    Returns
+    -------
+    stats : OrderedDict
+        Maps each filename, in sorted order, to a dictionary with its 'size',
+        'mtime', 'date', and 'counts'. The counts are keyed by the
+        categories of `helpers.COUNT_CATEGORIES`, and 'invalid'.
+
+    """
+    if isinstance(path, (list, tuple)):
+        filenames = sorted(path)
+        directory = os.path.dirname(filenames[0]) if filenames else '.'
+    else:
+        filenames = []
+        for pattern in ARCHIVE_PATTERNS:
+            filenames.extend(glob.glob(os.path.join(path, pattern)))
+        filenames.sort()
+        # Skip the offset indexes written alongside the archives, and the
+        # archive that data/stream.py is still writing.
+        suffixes = (INDEX_SUFFIX, CHECKPOINT_SUFFIX, ZRAN_SUFFIX, '.part')
+        filenames = [f for f in filenames if not f.endswith(suffixes)]
+        directory = path
+
+    if cache is True:
+        cache = os.path.join(directory, CACHE_FILENAME)
+    elif cache is False:
+        cache = None
+    cached = _load_cache(cache)
+
+    stats = OrderedDict()
+    todo = []
+    for filename in filenames:
+        entry = cached.get(os.path.abspath(filename))
+        size, mtime = _file_key(filename)
+        if entry and entry['size'] == size and entry['mtime'] == mtime:
+            stats[filename] = entry
+        else:
+            todo.append(filename)
+
+    print("{0} archives, {1} cached, {2} to count.".format(
+          len(filenames), len(filenames) - len(todo), len(todo)))
+    sys.stdout.flush()
+
+    def record(i, filename, entry):
+        stats[filename] = entry
+        cached[os.path.abspath(filename)] = entry
+        print("[{0}/{1}] {2}".format(i + 1, len(todo), filename))
+        sys.stdout.flush()
+        if (i + 1) % save_every == 0:
+            _save_cache(cache, cached)
+
+    try:
+        if processes == 1 or len(todo) <= 1:
+            for i, filename in enumerate(todo):
+                record(i, *_stats_worker(filename))
+        else:
+            from multiprocessing import Pool
+            pool = Pool(processes)
+            try:
+                results = pool.imap_unordered(_stats_worker, todo)
+                for i, (filename, entry) in enumerate(results):
+                    record(i, filename, entry)
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        # Keep whatever was counted, even if interrupted.
+        if todo:
+            _save_cache(cache, cached)
+
+    return OrderedDict((filename, stats[filename]) for filename in filenames)
+
+def daily_stats(stats):
+    """
+    Reduces per-file statistics into per-day totals.
+
+    Parameters
+    ----------
+    stats : dict
+        The per-file statistics, as returned by `archive_stats`.
+
+    Returns
+    -------
+    days : OrderedDict
+        Maps each day, in sorted order, to a Counter of the category counts
+        and the number of archives ('files') and bytes ('size') for that day.
+
+    """
+    days = {}
+    for entry in stats.values():
+        day = days.setdefault(entry['date'], Counter())
+        day.update(entry['counts'])
+        day['files'] += 1
+        day['size'] += entry['size']
+    return OrderedDict((day, days[day]) for day in sorted(days))
+
+def print_archive_stats(stats, per_file=False):
+    """
+    Prints the per-day table, and optionally the per-file table, of counts.
+
+    A day with no geocoded US tweets, or a high rate of undecodable lines,
+    usually means the stream was down or misbehaving.
+
+    """
+    keys = [key for key, label in COUNT_CATEGORIES] + ['invalid']
+    header = ['date', 'files'] + keys + ['usa_geo%']
+    rows = []
+    for day, counts in daily_stats(stats).items():
+        row = [day, counts['files']] + [counts[key] for key in keys]
+        rows.append(row + [_percent(counts['usa_geo'], counts['total'])])
+    _print_table(header, rows)
+
+    if per_file:
+        print()
+        header = ['file'] + keys + ['usa_geo%']
+        rows = []
+        for filename, entry in stats.items():
+            counts = entry['counts']
+            row = [os.path.basename(filename)]
+            row += [counts.get(key, 0) for key in keys]
+            rows.append(row + [_percent(counts['usa_geo'], counts['total'])])
+        _print_table(header, rows)
+
+def _percent(numerator, denominator):
+    if not denominator:
+        return '-'
+    return '{0:.2f}'.format(100 * numerator / denominator)
+
+def _print_table(header, rows):
+    rows = [[str(x) for x in row] for row in rows]
+    widths = [len(h) for h in header]
+    for row in rows:
+        widths = [max(w, len(x)) for w, x in zip(widths, row)]
+    fmt = '  '.join('{{{0}:>{1}}}'.format(i, w) for i, w in enumerate(widths))
+    print(fmt.format(*header))
+    for row in rows:
+        print(fmt.format(*row))
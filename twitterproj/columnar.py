@@ -0,0 +1,415 @@
+"""
+Columnar storage of tweets, as an alternative to the Mongo `tweets`
+collection.
+
+The fields kept by `helpers.extract` are stored as compressed Parquet files,
+partitioned by the day each tweet was created:
+
+    <path>/date=2014-08-09/<source>-<chunk>.parquet
+
+Scans read only the columns they need and skip whole partitions and row
+groups that fall outside the requested time range or bounding box.
+`TweetStore.find` and `TweetStore.tweets_in_region` yield documents shaped
+like those in the `tweets` collection, so a store can be passed to
+`tweets_in_region`, `hashtag_counts_in`, `user_counts_in` and
+`build_hashtag_grids` in place of a collection.
+
+Requires the `pyarrow` package.
+
+"""
+from __future__ import print_function
+
+from collections import defaultdict
+import glob
+import io
+import os
+import sys
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from .helpers import (LocationFilter, extract_fields, source_name,
+                      us_geocoded_tweets)
+from .partition import as_geometry
+
+__all__ = [
+    'TweetStore',
+    'populate_store',
+]
+
+if pa is not None:
+    SCHEMA = pa.schema([
+        ('created_at', pa.timestamp('ms')),
+        ('id_str', pa.string()),
+        ('lon', pa.float64()),
+        ('lat', pa.float64()),
+        ('hashtags', pa.list_(pa.string())),
+        ('text', pa.string()),
+        ('lang', pa.string()),
+        ('user_id', pa.int64()),
+        ('user_id_str', pa.string()),
+        ('user_favourites_count', pa.int64()),
+        ('user_followers_count', pa.int64()),
+        ('user_friends_count', pa.int64()),
+        ('user_statuses_count', pa.int64()),
+        ('user_created_at', pa.timestamp('ms')),
+    ])
+
+USER_FIELDS = [
+    'id',
+    'id_str',
+    'favourites_count',
+    'followers_count',
+    'friends_count',
+    'statuses_count',
+    'created_at',
+]
+
+# The columns needed for each field of a tweet document.
+FIELD_COLUMNS = {
+    'created_at': ['created_at'],
+    'id_str': ['id_str'],
+    'coordinates': ['lon', 'lat'],
+    'hashtags': ['hashtags'],
+    'text': ['text'],
+    'lang': ['lang'],
+    'user': ['user_' + field for field in USER_FIELDS],
+}
+for field in USER_FIELDS:
+    FIELD_COLUMNS['user.' + field] = ['user_' + field]
+
+# The fields of a tweet that a `find` query may compare, and their columns.
+QUERY_COLUMNS = dict((field, columns[0])
+                     for field, columns in FIELD_COLUMNS.items()
+                     if field not in ('coordinates', 'hashtags', 'user'))
+
+# The query operators that `find` supports, besides equality.
+QUERY_OPERATORS = ('$in', '$nin')
+
+SOURCES = '_sources'
+
+def columns_for(fields):
+    """
+    Returns the columns needed for a Mongo-style projection.
+
+    Parameters
+    ----------
+    fields : dict or list
+        The fields of the tweet documents to return, such as 'hashtags' or
+        'user.id'. If `None`, all columns are returned.
+
+    """
+    if fields is None:
+        return list(SCHEMA.names)
+    if isinstance(fields, dict):
+        fields = [field for field, keep in fields.items() if keep]
+    columns = []
+    for field in fields:
+        if field == '_id':
+            continue
+        for column in FIELD_COLUMNS[field]:
+            if column not in columns:
+                columns.append(column)
+    return columns
+
+def spec_filter(spec):
+    """
+    Returns the dataset filter for a Mongo-style query, or `None` if the
+    query is empty.
+
+    Each field of `spec` must be in `QUERY_COLUMNS`, such as 'lang' or
+    'user.id', and is compared for equality or with one of
+    `QUERY_OPERATORS`, as in {'user.id': {'$nin': [12, 34]}}. Any other
+    query raises ValueError.
+
+    """
+    expr = None
+    for field, value in (spec or {}).items():
+        if field not in QUERY_COLUMNS:
+            msg = 'Cannot query {0!r}. Supported fields: {1}.'
+            raise ValueError(msg.format(field,
+                                        ', '.join(sorted(QUERY_COLUMNS))))
+        column = ds.field(QUERY_COLUMNS[field])
+        if not isinstance(value, dict):
+            f = column == value
+        elif len(value) == 1 and next(iter(value)) in QUERY_OPERATORS:
+            op, values = next(iter(value.items()))
+            f = column.isin(list(values))
+            if op == '$nin':
+                # As in Mongo, missing values are not in any list.
+                f = ~f | column.is_null()
+        else:
+            msg = 'Cannot query {0!r} with {1!r}. Supported: equality, {2}.'
+            raise ValueError(msg.format(field, value,
+                                        ', '.join(QUERY_OPERATORS)))
+        expr = f if expr is None else expr & f
+    return expr
+
+def to_documents(batch):
+    """
+    Yields tweet documents, shaped as in the `tweets` collection, from a
+    record batch.
+
+    """
+    data = batch.to_pydict()
+    n = batch.num_rows
+    user_columns = [(column[5:], data[column]) for column in batch.schema.names
+                    if column.startswith('user_')]
+    for i in range(n):
+        doc = {}
+        for column in ('created_at', 'id_str', 'hashtags', 'text', 'lang'):
+            if column in data:
+                doc[column] = data[column][i]
+        if 'lon' in data:
+            doc['coordinates'] = [data['lon'][i], data['lat'][i]]
+        if user_columns:
+            doc['user'] = dict((field, values[i])
+                               for field, values in user_columns)
+        yield doc
+
+def to_row(tweet):
+    """
+    Returns a flat row of columns from an extracted tweet.
+
+    """
+    user = tweet['user']
+    return {
+        'created_at': tweet['created_at'],
+        'id_str': tweet['id_str'],
+        'lon': tweet['coordinates'][0],
+        'lat': tweet['coordinates'][1],
+        'hashtags': tweet['hashtags'],
+        'text': tweet['text'],
+        'lang': tweet['lang'],
+        'user_id': int(user['id_str']),
+        'user_id_str': user['id_str'],
+        'user_favourites_count': user['favourites_count'],
+        'user_followers_count': user['followers_count'],
+        'user_friends_count': user['friends_count'],
+        'user_statuses_count': user['statuses_count'],
+        'user_created_at': user['created_at'],
+    }
+
+class TweetStore(object):
+    """
+    A directory of tweets stored as partitioned Parquet files.
+
+    Examples
+    --------
+    >>> store = TweetStore('/data/tweets.parquet')
+    >>> store.ingest('tweets.2014-08-09_12.gz')
+    >>> counts, skipped = hashtag_counts_in(store, seattle)
+    >>> for tweet in store.find(start=datetime.datetime(2014, 8, 9),
+    ...                         fields=['created_at', 'hashtags']):
+    ...     pass
+
+    """
+    def __init__(self, path, compression='zstd'):
+        if pa is None:
+            raise ImportError('TweetStore requires the pyarrow package.')
+        self.path = path
+        self.compression = compression
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def sources(self):
+        """
+        Returns the set of sources that have been completely ingested.
+
+        """
+        filename = os.path.join(self.path, SOURCES)
+        if not os.path.isfile(filename):
+            return set([])
+        with io.open(filename, 'r', encoding='utf-8') as f:
+            return set(line.strip() for line in f if line.strip())
+
+    def write(self, tweets, source, chunk=0):
+        """
+        Writes extracted tweets, one file per day.
+
+        Parameters
+        ----------
+        tweets : list
+            The tweets, as returned by `helpers.extract_fields`.
+        source : str
+            The name of the archive the tweets came from.
+        chunk : int
+            Distinguishes files written from the same source and day.
+
+        """
+        days = defaultdict(list)
+        for tweet in tweets:
+            days[tweet['created_at'].strftime('%Y-%m-%d')].append(to_row(tweet))
+
+        for day, rows in days.items():
+            directory = os.path.join(self.path, 'date=' + day)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            table = pa.Table.from_pylist(rows, schema=SCHEMA)
+            name = '{0}-{1}.parquet'.format(source, chunk)
+            # Write then rename, so a partial file is never read. Scans
+            # ignore files beginning with a dot.
+            tmpname = os.path.join(directory, '.' + name)
+            pq.write_table(table, tmpname, compression=self.compression)
+            os.rename(tmpname, os.path.join(directory, name))
+
+    def ingest(self, filename, chunksize=10**6, source=None):
+        """
+        Ingests the US geocoded tweets of an archive.
+
+        Files from a previous, interrupted ingestion of the same source are
+        replaced.
+
+        """
+        if source is None:
+            source = source_name(filename)
+        if source in self.sources():
+            print("Already inserted.")
+            return
+
+        pattern = os.path.join(self.path, 'date=*', source + '-*.parquet')
+        for stale in glob.glob(pattern):
+            os.unlink(stale)
+
+        tweets = []
+        chunk = 0
+        for tweet, valid in us_geocoded_tweets(filename, prefilter=True):
+            tweets.append(extract_fields(tweet))
+            if len(tweets) == chunksize:
+                self.write(tweets, source, chunk)
+                tweets = []
+                chunk += 1
+        if tweets:
+            self.write(tweets, source, chunk)
+
+        with io.open(os.path.join(self.path, SOURCES), 'a',
+                     encoding='utf-8') as f:
+            f.write(source + '\n')
+
+    def dataset(self):
+        partitioning = ds.partitioning(pa.schema([('date', pa.string())]),
+                                       flavor='hive')
+        return ds.dataset(self.path, format='parquet',
+                          partitioning=partitioning)
+
+    def batches(self, columns=None, start=None, end=None, bbox=None,
+                spec=None):
+        """
+        Yields record batches, reading only the requested data.
+
+        Parameters
+        ----------
+        columns : list
+            The columns to read. If `None`, all columns are read.
+        start, end : datetime
+            Only tweets created in [start, end) are returned.
+        bbox : tuple
+            Only tweets within (min lon, min lat, max lon, max lat),
+            inclusive, are returned.
+        spec : dict
+            Only tweets matching the query are returned. See `spec_filter`.
+
+        """
+        if columns is None:
+            columns = list(SCHEMA.names)
+
+        # The day partitions prune whole directories, and the column
+        # statistics of each row group prune within files.
+        filters = []
+        timestamp = SCHEMA.field('created_at').type
+        if start is not None:
+            filters.append(ds.field('date') >= start.strftime('%Y-%m-%d'))
+            filters.append(ds.field('created_at') >= pa.scalar(start, timestamp))
+        if end is not None:
+            filters.append(ds.field('date') <= end.strftime('%Y-%m-%d'))
+            filters.append(ds.field('created_at') < pa.scalar(end, timestamp))
+        if bbox is not None:
+            filters.append(ds.field('lon') >= bbox[0])
+            filters.append(ds.field('lon') <= bbox[2])
+            filters.append(ds.field('lat') >= bbox[1])
+            filters.append(ds.field('lat') <= bbox[3])
+        if spec:
+            filters.append(spec_filter(spec))
+
+        expr = None
+        for f in filters:
+            expr = f if expr is None else expr & f
+        return self.dataset().to_batches(columns=columns, filter=expr)
+
+    def find(self, spec=None, fields=None, start=None, end=None, bbox=None):
+        """
+        Yields tweet documents, like `collection.find()`.
+
+        `spec` may compare scalar fields for equality or with '$in' and
+        '$nin', and is pushed down to the scan; see `spec_filter`. Use
+        `start`, `end` and `bbox` to restrict the tweets by time and place;
+        see `batches`.
+
+        """
+        columns = columns_for(fields)
+        batches = self.batches(columns, start=start, end=end, bbox=bbox,
+                               spec=spec)
+        for batch in batches:
+            for doc in to_documents(batch):
+                yield doc
+
+    def tweets_in_region(self, geometry, fields=None):
+        """
+        Yields tweet documents within a geometry, like `geo.tweets_in_region`.
+
+        The bounding box of the geometry is pushed down to the scan, and the
+        remaining points are tested against the geometry itself. Points on
+        the boundary are within the geometry.
+
+        """
+        if not hasattr(geometry, 'geom_type') and 'coordinates' not in geometry:
+            geometry = {'type': 'Polygon', 'coordinates': geometry}
+        geometry = as_geometry(geometry)
+        location = LocationFilter(geometry)
+
+        columns = columns_for(fields)
+        for column in ('lon', 'lat'):
+            if column not in columns:
+                columns.append(column)
+        batches = self.batches(columns, bbox=geometry.bounds)
+        for batch in batches:
+            lons = batch.column(columns.index('lon')).to_numpy()
+            lats = batch.column(columns.index('lat')).to_numpy()
+            mask = location.points(lons, lats)
+            if not mask.all():
+                batch = batch.filter(pa.array(mask))
+            for doc in to_documents(batch):
+                yield doc
+
+def populate_store(path, store_path, processes=1):
+    """
+    Populates a `TweetStore` from the gzipped archives found in `path`.
+
+    """
+    if path.endswith('/'):
+        path = path[:-1]
+    filenames = sorted(glob.glob(path + '/*.gz'))
+    jobs = [(filename, store_path) for filename in filenames]
+    if processes == 1:
+        for job in jobs:
+            _ingest_worker(job)
+    else:
+        from multiprocessing import Pool
+        pool = Pool(processes)
+        try:
+            for filename in pool.imap_unordered(_ingest_worker, jobs):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+
+def _ingest_worker(args):
+    filename, store_path = args
+    print("Inserting from {0}".format(filename))
+    sys.stdout.flush()
+    TweetStore(store_path).ingest(filename)
+    return filename
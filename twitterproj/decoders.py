@@ -0,0 +1,150 @@
+"""
+JSON decoders for raw tweets.
+
+Decoding dominates the time spent parsing archives. The fastest decoder
+available at import time is used by default, falling back to the standard
+library. All decoders raise `ValueError` on malformed input.
+
+"""
+from __future__ import print_function
+from __future__ import division
+
+from collections import OrderedDict
+from itertools import islice
+import json
+import time
+
+__all__ = [
+    'DECODERS',
+    'get_decoder',
+    'decode',
+    'benchmark',
+]
+
+def _available():
+    decoders = []
+    try:
+        import orjson
+    except ImportError:
+        pass
+    else:
+        decoders.append(('orjson', orjson.loads))
+    try:
+        import simdjson
+    except ImportError:
+        pass
+    else:
+        decoders.append(('simdjson', simdjson.loads))
+    try:
+        import rapidjson
+    except ImportError:
+        pass
+    else:
+        decoders.append(('rapidjson', rapidjson.loads))
+    try:
+        import ujson
+    except ImportError:
+        pass
+    else:
+        decoders.append(('ujson', ujson.loads))
+    try:
+        import simplejson
+    except ImportError:
+        pass
+    else:
+        decoders.append(('simplejson', simplejson.loads))
+    decoders.append(('json', json.loads))
+    return OrderedDict(decoders)
+
+# Available decoders, fastest first.
+DECODERS = _available()
+
+DEFAULT = next(iter(DECODERS))
+
+def get_decoder(name=None):
+    """
+    Returns the `loads` function of a decoder.
+
+    Parameters
+    ----------
+    name : str
+        One of `DECODERS`. If `None`, the fastest available decoder is used.
+
+    """
+    if name is None:
+        name = DEFAULT
+    try:
+        return DECODERS[name]
+    except KeyError:
+        msg = 'Decoder {0!r} is not available. Choose from: {1}'
+        raise ValueError(msg.format(name, ', '.join(DECODERS)))
+
+def decode(line, loads=None):
+    """
+    Decodes a raw tweet, removing any null characters if necessary.
+
+    For some reason, some lines written to file included a bunch of null
+    characters \\x00. They must be removed before a proper JSON decoding.
+
+    The faster decoders are stricter than the standard library: orjson, for
+    one, rejects lone surrogates such as "\\ud83d" that Twitter does emit.
+    Lines they reject are decoded again with `json.loads` before giving up.
+    Note that orjson also turns integers wider than 64 bits into floats;
+    tweet and user ids fit, but pass `loads=json.loads` if that matters.
+
+    Raises
+    ------
+    ValueError
+        If the line cannot be decoded, even without null characters.
+
+    """
+    if loads is None:
+        loads = DECODERS[DEFAULT]
+    try:
+        return loads(line)
+    except ValueError:
+        line = line.replace(b'\x00', b'')
+    try:
+        return loads(line)
+    except ValueError:
+        if loads is json.loads:
+            raise
+    if isinstance(line, bytes):
+        line = line.decode('utf-8')
+    return json.loads(line)
+
+def benchmark(filename, count=10**5, names=None):
+    """
+    Times each decoder on the first `count` lines of a tweet archive.
+
+    The lines are read into memory first, so only decoding is timed.
+
+    Returns
+    -------
+    results : OrderedDict
+        Maps decoder names to lines decoded per second.
+
+    """
+    from .helpers import open_archive
+
+    with open_archive(filename) as f:
+        lines = [line.strip() for line in islice(f, count)]
+    lines = [line for line in lines if line]
+
+    if names is None:
+        names = list(DECODERS)
+
+    results = OrderedDict()
+    for name in names:
+        loads = get_decoder(name)
+        start = time.time()
+        for line in lines:
+            decode(line, loads)
+        results[name] = len(lines) / (time.time() - start)
+
+    baseline = results.get('json')
+    print("{0:<12} {1:>12} {2:>8}".format('decoder', 'lines/s', 'speedup'))
+    for name, rate in results.items():
+        speedup = rate / baseline if baseline else float('nan')
+        print("{0:<12} {1:>12.0f} {2:>7.2f}x".format(name, rate, speedup))
+    return results
@@ -0,0 +1,281 @@
+"""
+De-duplication of tweets during ingestion.
+
+Redundant collectors and overlapping archives can deliver the same tweet
+more than once. A Bloom filter over tweet ids answers "definitely new" for
+almost every tweet using a fixed amount of memory. Only the few tweets it
+reports as possibly seen are confirmed exactly, in one query per chunk,
+against the recently inserted ids and the `tweets` collection.
+
+A new filter is seeded with the ids already in the collection. Worker
+processes share one filter, whose bits are in shared memory, so that each
+sees the ids added by the others. See `SharedBloomFilter`.
+
+"""
+from __future__ import division
+
+from collections import deque
+import math
+import multiprocessing
+import os
+
+import numpy as np
+
+__all__ = [
+    'BloomFilter',
+    'SharedBloomFilter',
+    'Deduplicator',
+    'ensure_id_index',
+]
+
+# The smallest capacity of a new filter.
+MIN_CAPACITY = 10**7
+
+_GOLDEN = np.uint64(0x9e3779b97f4a7c15)
+_M1 = np.uint64(0xbf58476d1ce4e5b9)
+_M2 = np.uint64(0x94d049bb133111eb)
+
+def _mix(x):
+    # splitmix64 finalizer. Arithmetic wraps modulo 2**64.
+    x = (x ^ (x >> np.uint64(30))) * _M1
+    x = (x ^ (x >> np.uint64(27))) * _M2
+    return x ^ (x >> np.uint64(31))
+
+class BloomFilter(object):
+    """
+    A Bloom filter over 64-bit integer keys, such as tweet ids.
+
+    """
+    def __init__(self, capacity=10**8, error_rate=0.01):
+        """
+        Parameters
+        ----------
+        capacity : int
+            The number of keys the filter is sized for.
+        error_rate : float
+            The false positive rate once `capacity` keys are added.
+
+        """
+        nbits = int(math.ceil(-capacity * math.log(error_rate) /
+                              math.log(2)**2))
+        self.nbits = np.uint64(nbits)
+        self.nhashes = max(1, int(round(nbits / capacity * math.log(2))))
+        self.bits = np.zeros((nbits + 7) // 8, dtype=np.uint8)
+
+    def _positions(self, keys):
+        keys = np.asarray(keys, dtype=np.uint64)
+        h1 = _mix(keys)
+        h2 = _mix(keys + _GOLDEN) | np.uint64(1)
+        i = np.arange(self.nhashes, dtype=np.uint64)
+        # Double hashing: the i-th position is h1 + i * h2.
+        return (h1[:, None] + i[None, :] * h2[:, None]) % self.nbits
+
+    def add(self, keys):
+        """
+        Adds an array of keys.
+
+        """
+        positions = self._positions(keys).ravel()
+        bits = (positions & np.uint64(7)).astype(np.uint8)
+        np.bitwise_or.at(self.bits, positions >> np.uint64(3),
+                         np.left_shift(np.uint8(1), bits))
+
+    def contains(self, keys):
+        """
+        Returns a boolean mask of the keys that may have been added.
+
+        False means the key was definitely never added.
+
+        """
+        positions = self._positions(keys)
+        bits = (positions & np.uint64(7)).astype(np.uint8)
+        found = (self.bits[positions >> np.uint64(3)] >> bits) & 1
+        return found.all(axis=1)
+
+    def save(self, filename):
+        np.savez(filename, bits=self.bits, nbits=self.nbits,
+                 nhashes=self.nhashes)
+
+    @classmethod
+    def load(cls, filename):
+        data = np.load(filename)
+        bloom = cls.__new__(cls)
+        bloom.bits = data['bits']
+        bloom.nbits = np.uint64(data['nbits'])
+        bloom.nhashes = int(data['nhashes'])
+        return bloom
+
+class SharedBloomFilter(BloomFilter):
+    """
+    A Bloom filter whose bits are in shared memory.
+
+    Build it in the parent process and pass `state()` to each worker, for
+    example in the `initargs` of a `multiprocessing.Pool`, which rebuilds it
+    with `from_state`. Adds are serialized with a lock, so no bit is lost.
+
+    """
+    def __init__(self, bloom):
+        """
+        Parameters
+        ----------
+        bloom : BloomFilter
+            The filter whose bits are copied into shared memory.
+
+        """
+        self.nbits = bloom.nbits
+        self.nhashes = bloom.nhashes
+        self._raw = multiprocessing.RawArray('B', len(bloom.bits))
+        self._lock = multiprocessing.Lock()
+        self.bits = np.frombuffer(self._raw, dtype=np.uint8)
+        self.bits[:] = bloom.bits
+
+    def state(self):
+        return self._raw, int(self.nbits), self.nhashes, self._lock
+
+    @classmethod
+    def from_state(cls, state):
+        bloom = cls.__new__(cls)
+        bloom._raw, nbits, bloom.nhashes, bloom._lock = state
+        bloom.nbits = np.uint64(nbits)
+        bloom.bits = np.frombuffer(bloom._raw, dtype=np.uint8)
+        return bloom
+
+    def add(self, keys):
+        with self._lock:
+            BloomFilter.add(self, keys)
+
+def _count(collection):
+    # estimated_document_count is new in pymongo 3.7, which deprecates count.
+    import pymongo
+    if pymongo.version_tuple >= (3, 7):
+        return collection.estimated_document_count()
+    return collection.count()
+
+class Deduplicator(object):
+    """
+    Drops tweets whose id has already been inserted.
+
+    Possible duplicates from the Bloom filter are confirmed against the ids
+    of the last `recent` chunks, which may not be written yet, and then
+    against the collection. Confirmation against the collection is fast
+    only with an index on 'id_str'. See `ensure_id_index`.
+
+    """
+    def __init__(self, collection, bloom=None, recent=8, expected=None):
+        """
+        Parameters
+        ----------
+        collection : MongoDB collection
+            The collection that tweets are inserted into.
+        bloom : BloomFilter or str
+            The filter, or the name of a file saved with `save`. If the file
+            does not exist, a new filter is created and `save` writes to it.
+        recent : int
+            The number of chunks whose ids are kept exactly. This should
+            exceed the number of chunks that may be waiting to be written.
+        expected : int
+            The number of tweets expected to be inserted. A new filter is
+            sized for these and the tweets already in the collection, and
+            for at least `MIN_CAPACITY`. If `None`, as many tweets as are
+            already in the collection are expected.
+
+        Notes
+        -----
+        A new filter is seeded with the ids of the tweets already in the
+        collection. See `seed`.
+
+        """
+        self.collection = collection
+        self.filename = None
+        if not isinstance(bloom, BloomFilter):
+            self.filename = bloom
+            if bloom is not None and os.path.isfile(bloom):
+                bloom = BloomFilter.load(bloom)
+            else:
+                bloom = None
+        self.recent = deque(maxlen=recent)
+        if bloom is None:
+            existing = _count(collection)
+            if expected is None:
+                expected = existing
+            self.bloom = BloomFilter(max(existing + expected, MIN_CAPACITY))
+            if existing:
+                self.seed()
+        else:
+            self.bloom = bloom
+
+    def seed(self, batch_size=10**6):
+        """
+        Adds the ids of all tweets already in the collection to the filter.
+
+        """
+        ids = []
+        for tweet in self.collection.find({}, {'id_str': True, '_id': False}):
+            ids.append(int(tweet['id_str']))
+            if len(ids) == batch_size:
+                self.bloom.add(ids)
+                ids = []
+        if ids:
+            self.bloom.add(ids)
+
+    def _seen(self, ids):
+        # Exact check of the possible duplicates.
+        seen = set([])
+        for chunk in self.recent:
+            seen.update(chunk.intersection(ids))
+        remaining = [i for i in ids if i not in seen]
+        if remaining:
+            query = {'id_str': {'$in': remaining}}
+            for tweet in self.collection.find(query, {'id_str': True}):
+                seen.add(tweet['id_str'])
+        return seen
+
+    def filter(self, tweets):
+        """
+        Returns the tweets whose ids have not been seen, and the number of
+        duplicates that were dropped.
+
+        Tweets repeated within `tweets` are also dropped.
+
+        """
+        unique = []
+        ids = set([])
+        for tweet in tweets:
+            if tweet['id_str'] not in ids:
+                ids.add(tweet['id_str'])
+                unique.append(tweet)
+
+        if unique:
+            keys = np.array([int(t['id_str']) for t in unique], dtype=np.uint64)
+            maybe = self.bloom.contains(keys)
+            if maybe.any():
+                candidates = [unique[i]['id_str'] for i in np.flatnonzero(maybe)]
+                seen = self._seen(candidates)
+                if seen:
+                    unique = [t for t in unique if t['id_str'] not in seen]
+                    keys = np.array([int(t['id_str']) for t in unique],
+                                    dtype=np.uint64)
+            self.bloom.add(keys)
+            self.recent.append(set(t['id_str'] for t in unique))
+
+        return unique, len(tweets) - len(unique)
+
+    def save(self, filename=None):
+        """
+        Saves the filter, so a later ingestion can start from it.
+
+        """
+        if filename is None:
+            filename = self.filename
+        # np.savez appends .npz unless present.
+        tmpname = filename + '.tmp.npz'
+        self.bloom.save(tmpname)
+        os.rename(tmpname, filename)
+
+def ensure_id_index(collection):
+    """
+    Creates an index on 'id_str', if needed, for confirming duplicates.
+
+    """
+    # create_index is in every pymongo; ensure_index is gone from pymongo 4.
+    collection.create_index('id_str')
@@ -3,8 +3,13 @@ Geospatial queries.
 
 """
 from collections import defaultdict
+
+import pymongo
 from shapely.geometry import mapping
 
+from .columnar import TweetStore
+from .regionfields import REGION_FIELDS, _aggregate
+
 __all__ = [
     'tweets_in_region',
     'hashtag_counts_in',
@@ -19,7 +24,7 @@ seattle = [
      [-122.4596959,47.4810022]],
 ]
 
-def tweets_in_region(collection, geometry):
+def tweets_in_region(collection, geometry, fields=None, skip_users=None):
     """Iterator over tweets in a region.
 
     Parameters
@@ -32,6 +37,12 @@ def tweets_in_region(collection, geometry):
         should be a list of LinearRing coordinate arrays. A LinearRing
         coordinate array is a list of (longitude, latitude) pairs that is
         closed---the first and last point must be the same.
+    fields : list or dict
+        The fields to return, as with `collection.find`. If `None`, whole
+        tweets are returned.
+    skip_users : list of int
+        A list of Twitter user ids. Tweets from these user ids are excluded
+        by the query itself.
 
     Examples
     --------
@@ -43,7 +54,7 @@ def tweets_in_region(collection, geometry):
     ...      [-122.4596959,47.4810022]],
     ... ]
     ...
-    >>> counts, skipped = tweets_in_region(collection, seattle)
+    >>> tweets = tweets_in_region(collection, seattle, fields=['hashtags'])
 
     Notes
     -----
@@ -53,7 +64,47 @@ def tweets_in_region(collection, geometry):
 
     .. [polygon] http://geojson.org/geojson-spec.html#polygon
 
+    `collection` may also be a `columnar.TweetStore`.
+
+    If the tweets are stamped with their regions, `geometry` may instead
+    name a region, such as {'geoid': '53033'}, which is found with an
+    indexed equality query. See `regionfields`.
+
     """
+    if _is_store(collection) and _region_field(geometry) is None:
+        # Columnar stores filter by region themselves.
+        if skip_users and fields is not None:
+            # The user ids are needed to skip users here.
+            fields = _field_names(fields) + ['user.id']
+        tweets = collection.tweets_in_region(geometry, fields)
+        if skip_users:
+            tweets = _without_users(tweets, skip_users)
+        return tweets
+
+    spec = _region_spec(geometry)
+    if skip_users:
+        spec['user.id'] = {'$nin': list(skip_users)}
+    return collection.find(spec, fields)
+
+def _is_store(collection):
+    # Not hasattr: a pymongo collection returns a sub-collection for any
+    # attribute, such as `tweets_in_region`.
+    return isinstance(collection, TweetStore)
+
+def _region_field(geometry):
+    if isinstance(geometry, dict) and len(geometry) == 1 and \
+       next(iter(geometry)) in REGION_FIELDS:
+        return next(iter(geometry))
+    return None
+
+def _region_spec(geometry):
+    """
+    Returns the query for tweets within a geometry or stamped region.
+
+    """
+    if _region_field(geometry) is not None:
+        return dict(geometry)
+
     try:
         # Shapley Polygon or MultiPolygon to geoJSON-like object
         geometry = mapping(geometry)
@@ -64,16 +115,88 @@ def tweets_in_region(collection, geometry):
         # Use the list to define a polygon.
         geometry = {'type': 'Polygon', 'coordinates': geometry}
 
-    c = collection.find({
+    return {
         'coordinates': {
             '$geoWithin': {
                 '$geometry' : geometry
             }
         }
-    })
-    return c
+    }
+
+def _field_names(fields):
+    if isinstance(fields, dict):
+        return [field for field, keep in fields.items() if keep]
+    return list(fields)
+
+def _without_users(tweets, skip_users):
+    skip_users = set(skip_users)
+    for tweet in tweets:
+        if tweet['user']['id'] not in skip_users:
+            yield tweet
+
+def _count(collection, spec):
+    # count_documents is new in pymongo 3.7, which deprecates Cursor.count.
+    if pymongo.version_tuple >= (3, 7):
+        return collection.count_documents(spec)
+    return collection.find(spec).count()
+
+def _counts_in(collection, geometry, skip_users, key, field, spec,
+               aggregate):
+    """
+    Returns the counts of `key` values over tweets in a geometry, and the
+    number of tweets skipped due to `skip_users`.
+
+    `field` is the field holding the key values, and `spec` restricts the
+    tweets further.
 
-def hashtag_counts_in(collection, geometry, skip_users=None):
+    """
+    skip_users = list(skip_users or [])
+    counts = defaultdict(int)
+
+    if _is_store(collection) and _region_field(geometry) is None:
+        # Columnar stores cannot count users without reading them.
+        skip = set(skip_users)
+        skipped = 0
+        fields = [field, 'user.id']
+        for tweet in collection.tweets_in_region(geometry, fields):
+            if tweet['user']['id'] in skip:
+                skipped += 1
+            else:
+                for value in key(tweet):
+                    counts[value] += 1
+        return counts, skipped
+
+    region = _region_spec(geometry)
+    skipped = 0
+    if skip_users:
+        skipped_spec = dict(region)
+        skipped_spec['user.id'] = {'$in': skip_users}
+        skipped = _count(collection, skipped_spec)
+
+    match = dict(region)
+    match.update(spec)
+    if skip_users:
+        match['user.id'] = {'$nin': skip_users}
+
+    if aggregate:
+        pipeline = [
+            {'$match': match},
+            {'$project': {'_id': False, field: True}},
+        ]
+        if field == 'hashtags':
+            pipeline.append({'$unwind': '$hashtags'})
+        pipeline.append({'$group': {'_id': '$' + field,
+                                    'count': {'$sum': 1}}})
+        for doc in _aggregate(collection, pipeline):
+            counts[doc['_id']] = doc['count']
+    else:
+        for tweet in collection.find(match, {'_id': False, field: True}):
+            for value in key(tweet):
+                counts[value] += 1
+
+    return counts, skipped
+
+def hashtag_counts_in(collection, geometry, skip_users=None, aggregate=False):
     """
     Returns hashtag counts for all tweets in a geometry.
 
@@ -89,7 +212,12 @@ def hashtag_counts_in(collection, geometry, skip_users=None):
         closed---the first and last point must be the same.
     skip_users : list of int
         A list of Twitter user ids. Any tweet from these user ids will be
-        skipped and not included in the counts.
+        skipped and not included in the counts. They are excluded by the
+        query, and the skipped tweets are counted by the server.
+    aggregate : bool
+        If `True`, the counts are computed by the server with an
+        aggregation. Otherwise only the needed field of each tweet is
+        fetched and counted here.
 
     Returns
     -------
@@ -119,23 +247,14 @@ def hashtag_counts_in(collection, geometry, skip_users=None):
     .. [polygon] http://geojson.org/geojson-spec.html#polygon
 
     """
-    if skip_users is None:
-        skip_users = set([])
-    else:
-        skip_users = set(skip_users)
-
-    counts = defaultdict(int)
-    skipped = 0
-    for tweet in tweets_in_region(collection, geometry):
-        if tweet['user']['id'] in skip_users:
-            skipped += 1
-        else:
-            for hashtag in tweet['hashtags']:
-                counts[hashtag] += 1
-
-    return counts, skipped
-
-def user_counts_in(collection, geometry, skip_users=None):
+    def hashtags(tweet):
+        return tweet['hashtags']
+    # Only tweets with hashtags can add to the counts.
+    spec = {'hashtags.0': {'$exists': True}}
+    return _counts_in(collection, geometry, skip_users, hashtags,
+                      'hashtags', spec, aggregate)
+
+def user_counts_in(collection, geometry, skip_users=None, aggregate=False):
     """
     Returns user tweet counts for all tweets in a geometry.
 
@@ -151,7 +270,12 @@ def user_counts_in(collection, geometry, skip_users=None):
         closed---the first and last point must be the same.
     skip_users : list of int
         A list of Twitter user ids. Any tweet from these user ids will be
-        skipped and not included in the counts.
+        skipped and not included in the counts. They are excluded by the
+        query, and the skipped tweets are counted by the server.
+    aggregate : bool
+        If `True`, the counts are computed by the server with an
+        aggregation. Otherwise only the needed field of each tweet is
+        fetched and counted here.
 
     Returns
     -------
@@ -181,21 +305,7 @@ def user_counts_in(collection, geometry, skip_users=None):
     .. [polygon] http://geojson.org/geojson-spec.html#polygon
 
     """
-    if skip_users is None:
-        skip_users = set([])
-    else:
-        skip_users = set(skip_users)
-
-    counts = defaultdict(int)
-    skipped = 0
-    for tweet in tweets_in_region(collection, geometry):
-        if tweet['user']['id'] in skip_users:
-            skipped += 1
-        else:
-            user_id = tweet['user']['id']
-            counts[user_id] += 1
-
-    return counts, skipped
-
-
-
+    def user_id(tweet):
+        return [tweet['user']['id']]
+    return _counts_in(collection, geometry, skip_users, user_id,
+                      'user.id', {}, aggregate)
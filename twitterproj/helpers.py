@@ -9,19 +9,30 @@ Note: geoJSON formatted coordinates are: (longitude, latitude)
 """
 from __future__ import unicode_literals
 from __future__ import print_function
+from __future__ import division
 
 import glob
+import gzip
 import io
-import json
 import os
-import shutil
-import subprocess
 import sys
+import threading
+import time
 
-from collections import OrderedDict
+from collections import Counter, OrderedDict
 from datetime import datetime
 
-from shapely.geometry import box, asShape
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+from shapely.geometry import Point, box, asShape
+from shapely.prepared import prep
+
+from .decoders import decode, get_decoder
+from .tweetindex import create_index
 
 # Bounding boxes are two geoJSON points specifying the
 # (A) lower left and (B) upper right corners of a box.
@@ -33,39 +44,16 @@ from shapely.geometry import box, asShape
 ANY = box(-180, -90, 180, 90)
 USA = box(-124.7625, 24.5210, -66.9326, 49.3845) # contiguous
 
-def create_index(filename, force=False):
-    """
-    Create an index from a text file of tweets.
-
-    Assumption: Each line corresponds to a tweet.
-
-    The index can be used to randomly access each tweet. It will contain seek
-    locations to each tweet. For example, the 3rd line of the index file will
-    contain the seek location of the 3rd tweet in the original file.
-
-    Parameters
-    ----------
-    filename : str
-        The name of the tweet file.
-    force : bool
-        If true, then create the index file even if an index file
-        already exists.
+# Read buffer size, in bytes, for tweet archives.
+BUFFER_SIZE = 2**22
 
-    """
-    if os.path.isfile(filename + '.index') and not force:
-        return
+# Number of tweets whose locations are tested at once.
+BATCH_SIZE = 2**12
 
-    lines = []
-    # Open in binary mode, since we want raw byte locations.
-    with open(filename, 'rb') as fobj:
-        lines.append(0)
-        # Do not use the file object as an iterator.
-        # http://stackoverflow.com/questions/14145082/file-tell-inconsistency
-        # Instead, use readline.
-        for line in iter(fobj.readline, ''):
-            lines.append(fobj.tell())
-    with open(filename + '.index', 'w') as fobj:
-        fobj.write('\n'.join(map(str, lines)))
+# Line categories from classify_line().
+RATELIMIT = 'ratelimit'
+NO_COORDINATES = 'no_coordinates'
+CANDIDATE = 'candidate'
 
 def is_ratelimit(tweet):
     """
@@ -89,6 +77,28 @@ def is_ratelimit(tweet):
         else:
             return False
 
+def classify_line(line):
+    """
+    Cheaply classifies a raw line of JSON, without decoding it.
+
+    Returns one of:
+
+        RATELIMIT : The line is a rate-limit response.
+        NO_COORDINATES : The line is a tweet whose coordinates field is null.
+        CANDIDATE : Anything else. These must be fully decoded.
+
+    The classification is conservative. A line is only rejected when its
+    bytes prove it, so lines formatted in unexpected ways are candidates.
+
+    """
+    if line.startswith(b'{"limit":{"track"'):
+        return RATELIMIT
+    # Populated coordinates are a geoJSON Point object. The same key within a
+    # place bounding box or a deprecated geo field is followed by a list.
+    if b'"coordinates":null' in line and b'"coordinates":{' not in line:
+        return NO_COORDINATES
+    return CANDIDATE
+
 def location_match(tweet, polygon, allow_place=True):
     """
     Returns `True` if the tweet's location is in the bounding box.
@@ -136,60 +146,371 @@ def location_match(tweet, polygon, allow_place=True):
 
     return match
 
-def tweets(filename, with_ratelimits=False, raise_on_error=True):
+def _gzip_backends():
+    """
+    Returns the available gzip decompression backends, fastest first.
+
+    """
+    backends = []
+    try:
+        import rapidgzip
+    except ImportError:
+        pass
+    else:
+        # Decompresses blocks in parallel across all cores.
+        backends.append(('rapidgzip',
+                         lambda f: rapidgzip.open(f, parallelization=0)))
+    try:
+        from isal import igzip
+    except ImportError:
+        pass
+    else:
+        backends.append(('isal', lambda f: igzip.IGzipFile(fileobj=f)))
+    backends.append(('gzip', lambda f: gzip.GzipFile(fileobj=f)))
+    return OrderedDict(backends)
+
+GZIP_BACKENDS = _gzip_backends()
+
+# Suffixes of compressed archives, which are not part of the source name.
+ARCHIVE_SUFFIXES = ('.gz', '.zst')
+
+def source_name(filename):
+    """
+    Returns the name of an archive without its directory or compression
+    suffix, as recorded in the `sources` collection.
+
+    """
+    name = os.path.basename(filename)
+    for suffix in ARCHIVE_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+class _ForwardSeekReader(io.BufferedReader):
+    """
+    A buffered reader over a stream that can only seek forward, by reading.
+
+    """
+    def seek(self, pos, whence=0):
+        if whence != 0 or pos < self.tell():
+            raise io.UnsupportedOperation('Only forward seeks are supported.')
+        remaining = pos - self.tell()
+        while remaining:
+            data = self.read(min(remaining, BUFFER_SIZE))
+            if not data:
+                break
+            remaining -= len(data)
+        return self.tell()
+
+def open_archive(filename, buffer_size=BUFFER_SIZE, backend=None):
+    """
+    Opens a tweet archive for binary reading, decompressing on the fly.
+
+    Files ending in '.gz' are decompressed as they are read, so no
+    uncompressed copy is written to disk. The returned file object supports
+    `readline`, `tell` and `seek`, with positions measured in uncompressed
+    bytes. Files ending in '.zst', as written by data/zipper.py, are
+    decompressed with the `zstandard` package, and can only seek forward.
+    Any other file is opened as is.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the tweet file.
+    buffer_size : int
+        The size of the read buffers, in bytes.
+    backend : str
+        The gzip decompression backend, one of `GZIP_BACKENDS`. If `None`,
+        the fastest available backend is used. 'rapidgzip' decompresses in
+        parallel, 'isal' uses the Intel ISA-L library, and 'gzip' is the
+        standard library.
+
+    """
+    if filename.endswith('.zst'):
+        import zstandard
+        raw = io.open(filename, 'rb', buffering=buffer_size)
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            raw, read_across_frames=True, closefd=True)
+        return _ForwardSeekReader(reader, buffer_size)
+    if not filename.endswith('.gz'):
+        return io.open(filename, 'rb', buffering=buffer_size)
+
+    if backend is None:
+        backend = next(iter(GZIP_BACKENDS))
+    if backend == 'rapidgzip':
+        # Handles its own reads and buffering.
+        return GZIP_BACKENDS[backend](filename)
+
+    raw = io.open(filename, 'rb', buffering=buffer_size)
+    fobj = GZIP_BACKENDS[backend](raw)
+    try:
+        return io.BufferedReader(fobj, buffer_size)
+    except AttributeError:
+        # Python 2 GzipFile is not an io object.
+        return fobj
+
+def points_in_bounds(lons, lats, bounds):
+    """
+    Returns a boolean mask of the points that lie within a rectangle.
+
+    Parameters
+    ----------
+    lons, lats : array-like, shape (n,)
+        The longitudes and latitudes of the points. NaN never matches.
+    bounds : tuple
+        The rectangle as (min lon, min lat, max lon, max lat). Points on
+        the boundary are within the rectangle.
+
+    """
+    lons = np.asarray(lons, dtype=float)
+    lats = np.asarray(lats, dtype=float)
+    return ((lons >= bounds[0]) & (lons <= bounds[2]) &
+            (lats >= bounds[1]) & (lats <= bounds[3]))
+
+def bboxes_intersect_bounds(bboxes, bounds):
+    """
+    Returns a boolean mask of the bounding boxes that intersect a rectangle.
+
+    Parameters
+    ----------
+    bboxes : array-like, shape (n, 4)
+        The boxes, each as (min lon, min lat, max lon, max lat). NaN never
+        matches.
+    bounds : tuple
+        The rectangle as (min lon, min lat, max lon, max lat). Touching
+        boxes intersect.
+
+    """
+    bboxes = np.asarray(bboxes, dtype=float).reshape(-1, 4)
+    return ((bboxes[:, 0] <= bounds[2]) & (bboxes[:, 2] >= bounds[0]) &
+            (bboxes[:, 1] <= bounds[3]) & (bboxes[:, 3] >= bounds[1]))
+
+class LocationFilter(object):
+    """
+    Batch version of `location_match` for a fixed polygon.
+
+    Rectangular polygons, such as `USA`, are tested with NumPy comparisons
+    alone. Other polygons are tested against their bounds first, and only
+    the remaining candidates are tested against the prepared polygon.
+
+    """
+    def __init__(self, polygon):
+        self.polygon = polygon
+        self.bounds = polygon.bounds
+        self.rectangular = polygon.equals(box(*self.bounds))
+        self.prepared = prep(polygon)
+
+    def points(self, lons, lats):
+        """
+        Returns a boolean mask of the points (lon, lat) in the polygon.
+
+        """
+        mask = points_in_bounds(lons, lats, self.bounds)
+        if not self.rectangular:
+            for i in np.flatnonzero(mask):
+                point = Point(lons[i], lats[i])
+                mask[i] = self.prepared.intersects(point)
+        return mask
+
+    def bboxes(self, bboxes):
+        """
+        Returns a boolean mask of the bounding boxes intersecting the polygon.
+
+        """
+        bboxes = np.asarray(bboxes, dtype=float).reshape(-1, 4)
+        mask = bboxes_intersect_bounds(bboxes, self.bounds)
+        if not self.rectangular:
+            for i in np.flatnonzero(mask):
+                mask[i] = self.prepared.intersects(box(*bboxes[i]))
+        return mask
+
+    def tweets(self, tweets, allow_place=True):
+        """
+        Returns a boolean mask of the tweets whose location matches.
+
+        This follows the same rules as `location_match`.
+
+        """
+        n = len(tweets)
+        lons = np.empty(n)
+        lats = np.empty(n)
+        lons.fill(np.nan)
+        lats.fill(np.nan)
+        bboxes = np.empty((n, 4))
+        bboxes.fill(np.nan)
+        for i, tweet in enumerate(tweets):
+            if 'coordinates' in tweet and tweet['coordinates']:
+                # Method 1) The coordinates, a geoJSON Point.
+                lons[i], lats[i] = tweet['coordinates']['coordinates'][:2]
+            elif allow_place and 'place' in tweet and tweet['place']:
+                # Method 2) The place bounding box, a geoJSON Polygon.
+                ring = tweet['place']['bounding_box']['coordinates'][0]
+                x = [point[0] for point in ring]
+                y = [point[1] for point in ring]
+                bboxes[i] = min(x), min(y), max(x), max(y)
+
+        mask = self.points(lons, lats)
+        has_place = ~np.isnan(bboxes[:, 0])
+        if has_place.any():
+            mask[has_place] = self.bboxes(bboxes[has_place])
+        return mask
+
+USA_FILTER = LocationFilter(USA)
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def tweets(filename, with_ratelimits=False, raise_on_error=True, offset=0,
+           with_offsets=False, require_coordinates=False, stats=None,
+           decoder=None):
     """
     Simple parsing of tweets.
 
     If with_ratelimits is `True`, then ratelimit JSON objects are returned
     in addition to tweet JSON objects.
 
+    Gzipped files are decompressed as they are read. See `open_archive`.
+    Byte locations, in error messages and otherwise, are then measured in
+    uncompressed bytes.
+
+    Parsing begins at byte `offset`, which should be the start of a line.
+    If `with_offsets` is `True`, then the byte location just after each tweet
+    is yielded as well. This is a valid `offset` to resume parsing from.
+
+    If `require_coordinates` is `True`, then tweets whose coordinates field
+    is null are not returned. These, and ratelimits when they are not
+    wanted, are rejected from the raw bytes before any JSON decoding.
+    See `classify_line`.
+
+    If `stats` is a `collections.Counter`, it is updated with the number of
+    lines read ('lines'), rejected before decoding ('prefilter_ratelimit',
+    'prefilter_no_coordinates'), decoded ('decoded'), undecodable
+    ('invalid'), and rejected as ratelimits after decoding ('ratelimit').
+
+    The JSON decoder is chosen by `decoder`. See `decoders.get_decoder`.
+
     """
-    with open(filename, 'r') as fobj:
-        location = 0
+    if stats is None:
+        stats = Counter()
+    loads = get_decoder(decoder)
+
+    with open_archive(filename) as fobj:
+        if offset:
+            fobj.seek(offset)
+        location = offset
         for i, line in enumerate(iter(fobj.readline, b'')):
             line = line.strip()
             valid = False
             if not line:
                 continue
+            stats['lines'] += 1
+            if require_coordinates:
+                category = classify_line(line)
+                if category == RATELIMIT and not with_ratelimits:
+                    stats['prefilter_ratelimit'] += 1
+                    location = fobj.tell()
+                    continue
+                elif category == NO_COORDINATES:
+                    stats['prefilter_no_coordinates'] += 1
+                    location = fobj.tell()
+                    continue
+            stats['decoded'] += 1
             try:
-                tweet = json.loads(line)
+                # Null characters are removed if necessary.
+                tweet = decode(line, loads)
             except ValueError:
-                # For some reason, some lines written to file included
-                # bunch of null characters \x00. We need to remove them
-                # before we get a proper JSON decoding.
-                try:
-                    line2 = line.replace('\x00', '')
-                    tweet = json.loads(line2)
-                except ValueError:
-                    msg = "JSON error decoding line {0} of {1} at {2} bytes:\n{3!r}"
-                    msg = msg.format(i, filename, location, line)
-                    if raise_on_error:
-                        raise ValueError(msg)
-                    else:
-                        print(msg)
+                msg = "JSON error decoding line {0} of {1} at {2} bytes:\n{3!r}"
+                msg = msg.format(i, filename, location, line)
+                if raise_on_error:
+                    raise ValueError(msg)
                 else:
-                    valid = True
-                    location = fobj.tell()
+                    print(msg)
             else:
                 valid = True
                 location = fobj.tell()
 
-            if with_ratelimits:
-                yield tweet, valid
-            elif not is_ratelimit(tweet):
-                yield tweet, valid
+            if not valid:
+                # Skip past the undecodable line when resuming.
+                stats['invalid'] += 1
+                location = fobj.tell()
+                continue
+
+            if with_ratelimits or not is_ratelimit(tweet):
+                if with_offsets:
+                    yield tweet, valid, location
+                else:
+                    yield tweet, valid
+            else:
+                stats['ratelimit'] += 1
 
-def us_geocoded_tweets(filename, require_hashtags=False, raise_on_error=True):
+def us_geocoded_tweets(filename, require_hashtags=False, raise_on_error=True,
+                       offset=0, with_offsets=False, prefilter=False,
+                       stats=None, batch_size=BATCH_SIZE):
     """
     Iterator over US geocoded tweets.
 
+    See `tweets` for a description of `offset` and `with_offsets`.
+
+    If `prefilter` is `True`, then ratelimits and tweets without coordinates
+    are rejected from their raw bytes, before JSON decoding.
+
+    If `stats` is a `collections.Counter`, it is updated with the counts
+    described in `tweets`, and also the number of decoded tweets rejected
+    for their location ('location') or for lacking hashtags ('hashtags'),
+    and the number of tweets returned ('matched').
+
+    Locations are tested `batch_size` tweets at a time with `USA_FILTER`.
+
     """
+    if stats is None:
+        stats = Counter()
+
     all_tweets = not require_hashtags
-    for tweet, valid in tweets(filename, with_ratelimits=False,
-                               raise_on_error=raise_on_error):
-        if location_match(tweet, USA, allow_place=False):
-            if all_tweets or has_hashtags(tweet):
-                yield tweet, valid
+    items = tweets(filename, with_ratelimits=False,
+                   raise_on_error=raise_on_error,
+                   offset=offset, with_offsets=True,
+                   require_coordinates=prefilter, stats=stats)
+    for batch in _batches(items, batch_size):
+        mask = USA_FILTER.tweets([item[0] for item in batch],
+                                 allow_place=False)
+        for item, match in zip(batch, mask):
+            if not match:
+                stats['location'] += 1
+            elif not (all_tweets or has_hashtags(item[0])):
+                stats['hashtags'] += 1
+            else:
+                stats['matched'] += 1
+                if with_offsets:
+                    yield item
+                else:
+                    yield item[:2]
+
+def print_stats(stats):
+    """
+    Prints the line counts collected by `tweets` and `us_geocoded_tweets`.
+
+    """
+    stages = [
+        ('lines', 'Lines'),
+        ('prefilter_ratelimit', 'Rejected as ratelimits before decoding'),
+        ('prefilter_no_coordinates', 'Rejected as ungeocoded before decoding'),
+        ('decoded', 'Decoded'),
+        ('invalid', 'Undecodable'),
+        ('ratelimit', 'Rejected as ratelimits after decoding'),
+        ('location', 'Rejected by location after decoding'),
+        ('hashtags', 'Rejected for lacking hashtags'),
+        ('matched', 'Matched'),
+    ]
+    for key, label in stages:
+        if key in stats:
+            print("\t{0}: {1}".format(label, stats[key]))
 
 def has_hashtags(tweet):
     if 'entities' in tweet and 'hashtags' in tweet['entities']:
@@ -252,15 +573,57 @@ class Tweet(OrderedDict):
     def has_hashtags(self):
         return len(self['hashtags']) > 0
 
+TIME_FORMAT = '%a %b %d %H:%M:%S +0000 %Y'
+
+MONTHS = {
+    'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+    'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12,
+}
+
+def parse_time(timestamp):
+    """
+    Parses a Twitter timestamp, such as 'Wed Aug 27 13:08:45 +0000 2008'.
+
+    Twitter always uses this fixed-width format in UTC, so the fields are
+    sliced out directly. Anything else is left to `datetime.strptime`.
+
+    """
+    if len(timestamp) == 30 and timestamp[20:25] == '+0000':
+        try:
+            return datetime(int(timestamp[26:30]),
+                            MONTHS[timestamp[4:7]],
+                            int(timestamp[8:10]),
+                            int(timestamp[11:13]),
+                            int(timestamp[14:16]),
+                            int(timestamp[17:19]))
+        except (KeyError, ValueError):
+            pass
+    return datetime.strptime(timestamp, TIME_FORMAT)
+
+# Profile creation times repeat for every tweet from a user.
+PROFILE_TIMES = {}
+PROFILE_TIMES_SIZE = 10**6
+
+def parse_profile_time(timestamp):
+    """
+    Parses a Twitter timestamp, caching the result.
+
+    """
+    try:
+        return PROFILE_TIMES[timestamp]
+    except KeyError:
+        if len(PROFILE_TIMES) >= PROFILE_TIMES_SIZE:
+            PROFILE_TIMES.clear()
+        dt = PROFILE_TIMES[timestamp] = parse_time(timestamp)
+        return dt
+
 def extract(tweet):
     """
     Builds an ordered dictionary of tweet data to be retained/stored.
 
     """
-    template = '%a %b %d %H:%M:%S +0000 %Y'
-
-    tweet_dt = datetime.strptime(tweet['created_at'], template)
-    profile_dt = datetime.strptime(tweet['user']['created_at'], template)
+    tweet_dt = datetime.strptime(tweet['created_at'], TIME_FORMAT)
+    profile_dt = datetime.strptime(tweet['user']['created_at'], TIME_FORMAT)
 
     user = [
         ('id_str', tweet['user']['id_str']),
@@ -284,36 +647,127 @@ def extract(tweet):
     data = Tweet(data)
     return data
 
-def counts(filename):
+# Plain dicts keep insertion order from Python 3.7 on.
+_ordered_dict = dict if sys.version_info >= (3, 7) else OrderedDict
+
+def extract_fields(tweet):
     """
-    Return counts and categories for tweets from a raw text file.
+    Returns the tweet data to be stored, as a plain dictionary.
+
+    The keys, their order and their values are the same as from `extract`,
+    so the stored documents are identical. This is the faster path used
+    during ingestion. Use `extract` for a printable `Tweet`.
+
+    """
+    user = tweet['user']
+    hashtags = [h['text'].lower() for h in tweet['entities']['hashtags']] \
+        if 'entities' in tweet and 'hashtags' in tweet['entities'] else []
+    return _ordered_dict((
+        ('created_at', parse_time(tweet['created_at'])),
+        ('id_str', tweet['id_str']),
+        ('coordinates', tweet['coordinates']['coordinates']),
+        ('hashtags', hashtags),
+        ('text', tweet['text']),
+        ('lang', tweet['lang']),
+        ('user', _ordered_dict((
+            ('id_str', user['id_str']),
+            ('favourites_count', user['favourites_count']),
+            ('followers_count', user['followers_count']),
+            ('friends_count', user['friends_count']),
+            ('statuses_count', user['statuses_count']),
+            ('created_at', parse_profile_time(user['created_at'])),
+        ))),
+    ))
+
+def benchmark_extract(filename, count=10**5):
+    """
+    Times `extract` against `extract_fields` on US geocoded tweets.
+
+    The tweets are decoded into memory first, so only extraction is timed.
+
+    Returns
+    -------
+    results : OrderedDict
+        Maps function names to seconds per million tweets.
+
+    """
+    from itertools import islice
+    tweets = [tweet for tweet, valid
+              in islice(us_geocoded_tweets(filename), count)]
+
+    results = OrderedDict()
+    for func in [extract, extract_fields]:
+        PROFILE_TIMES.clear()
+        start = time.time()
+        for tweet in tweets:
+            func(tweet)
+        results[func.__name__] = (time.time() - start) * 1e6 / len(tweets)
+
+    print("{0:<16} {1:>14}".format('function', 's/million'))
+    for name, seconds in results.items():
+        print("{0:<16} {1:>14.1f}".format(name, seconds))
+    print("Speedup: {0:.2f}x".format(results['extract'] /
+                                     results['extract_fields']))
+    return results
+
+COUNT_CATEGORIES = [
+    ('total', 'Total'),
+    ('ratelimits', 'Rate limits'),
+    ('geocoded', 'Geocoded'),
+    ('usa', 'USA'),
+    ('usa_geo', 'USA w/geo'),
+]
+
+def count_categories(filename, raise_on_error=True):
+    """
+    Returns counts of the tweets from a raw text file, by category.
+
+    The categories are those of `COUNT_CATEGORIES`. If `raise_on_error` is
+    `False`, undecodable lines are skipped and counted as 'invalid'.
 
     """
+    stats = Counter()
     total = 0
     ratelimits = 0
     geocoded = 0
     usa_geo= 0
     usa_nogeo = 0
-    for tweet, valid in tweets(filename, with_ratelimits=True):
-        total += 1
-        if is_ratelimit(tweet):
-            ratelimits += 1
-            continue
-
-        match = location_match(tweet, USA)
-        if 'coordinates' in tweet and tweet['coordinates']:
-            geocoded += 1
-            if match:
-                usa_geo += 1
-        elif match:
-            usa_nogeo += 1
-
-    print("""Total: {0}
-Rate limits: {1}
-Geocoded: {2}
-USA: {3}
-USA w/geo: {4}
-""".format(total, ratelimits, geocoded, usa_geo + usa_nogeo, usa_geo))
+    items = tweets(filename, with_ratelimits=True,
+                   raise_on_error=raise_on_error, stats=stats)
+    for batch in _batches(items, BATCH_SIZE):
+        total += len(batch)
+        batch = [tweet for tweet, valid in batch]
+        candidates = [tweet for tweet in batch if not is_ratelimit(tweet)]
+        ratelimits += len(batch) - len(candidates)
+
+        mask = USA_FILTER.tweets(candidates)
+        for tweet, match in zip(candidates, mask):
+            if 'coordinates' in tweet and tweet['coordinates']:
+                geocoded += 1
+                if match:
+                    usa_geo += 1
+            elif match:
+                usa_nogeo += 1
+
+    counts = OrderedDict()
+    counts['total'] = total
+    counts['ratelimits'] = ratelimits
+    counts['geocoded'] = geocoded
+    counts['usa'] = usa_geo + usa_nogeo
+    counts['usa_geo'] = usa_geo
+    counts['invalid'] = stats['invalid']
+    return counts
+
+def counts(filename):
+    """
+    Return counts and categories for tweets from a raw text file.
+
+    """
+    categories = count_categories(filename)
+    for key, label in COUNT_CATEGORIES:
+        print("{0}: {1}".format(label, categories[key]))
+    print()
+    return categories
 
 def test_run(filename, count=10):
     """
@@ -339,7 +793,7 @@ def connect(dbname='twitter'):
     """
     from pymongo import MongoClient
     client = MongoClient()
-    db = client.__getattr__(self, dbname)
+    db = client[dbname]
 
     return db
 
@@ -349,81 +803,470 @@ def take(n, iterable):
     """
     return list(islice(iterable, n))
 
-def insert_chunked(filename, db, chunksize=10**5, force_hashtags=False, log=True, dry_run=False):
+def bulk_insert(collection, docs, write_concern=None):
+    """
+    Inserts documents with a single unordered bulk write.
+
+    Parameters
+    ----------
+    collection : MongoDB collection
+        The collection to insert into.
+    docs : list
+        The documents to insert.
+    write_concern : dict
+        The write concern, such as {'w': 1} or {'w': 0}. If `None`, the
+        collection's write concern is used.
+
+    """
+    import pymongo
+    # Not hasattr: a collection returns a sub-collection for any attribute.
+    if pymongo.version_tuple >= (3,):
+        if write_concern is not None:
+            from pymongo.write_concern import WriteConcern
+            wc = WriteConcern(**write_concern)
+            collection = collection.with_options(write_concern=wc)
+        collection.insert_many(docs, ordered=False)
+    else:
+        bulk = collection.initialize_unordered_bulk_op()
+        for doc in docs:
+            bulk.insert(doc)
+        bulk.execute(write_concern)
+
+class BulkWriter(object):
+    """
+    Writes batches of documents from a background thread.
+
+    Parsing continues while earlier batches are written. At most
+    `max_pending` batches wait to be written; `put` blocks beyond that, so
+    a slow database applies backpressure to the parser instead of letting
+    memory grow.
+
+    Examples
+    --------
+    >>> writer = BulkWriter(db.tweets, write_concern={'w': 1})
+    >>> for batch in batches:
+    ...     writer.put(batch)
+    ...
+    >>> writer.close()
+
+    """
+    def __init__(self, collection, max_pending=4, write_concern=None,
+                 log=True):
+        self.collection = collection
+        self.write_concern = write_concern
+        self.log = log
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.docs = 0
+        self.latencies = []
+        self.start = time.time()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, docs, callback=None):
+        """
+        Queues a batch of documents to be written.
+
+        If given, `callback` is called with no arguments once the batch is
+        written, from the writer thread.
+
+        """
+        if self.error is not None:
+            raise self.error
+        self.queue.put((docs, callback))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                # Keep draining so that put() never blocks forever.
+                continue
+            docs, callback = item
+            # Everything is guarded: an exception escaping here would end
+            # the thread, and put() would then block forever.
+            try:
+                if docs:
+                    self._write(docs)
+                if callback is not None:
+                    callback()
+            except Exception as e:
+                self.error = e
+
+    def _write(self, docs):
+        start = time.time()
+        bulk_insert(self.collection, docs, self.write_concern)
+        latency = time.time() - start
+        self.latencies.append(latency)
+        self.docs += len(docs)
+        if self.log:
+            msg = "\tWrote {0} docs in {1:.2f}s ({2:.0f} docs/s)"
+            print(msg.format(len(docs), latency, _rate(len(docs), latency)))
+            sys.stdout.flush()
+
+    def close(self):
+        """
+        Waits for all queued batches to be written.
+
+        """
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        if self.log:
+            self.report()
+
+    def report(self):
+        """
+        Prints the batch latencies and throughput.
+
+        """
+        if not self.latencies:
+            return
+        writing = sum(self.latencies)
+        elapsed = time.time() - self.start
+        msg = ("\tBatches: {0}, latency mean {1:.2f}s, max {2:.2f}s\n"
+               "\tDocs: {3}, {4:.0f} docs/s writing, {5:.0f} docs/s overall")
+        print(msg.format(len(self.latencies), writing / len(self.latencies),
+                         max(self.latencies), self.docs,
+                         _rate(self.docs, writing), _rate(self.docs, elapsed)))
+
+def _rate(count, seconds):
+    # The clock can report no time at all for a fast enough batch.
+    return count / seconds if seconds > 0 else float('inf')
+
+def insert_chunked(filename, db, chunksize=10**5, force_hashtags=False, log=True,
+                   dry_run=False, source=None, checkpoint=True,
+                   prefilter=False, write_concern=None, max_pending=4,
+                   dedup=None, stamper=None):
     """
     Insert tweets in mongodb database.
 
+    Parameters
+    ----------
+    filename : str
+        The file of tweets, possibly gzipped.
+    db : MongoDB database
+        The database holding the `tweets` and `sources` collections.
+    source : str
+        The name recorded in the `sources` collection once the file is done.
+        Defaults to the basename of `filename`.
+    checkpoint : bool
+        If `True`, then the byte offset just past the last inserted chunk
+        is recorded in the `sources.checkpoints` collection. An interrupted
+        insertion of the same source resumes from that offset. Tweets
+        inserted after the last checkpoint, at most one chunk, are inserted
+        again when resuming.
+    prefilter : bool
+        If `True`, reject ratelimits and tweets without coordinates from
+        their raw bytes, before JSON decoding. See `us_geocoded_tweets`.
+    write_concern : dict
+        The write concern for inserting tweets, such as {'w': 1}.
+    max_pending : int
+        The number of chunks that may wait to be written while parsing
+        continues. See `BulkWriter`.
+    dedup : Deduplicator
+        If given, tweets whose ids were already inserted are dropped before
+        insertion. The number dropped is recorded as 'duplicates' in the
+        `sources` collection. See `dedup.Deduplicator`.
+    stamper : RegionStamper
+        If given, each tweet is stamped with the keys of the county, state
+        and square containing it, a chunk at a time. See
+        `regionfields.RegionStamper`.
+
+    Returns
+    -------
+    count : int
+        The number of tweets inserted, or `None` if the source was already
+        inserted.
+
     """
-    import os
-    sources = set([source['filename']
-        for source in db.sources.find(fields={'filename':1})])
-    basename = os.path.basename(filename)
-    if basename in sources:
+    if source is None:
+        source = os.path.basename(filename)
+    if db.sources.find_one({'filename': source}):
         print("Already inserted.")
         return
-    collection = db.tweets
+
+    offset = 0
+    duplicates = 0
+    if checkpoint:
+        state = db.sources.checkpoints.find_one({'_id': source})
+        if state is not None:
+            offset = state['offset']
+            duplicates = state.get('duplicates', 0)
+            print("Resuming {0} at {1} bytes.".format(source, offset))
+
+    def save_checkpoint(offset, duplicates):
+        if checkpoint and not dry_run:
+            state = {'offset': offset, 'duplicates': duplicates}
+            db.sources.checkpoints.update({'_id': source},
+                                          {'$set': state},
+                                          upsert=True)
+
+    if not dry_run:
+        writer = BulkWriter(db.tweets, max_pending=max_pending,
+                            write_concern=write_concern, log=log)
+
+    def write(tweets, location, duplicates):
+        if dedup is not None:
+            tweets, dropped = dedup.filter(tweets)
+            duplicates += dropped
+        if stamper is not None and tweets:
+            stamper.stamp_many(tweets)
+        # The checkpoint is saved only once the chunk is written.
+        if not dry_run:
+            writer.put(tweets, lambda: save_checkpoint(location, duplicates))
+        return len(tweets), duplicates
+
     tweets = []
     count = 0
+    inserted = 0
+    location = offset
+    stats = Counter()
     print("Chunk: {0}".format(count))
-    for i, (tweet, valid) in enumerate(us_geocoded_tweets(filename)):
+    for i, (tweet, valid, location) in enumerate(
+            us_geocoded_tweets(filename, offset=offset, with_offsets=True,
+                               prefilter=prefilter, stats=stats)):
         if log and i % (chunksize/10) == 0:
             print("\t{0}".format(i))
-        t = extract(tweet)
+        t = extract_fields(tweet)
         if force_hashtags:
-            if t.has_hashtags():
+            if t['hashtags']:
                 tweets.append(t)
         else:
             tweets.append(t)
         if len(tweets) == chunksize:
-            if not dry_run:
-                collection.insert(tweets)
+            written, duplicates = write(tweets, location, duplicates)
+            inserted += written
             tweets = []
             count += 1
             print("Chunk: {0}".format(count))
 
     else:
-        if not dry_run:
-            collection.insert(tweets)
+        if tweets:
+            written, duplicates = write(tweets, location, duplicates)
+            inserted += written
+
+    if not dry_run:
+        writer.close()
+
+    if log:
+        print_stats(stats)
+    if dedup is not None:
+        print("\tDropped {0} duplicate tweets.".format(duplicates))
 
     # Mark this filename as done.
     if not dry_run:
-        db.sources.insert({'filename':basename})
+        doc = {'filename': source}
+        if dedup is not None:
+            doc['duplicates'] = duplicates
+        db.sources.insert(doc)
+        if checkpoint:
+            db.sources.checkpoints.remove({'_id': source})
+
+    return inserted
 
 
 class Pipeline(object):
-    def __init__(self, db, dry_run=False):
+    def __init__(self, db, dry_run=False, prefilter=False, dedup=None,
+                 stamper=None):
         self.db = db
         self.dry_run = dry_run
+        self.prefilter = prefilter
+        self.dedup = dedup
+        self.stamper = stamper
     def __call__(self, gzfilename):
-        shutil.copy(gzfilename, '/tmp')
-        tmpfilename = '/tmp/{0}'.format(os.path.basename(gzfilename))
-        subprocess.call(['gunzip', tmpfilename])
-        unzipped = tmpfilename[:-3]
-        insert_chunked(unzipped, self.db, dry_run=self.dry_run)
-        os.unlink(unzipped)
+        # The archive is decompressed as it is read.
+        source = source_name(gzfilename)
+        return insert_chunked(gzfilename, self.db, dry_run=self.dry_run,
+                              source=source, prefilter=self.prefilter,
+                              dedup=self.dedup, stamper=self.stamper)
+
+def _stamper(regions):
+    if regions is None:
+        return None
+    from .regionfields import RegionStamper
+    return RegionStamper(**regions)
+
+# The Bloom filter of inserted ids kept by `populate_db(dedup=True)`, in the
+# directory of the archives.
+DEDUP_FILENAME = '.dedup_filter.npz'
+
+# The state of a worker process of `populate_db`, set by `_init_worker`.
+_WORKER = {}
+
+def _init_worker(dbname, regions, bloom_state):
+    """
+    Connects to the database and builds the region stamper and the
+    deduplicator, once for each worker process of `populate_db`.
+
+    """
+    # Each process needs its own connection.
+    db = _WORKER['db'] = connect(dbname)
+    _WORKER['stamper'] = _stamper(regions)
+    _WORKER['dedup'] = None
+    if bloom_state is not None:
+        from .dedup import Deduplicator, SharedBloomFilter
+        bloom = SharedBloomFilter.from_state(bloom_state)
+        _WORKER['dedup'] = Deduplicator(db.tweets, bloom=bloom)
+
+def _populate_worker(args):
+    """
+    Inserts one archive from a worker process of `populate_db`.
 
-def populate_db(path, dry_run=False):
+    """
+    filename, dry_run, prefilter = args
+    p = Pipeline(_WORKER['db'], dry_run=dry_run, prefilter=prefilter,
+                 dedup=_WORKER['dedup'], stamper=_WORKER['stamper'])
+    start = time.time()
+    count = p(filename)
+    return filename, count, os.path.getsize(filename), time.time() - start
+
+def _picklable_regions(regions):
+    # Generators of cells, such as us_grid(), cannot be sent to workers.
+    from .squaregrid import SquareGrid
+    cells = regions.get('cells')
+    if cells is None or isinstance(cells, (SquareGrid, list)):
+        return regions
+    return dict(regions, cells=list(cells))
+
+def _print_progress(i, n, filename, count, elapsed, total_tweets, total_bytes,
+                    wall):
+    # The aggregate throughput of populate_db, after each archive.
+    msg = ("[{0}/{1}] {2}: {3} tweets in {4:.0f}s\n"
+           "\tTotal: {5} tweets, {6:.1f} MB, "
+           "{7:.0f} tweets/s, {8:.2f} MB/s")
+    print(msg.format(i + 1, n, os.path.basename(filename), count, elapsed,
+                     total_tweets, total_bytes / 1e6,
+                     _rate(total_tweets, wall), _rate(total_bytes / 1e6, wall)))
+    sys.stdout.flush()
+
+def populate_db(path, dry_run=False, processes=1, dbname='twitter',
+                prefilter=False, dedup=False, pattern='*.gz', regions=None,
+                expected=None):
     """
     Populating the database from gzipped files found in `path`.
 
+    Parameters
+    ----------
+    path : str
+        The directory containing the gzipped tweet archives.
+    dry_run : bool
+        If `True`, parse the archives but do not insert anything.
+    processes : int
+        The number of worker processes. Each worker inserts a whole archive
+        at a time. The `sources` collection records completed archives, and
+        `sources.checkpoints` records progress within unfinished ones, so an
+        interrupted run can simply be restarted.
+    dbname : str
+        The name of the database to populate.
+    prefilter : bool
+        If `True`, reject lines from their raw bytes before JSON decoding
+        where possible. See `us_geocoded_tweets`.
+    dedup : bool or str
+        If true, drop tweets whose ids were already inserted. The Bloom
+        filter of inserted ids is loaded from a file and saved back to it
+        when done: the string given, or for `True`, `DEDUP_FILENAME` in
+        `path`. Only when the file does not exist yet is a new filter sized,
+        see `expected`, and seeded with every id in the database. Delete the
+        file if tweets are inserted or removed by other means, so that it is
+        rebuilt. Worker processes share the filter, but
+        each confirms possible duplicates only against its own recent chunks
+        and the database, so a tweet in two archives inserted at the same
+        moment may still be inserted twice. See `dedup.Deduplicator`.
+    pattern : str
+        The glob pattern of the archives within `path`. For example,
+        'tweets_us.*.gz' selects only the US archives split off by
+        data/stream.py.
+    regions : dict
+        If given, tweets are stamped with their county, state and square,
+        and the region indexes are created. The dictionary holds the
+        arguments of `regionfields.RegionStamper`, such as
+        {'county_shp': ..., 'state_shp': ..., 'cells': square_grid()}, and
+        is sent to each worker process, which builds its stamper once. The
+        cells should be a `squaregrid.SquareGrid`, as returned by
+        `usoutline.square_grid`. Other iterables of cells, such as
+        `usoutline.us_grid()`, are first read into a list.
+    expected : int
+        The number of tweets expected to be inserted, over this run and
+        later ones, when a new deduplication filter is created. Only the
+        inserted tweets count, not every line of the archives. If `None`,
+        as many as are already in the database. See `dedup.Deduplicator`.
+
     """
     if path.endswith('/'):
         path = path[:-1]
-    filenames = glob.glob(path + '/*.gz')
-
-    db = connect()
-    p = Pipeline(db, dry_run=dry_run)
+    filenames = glob.glob(path + '/' + pattern)
+
+    db = connect(dbname)
+    if dedup:
+        from .dedup import Deduplicator, ensure_id_index
+        ensure_id_index(db.tweets)
+    if regions is not None:
+        regions = _picklable_regions(regions)
+        if not dry_run:
+            from .regionfields import ensure_region_indexes
+            ensure_region_indexes(db.tweets)
 
     sources = set([source['filename']
-        for source in db.sources.find(fields={'filename':1})])
+        for source in db.sources.find({}, {'filename':1})])
 
+    pending = []
     for filename in filenames:
-        print("Inserting from {0}".format(filename))
-        basename = os.path.basename(filename)[:-3]
+        basename = source_name(filename)
         if basename in sources:
-            print("Already inserted.")
-            continue
+            print("Already inserted: {0}".format(filename))
         else:
+            pending.append(filename)
+
+    deduplicator = None
+    if dedup:
+        if dedup is True:
+            dedup = os.path.join(path, DEDUP_FILENAME)
+        deduplicator = Deduplicator(db.tweets, bloom=dedup, expected=expected)
+
+    start = time.time()
+    total_tweets = 0
+    total_bytes = 0
+    if processes == 1:
+        p = Pipeline(db, dry_run=dry_run, prefilter=prefilter,
+                     dedup=deduplicator, stamper=_stamper(regions))
+        for i, filename in enumerate(pending):
+            print("Inserting from {0}".format(filename))
             sys.stdout.flush()
-            p(filename)
+            file_start = time.time()
+            count = p(filename)
+            total_tweets += count or 0
+            total_bytes += os.path.getsize(filename)
+            _print_progress(i, len(pending), filename, count,
+                            time.time() - file_start, total_tweets,
+                            total_bytes, time.time() - start)
+        if deduplicator is not None:
+            deduplicator.save()
+        return
 
+    from multiprocessing import Pool
+
+    bloom_state = None
+    if deduplicator is not None:
+        from .dedup import SharedBloomFilter
+        deduplicator.bloom = SharedBloomFilter(deduplicator.bloom)
+        bloom_state = deduplicator.bloom.state()
+    pool = Pool(processes, initializer=_init_worker,
+                initargs=(dbname, regions, bloom_state))
+    jobs = [(filename, dry_run, prefilter) for filename in pending]
+    try:
+        for i, result in enumerate(pool.imap_unordered(_populate_worker, jobs)):
+            filename, count, nbytes, elapsed = result
+            total_tweets += count or 0
+            total_bytes += nbytes
+            _print_progress(i, len(jobs), filename, count, elapsed,
+                            total_tweets, total_bytes, time.time() - start)
+    finally:
+        pool.close()
+        pool.join()
+        if deduplicator is not None:
+            # The workers' ids were added to the shared filter.
+            deduplicator.save()
@@ -0,0 +1,377 @@
+"""
+Single-pass partitioning of tweets into counties, states, and squares.
+
+The `build_hashtag_counts_by_*` builders issue one `$geoWithin` query per
+region, which means thousands of full geo queries for each grid. Here, the
+tweet collection is streamed once and each tweet is assigned to its regions
+using an in-memory spatial index over the region geometries. The counts for
+all grids are collected in that one pass and then written as the same
+documents that the `grids.*` builders produce.
+
+"""
+from __future__ import print_function
+
+from collections import OrderedDict, defaultdict
+import numbers
+import sys
+
+import fiona
+import pymongo
+import us
+from shapely.geometry import Point, mapping, shape
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+from .squaregrid import SquareGrid
+
+__all__ = [
+    'RegionIndex',
+    'county_regions',
+    'state_regions',
+    'square_regions',
+    'partition_hashtag_counts',
+    'write_hashtag_grid',
+    'build_hashtag_grids',
+]
+
+class RegionIndex(object):
+    """
+    An in-memory spatial index over a set of region geometries.
+
+    """
+    def __init__(self, keys, geometries):
+        """
+        Parameters
+        ----------
+        keys : iterable
+            The key identifying each region, e.g. the county GEOID.
+        geometries : iterable
+            The geometry of each region, as a shapely geometry or as a
+            GeoJSON-like object.
+
+        """
+        self.keys = list(keys)
+        self.geometries = [as_geometry(g) for g in geometries]
+        self.prepared = [prep(g) for g in self.geometries]
+        self.tree = STRtree(self.geometries)
+        # Shapely 1.x returns geometries from STRtree queries, while 2.x
+        # returns their integer positions. Support both.
+        self._positions = dict((id(g), i) for i, g in enumerate(self.geometries))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def candidates(self, geometry):
+        """
+        Returns the sorted positions of regions whose envelopes intersect
+        `geometry`.
+
+        """
+        positions = []
+        for hit in self.tree.query(geometry):
+            if isinstance(hit, numbers.Integral):
+                positions.append(int(hit))
+            else:
+                positions.append(self._positions[id(hit)])
+        positions.sort()
+        return positions
+
+    def query(self, lon, lat):
+        """
+        Returns the keys of all regions containing the point (lon, lat).
+
+        Points on a shared boundary belong to each region that touches them,
+        as with MongoDB's `$geoWithin`.
+
+        """
+        point = Point(lon, lat)
+        return [self.keys[i] for i in self.candidates(point)
+                if self.prepared[i].intersects(point)]
+
+    def lookup(self, lon, lat):
+        """
+        Returns the key of the first region containing (lon, lat) or `None`.
+
+        """
+        point = Point(lon, lat)
+        for i in self.candidates(point):
+            if self.prepared[i].intersects(point):
+                return self.keys[i]
+        return None
+
+def as_geometry(geometry):
+    """
+    Returns a shapely geometry from a shapely or GeoJSON-like geometry.
+
+    """
+    if hasattr(geometry, 'geom_type'):
+        return geometry
+    return shape(geometry)
+
+def county_regions(shpfile):
+    """
+    Returns the counties in the contiguous US from a TIGER/Line shapefile.
+
+    The result is an ordered dictionary from GEOID to the feature, in
+    shapefile order.
+
+    """
+    fips = set([state.fips for state in us.STATES_CONTIGUOUS])
+    regions = OrderedDict()
+    with fiona.open(shpfile, 'r') as f:
+        for feature in f:
+            if feature['properties']['STATEFP'] not in fips:
+                continue
+            regions[feature['properties']['GEOID']] = feature
+    return regions
+
+def state_regions(shpfile):
+    """
+    Returns the contiguous states from a TIGER/Line shapefile.
+
+    The result is an ordered dictionary from state FIPS to the feature, in
+    shapefile order.
+
+    """
+    desired = us.states.mapping('fips', 'abbr', us.STATES_CONTIGUOUS)
+    regions = OrderedDict()
+    with fiona.open(shpfile, 'r') as f:
+        for feature in f:
+            if feature['properties']['STATEFP'] not in desired:
+                continue
+            regions[feature['properties']['STATEFP']] = feature
+    return regions
+
+def square_regions(cells):
+    """
+    Returns the squares of a grid, keyed by their enumeration order.
+
+    Parameters
+    ----------
+    cells : iterable of shapely Polygon, or SquareGrid
+        The grid cells, as yielded by `usoutline.us_grid`. A `SquareGrid` is
+        returned as is: it is already a mapping from cell ids to features,
+        and assigns points to cells arithmetically.
+
+    """
+    if isinstance(cells, SquareGrid):
+        return cells
+    regions = OrderedDict()
+    for i, cell in enumerate(cells):
+        regions[i] = {'properties': {}, 'geometry': mapping(cell)}
+    return regions
+
+def _region_index(regions):
+    if isinstance(regions, SquareGrid):
+        return regions
+    return RegionIndex(regions.keys(),
+                       [feature['geometry'] for feature in regions.values()])
+
+def partition_hashtag_counts(tweet_collection, grids, skip_users=None,
+                             log_every=10**6):
+    """
+    Returns hashtag counts for every region of every grid in a single pass.
+
+    Parameters
+    ----------
+    tweet_collection : MongoDB collection
+        The collection of tweets to partition.
+    grids : dict
+        Maps grid names to the regions of the grid, as returned by
+        `county_regions`, `state_regions` or `square_regions`.
+    skip_users : list of int
+        A list of Twitter user ids. Any tweet from these user ids will be
+        skipped and not included in the counts.
+    log_every : int
+        Print progress after this many tweets.
+
+    Returns
+    -------
+    counts : dict
+        Maps grid names to a dictionary from region key to the hashtag counts
+        of the region.
+    skipped : dict
+        Maps grid names to a dictionary from region key to the number of
+        tweets that were not counted, due to `skip_users`.
+
+    """
+    if skip_users is None:
+        skip_users = set([])
+    else:
+        skip_users = set(skip_users)
+
+    indexes = OrderedDict()
+    counts = {}
+    skipped = {}
+    for name, regions in grids.items():
+        indexes[name] = _region_index(regions)
+        counts[name] = dict((key, defaultdict(int)) for key in regions)
+        skipped[name] = dict((key, 0) for key in regions)
+
+    fields = {'coordinates': True, 'hashtags': True, 'user.id': True}
+    tweets = tweet_collection.find({}, fields)
+    for i, tweet in enumerate(tweets):
+        if log_every and i % log_every == 0:
+            print("\t{0}".format(i))
+            sys.stdout.flush()
+
+        skip = tweet['user']['id'] in skip_users
+        if not skip and not tweet['hashtags']:
+            # Nothing to count and nothing to record as skipped.
+            continue
+
+        lon, lat = tweet['coordinates']
+        for name, index in indexes.items():
+            for key in index.query(lon, lat):
+                if skip:
+                    skipped[name][key] += 1
+                else:
+                    region_counts = counts[name][key]
+                    for hashtag in tweet['hashtags']:
+                        region_counts[hashtag] += 1
+
+    return counts, skipped
+
+def _county_doc(feature, counts):
+    properties = feature['properties']
+    doc = OrderedDict()
+    doc['name'] = properties['NAMELSAD']
+    doc['counts'] = counts
+    doc['state_fips'] = properties['STATEFP']
+    doc['county_fips'] = properties['COUNTYFP']
+    doc['geoid'] = properties['GEOID']
+    doc['landarea'] = properties['ALAND']
+    doc['geometry'] = feature['geometry']
+    return doc
+
+def _state_doc(feature, counts):
+    properties = feature['properties']
+    doc = OrderedDict()
+    doc['name'] = properties['NAME']
+    doc['counts'] = counts
+    doc['fips'] = properties['STATEFP']
+    doc['abbrev'] = properties['STUSPS']
+    doc['landarea'] = properties['ALAND']
+    doc['geometry'] = feature['geometry']
+    return doc
+
+def _square_doc(key, feature, counts):
+    doc = OrderedDict()
+    doc['geometry'] = feature['geometry']
+    doc['counts'] = counts
+    # increase latitudes to max lat, then increases longitude
+    doc['_id'] = key
+    return doc
+
+def _insert_split(collection, doc):
+    try:
+        collection.insert(doc)
+    except pymongo.errors.DocumentTooLarge:
+        # Split in two...must be careful to join when querying.
+        counts = doc.pop('counts')
+        doc.pop('_id', None)
+        doc2 = doc.copy()
+        items = list(counts.items())
+        L = int(len(items)/2)
+        doc['counts'] = dict(items[:L])
+        doc2['counts'] = dict(items[L:])
+        collection.insert(doc)
+        collection.insert(doc2)
+
+def write_hashtag_grid(kind, regions, counts, collection, drop=True):
+    """
+    Writes the hashtag counts of one grid as `grids.*` documents.
+
+    Parameters
+    ----------
+    kind : str
+        One of 'counties', 'states', or 'squares'. This determines the
+        layout of the documents.
+    regions : dict
+        The regions of the grid.
+    counts : dict
+        Maps region keys to hashtag counts.
+    collection : MongoDB collection
+        The collection to write to.
+    drop : bool
+        If `True`, drop the collection before writing.
+
+    """
+    if drop:
+        collection.drop()
+
+    for key, feature in regions.items():
+        region_counts = counts.get(key, {})
+        if kind == 'counties':
+            _insert_split(collection, _county_doc(feature, region_counts))
+        elif kind == 'states':
+            _insert_split(collection, _state_doc(feature, region_counts))
+        elif kind == 'squares':
+            # Since we are specifying a unique id, let any error raise.
+            collection.insert(_square_doc(key, feature, region_counts))
+        else:
+            raise ValueError('Unknown grid: {0!r}'.format(kind))
+
+def build_hashtag_grids(tweet_collection, collections, county_shp=None,
+                        state_shp=None, cells=None, skip_users=None,
+                        dry_run=True):
+    """
+    Builds the county, state and square grids from one pass over the tweets.
+
+    Parameters
+    ----------
+    tweet_collection : MongoDB collection
+        The collection containing the tweets to partition.
+    collections : dict
+        Maps 'counties', 'states', and 'squares' to the collection where
+        that grid is stored. Each will be emptied if `dry_run` is `False`.
+    county_shp : str
+        The TIGER/Line county shapefile. If `None`, counties are not built.
+    state_shp : str
+        The TIGER/Line state shapefile. If `None`, states are not built.
+    cells : iterable of shapely Polygon, or SquareGrid
+        The grid cells. If `None`, squares are not built.
+    skip_users : list of int
+        The set of user ids to skip.
+    dry_run : bool
+        If `True`, then we only build the counts, but nothing is saved.
+
+    Returns
+    -------
+    skips : dict
+        Maps grid names to the total number of skipped tweets in each region.
+
+    Examples
+    --------
+    >>> db = connect()
+    >>> skip = get_skip_users()
+    >>> build_hashtag_grids(db.tweets.with_hashtags,
+    ...                     {'counties': db.grids.counties.bot_filtered,
+    ...                      'states': db.grids.states.bot_filtered,
+    ...                      'squares': db.grids.squares.bot_filtered},
+    ...                     '../tiger/tl_2014_us_county.shp',
+    ...                     '../tiger/tl_2014_us_state.shp',
+    ...                     us_grid(),
+    ...                     skip_users=skip)
+    ...
+
+    """
+    grids = OrderedDict()
+    if county_shp is not None:
+        grids['counties'] = county_regions(county_shp)
+    if state_shp is not None:
+        grids['states'] = state_regions(state_shp)
+    if cells is not None:
+        grids['squares'] = square_regions(cells)
+
+    counts, skipped = partition_hashtag_counts(tweet_collection, grids,
+                                               skip_users=skip_users)
+
+    for name, regions in grids.items():
+        total = sum(skipped[name].values())
+        msg = "{0}: skipped {1} tweets due to user ids."
+        print(msg.format(name, total))
+        if not dry_run:
+            write_hashtag_grid(name, regions, counts[name], collections[name])
+
+    return skipped
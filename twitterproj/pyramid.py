@@ -0,0 +1,351 @@
+"""
+A multi-resolution pyramid of square-grid counts.
+
+Tweets are counted once, at the finest resolution, and each coarser level
+doubles the cell size by summing the counts of its 2x2 children:
+
+    level 0: resolution r, e.g. 0.25 degrees
+    level 1: 2r
+    level 2: 4r
+    ...
+
+Cell (x, y) of level k holds the cells (x << k ... , y << k ...) of level 0,
+so every level shares the origin of the base grid, a `SquareGrid` without an
+outline. Each cell holds:
+
+    tweets   : the number of counted tweets
+    skipped  : the number of tweets skipped due to user ids
+    hashtags : hashtag counts
+    users    : tweet counts by user id (as a string)
+
+The pyramid is stored in a MongoDB collection, one document per cell and
+level, and `query_pyramid` returns the counts of the cells covering any
+bounding box at any level. Changing the map resolution is then a lookup.
+
+Examples
+--------
+>>> db = connect()
+>>> build_pyramid(db.tweets.with_hashtags, db.grids.pyramid.bot_filtered,
+...               resolution=0.25, levels=6, skip_users=get_skip_users())
+>>> cells = query_pyramid(db.grids.pyramid.bot_filtered,
+...                       (-125, 24, -66, 50), level=2)
+>>> cells[(0, 0)]['hashtags']
+
+"""
+from __future__ import division
+from __future__ import print_function
+
+from collections import OrderedDict, defaultdict
+import math
+import sys
+
+import numpy as np
+import pymongo
+from shapely.geometry import box, mapping
+
+from .squaregrid import SquareGrid
+
+__all__ = [
+    'CountPyramid',
+    'build_pyramid',
+    'query_pyramid',
+    'sum_cells',
+]
+
+KINDS = ('hashtags', 'users')
+
+# The most hashtags and users stored in one document. Coarse cells can hold
+# millions, and documents are limited to 16 MB.
+MAX_KEYS = 100000
+
+def _cell():
+    return {'tweets': 0, 'skipped': 0,
+            'hashtags': defaultdict(int), 'users': defaultdict(int)}
+
+class CountPyramid(object):
+    """
+    Hashtag and user counts of square cells at several resolutions.
+
+    """
+    def __init__(self, resolution=0.25, levels=6, bounds=None):
+        """
+        Parameters
+        ----------
+        resolution : float
+            The cell size of level 0, in degrees.
+        levels : int
+            The number of levels. Level k has cells of `resolution * 2**k`.
+        bounds : tuple
+            The bounds covered by the grid, as in `SquareGrid`.
+
+        """
+        self.grid = SquareGrid(resolution, bounds)
+        self.resolution = resolution
+        self.nlevels = levels
+        self.bounds = bounds
+        self.levels = [defaultdict(_cell) for i in range(levels)]
+
+    def level_resolution(self, level):
+        return self.resolution * 2**level
+
+    def shape(self, level):
+        """
+        Returns the number of cells of `level` in longitude and latitude.
+
+        """
+        n = 2**level
+        return (self.grid.nx + n - 1) // n, (self.grid.ny + n - 1) // n
+
+    def cell_box(self, level, x, y):
+        """
+        Returns cell (x, y) of `level` as a shapely box.
+
+        """
+        r = self.level_resolution(level)
+        return box(self.grid.min_lon + x * r, self.grid.min_lat + y * r,
+                   self.grid.min_lon + (x + 1) * r,
+                   self.grid.min_lat + (y + 1) * r)
+
+    def cell_range(self, bbox, level):
+        """
+        Returns the (x0, x1, y0, y1) cells of `level` covering a bounding
+        box, inclusive, or `None` if the box is outside the grid.
+
+        """
+        r = self.level_resolution(level)
+        nx, ny = self.shape(level)
+        x0 = int(math.floor((bbox[0] - self.grid.min_lon) / r))
+        y0 = int(math.floor((bbox[1] - self.grid.min_lat) / r))
+        x1 = int(math.floor((bbox[2] - self.grid.min_lon) / r))
+        y1 = int(math.floor((bbox[3] - self.grid.min_lat) / r))
+        x0, y0 = max(x0, 0), max(y0, 0)
+        x1, y1 = min(x1, nx - 1), min(y1, ny - 1)
+        if x0 > x1 or y0 > y1:
+            return None
+        return x0, x1, y0, y1
+
+    def add(self, tweets, skip_users=None):
+        """
+        Counts a batch of tweets into level 0.
+
+        Each tweet needs 'coordinates', 'hashtags' and 'user.id'.
+
+        """
+        skip_users = skip_users or ()
+        tweets = list(tweets)
+        if not tweets:
+            return
+        coords = np.array([tweet['coordinates'] for tweet in tweets],
+                          dtype=float).reshape(-1, 2)
+        ids = self.grid.cell_ids(coords[:, 0], coords[:, 1])
+        base = self.levels[0]
+        for tweet, key in zip(tweets, ids.tolist()):
+            if key < 0:
+                continue
+            cell = base[divmod(key, self.grid.ny)]
+            user_id = tweet['user']['id']
+            if user_id in skip_users:
+                cell['skipped'] += 1
+                continue
+            cell['tweets'] += 1
+            cell['users'][str(user_id)] += 1
+            for hashtag in tweet['hashtags']:
+                cell['hashtags'][hashtag] += 1
+
+    def build_levels(self):
+        """
+        Computes every coarser level by summing the children of each cell.
+
+        """
+        for level in range(1, self.nlevels):
+            parents = self.levels[level] = defaultdict(_cell)
+            for (x, y), child in self.levels[level - 1].items():
+                parent = parents[(x >> 1, y >> 1)]
+                parent['tweets'] += child['tweets']
+                parent['skipped'] += child['skipped']
+                for kind in KINDS:
+                    counts = parent[kind]
+                    for key, count in child[kind].items():
+                        counts[key] += count
+
+    def query(self, bbox, level):
+        """
+        Returns the cells of `level` covering a bounding box.
+
+        The result maps (x, y) to the cell's counts. Cells without tweets
+        are absent.
+
+        """
+        cells = OrderedDict()
+        r = self.cell_range(bbox, level)
+        if r is None:
+            return cells
+        x0, x1, y0, y1 = r
+        for (x, y) in sorted(self.levels[level]):
+            if x0 <= x <= x1 and y0 <= y <= y1:
+                cells[(x, y)] = self.levels[level][(x, y)]
+        return cells
+
+    def meta(self):
+        return {'resolution': self.resolution, 'levels': self.nlevels,
+                'bounds': None if self.bounds is None else list(self.bounds)}
+
+    def documents(self, max_keys=MAX_KEYS):
+        """
+        Yields the documents of every cell of every level.
+
+        Cells with more than `max_keys` hashtags and users are split into
+        several documents, numbered by 'part'. Only part 0 holds the
+        tweet counts.
+
+        """
+        for level, cells in enumerate(self.levels):
+            for (x, y) in sorted(cells):
+                cell = cells[(x, y)]
+                items = [(kind, list(cell[kind].items())) for kind in KINDS]
+                total = sum(len(kind_items) for kind, kind_items in items)
+                nparts = max(1, -(-total // max_keys))
+                for part in range(nparts):
+                    doc = OrderedDict()
+                    doc['level'] = level
+                    doc['x'] = x
+                    doc['y'] = y
+                    doc['part'] = part
+                    if part == 0:
+                        doc['geometry'] = mapping(self.cell_box(level, x, y))
+                        doc['tweets'] = cell['tweets']
+                        doc['skipped'] = cell['skipped']
+                    for kind, kind_items in items:
+                        doc[kind] = dict(kind_items[part::nparts])
+                    yield doc
+
+    def save(self, collection, drop=True, max_keys=MAX_KEYS):
+        """
+        Writes the pyramid to a collection.
+
+        """
+        if drop:
+            collection.drop()
+        collection.insert({'_id': 'meta', 'meta': self.meta()})
+        keys = [('level', pymongo.ASCENDING), ('x', pymongo.ASCENDING),
+                ('y', pymongo.ASCENDING)]
+        # create_index is in every pymongo; ensure_index is gone from
+        # pymongo 4.
+        collection.create_index(keys)
+        for doc in self.documents(max_keys):
+            collection.insert(doc)
+
+def build_pyramid(tweet_collection, pyramid_collection, resolution=0.25,
+                  levels=6, bounds=None, skip_users=None, batch_size=10**5,
+                  dry_run=False, log_every=10**6):
+    """
+    Builds a count pyramid from one pass over the tweets.
+
+    Parameters
+    ----------
+    tweet_collection : MongoDB collection
+        The collection of tweets.
+    pyramid_collection : MongoDB collection
+        Where the pyramid is stored. It is dropped first.
+    resolution : float
+        The finest cell size, in degrees.
+    levels : int
+        The number of levels.
+    bounds : tuple
+        The bounds covered by the grid, as in `SquareGrid`.
+    skip_users : list of int
+        Tweets from these user ids are counted as skipped.
+    batch_size : int
+        The number of tweets assigned to cells at once.
+    dry_run : bool
+        If `True`, the pyramid is built but not saved.
+
+    Returns
+    -------
+    pyramid : CountPyramid
+        The pyramid.
+
+    """
+    skip_users = set(skip_users or [])
+    pyramid = CountPyramid(resolution, levels, bounds)
+    fields = {'coordinates': True, 'hashtags': True, 'user.id': True}
+    batch = []
+    for i, tweet in enumerate(tweet_collection.find({}, fields)):
+        if log_every and i % log_every == 0:
+            print("\t{0}".format(i))
+            sys.stdout.flush()
+        batch.append(tweet)
+        if len(batch) == batch_size:
+            pyramid.add(batch, skip_users)
+            batch = []
+    pyramid.add(batch, skip_users)
+    pyramid.build_levels()
+
+    if not dry_run:
+        pyramid.save(pyramid_collection)
+    return pyramid
+
+def query_pyramid(collection, bbox, level, kinds=KINDS):
+    """
+    Returns the counts of the cells of `level` covering a bounding box.
+
+    Parameters
+    ----------
+    collection : MongoDB collection
+        The pyramid, as written by `build_pyramid`.
+    bbox : tuple
+        The (min lon, min lat, max lon, max lat) of the box.
+    level : int
+        The level, 0 being the finest.
+    kinds : tuple
+        Which of 'hashtags' and 'users' to return. The others are not
+        fetched.
+
+    Returns
+    -------
+    cells : dict
+        Maps (x, y) to a dictionary with the cell's 'geometry', 'tweets',
+        'skipped', and counts of each of `kinds`. Cells without tweets are
+        absent.
+
+    """
+    meta = collection.find_one({'_id': 'meta'})['meta']
+    if not 0 <= level < meta['levels']:
+        raise ValueError('No level {0} in the pyramid.'.format(level))
+    pyramid = CountPyramid(meta['resolution'], meta['levels'], meta['bounds'])
+    r = pyramid.cell_range(bbox, level)
+    cells = OrderedDict()
+    if r is None:
+        return cells
+
+    x0, x1, y0, y1 = r
+    spec = {'level': level, 'x': {'$gte': x0, '$lte': x1},
+            'y': {'$gte': y0, '$lte': y1}}
+    fields = dict.fromkeys(['x', 'y', 'geometry', 'tweets', 'skipped'], True)
+    fields.update(dict.fromkeys(kinds, True))
+    docs = collection.find(spec, fields).sort([('x', pymongo.ASCENDING),
+                                               ('y', pymongo.ASCENDING),
+                                               ('part', pymongo.ASCENDING)])
+    for doc in docs:
+        key = (doc['x'], doc['y'])
+        if key not in cells:
+            cells[key] = dict((kind, {}) for kind in kinds)
+        cell = cells[key]
+        for field in ('geometry', 'tweets', 'skipped'):
+            if field in doc:
+                cell[field] = doc[field]
+        for kind in kinds:
+            # Parts of a split cell hold disjoint keys.
+            cell[kind].update(doc[kind])
+    return cells
+
+def sum_cells(cells, kind='hashtags'):
+    """
+    Returns the total counts of `kind` over several cells.
+
+    """
+    total = defaultdict(int)
+    for cell in cells.values():
+        for key, count in cell[kind].items():
+            total[key] += count
+    return total
@@ -0,0 +1,240 @@
+"""
+A raster lookup table from points to counties.
+
+The contiguous US bounding box is divided into square cells, and each cell
+stores the position of the one county that contains the whole cell in its
+interior, `NONE` if no county touches the cell, or `BOUNDARY` if the cell
+is crossed by a boundary. Resolving a point is then a NumPy indexing
+operation, and only points in boundary cells are tested against the county
+polygons.
+
+The raster is built top-down, as a quadtree: a block of cells that one
+county contains, or that no county touches, is filled at once, and only
+blocks crossed by a boundary are subdivided.
+
+The result for every point is the same as `RegionIndex.query`, and so as
+`$geoWithin`: cells are only filled when the county contains them, edges
+included, in its interior, and points within a tiny distance of a cell edge
+are also tested exactly.
+
+The raster is saved as a `.npy` file, with its bounds, resolution and
+region keys in a `.json` file beside it, and is loaded memory-mapped.
+
+Examples
+--------
+>>> counties = county_regions('../tiger/tl_2014_us_county.shp')
+>>> raster = RegionRaster(counties, resolution=0.01)
+>>> raster.save('counties.raster.npy')
+>>> raster = RegionRaster.load('counties.raster.npy', counties)
+>>> geoids = raster.lookup(lons, lats)
+
+"""
+from __future__ import division
+
+import io
+import json
+
+import numpy as np
+from shapely.geometry import Point, box
+
+from .helpers import USA
+from .partition import _region_index
+
+__all__ = [
+    'RegionRaster',
+]
+
+# Cell values other than region positions.
+
+NONE = -1
+BOUNDARY = -2
+
+# Points this close to a cell edge, in cells, are tested exactly.
+EDGE_TOLERANCE = 1e-9
+
+class RegionRaster(object):
+    """
+    A raster of region positions over a bounding box.
+
+    """
+    def __init__(self, regions, resolution=0.01, bounds=None, grid=None):
+        """
+        Parameters
+        ----------
+        regions : dict
+            Maps region keys to features, as returned by
+            `partition.county_regions`.
+        resolution : float
+            The width and height of each cell, in degrees.
+        bounds : tuple
+            The (min lon, min lat, max lon, max lat) of the raster. Defaults
+            to the bounds of `helpers.USA`.
+        grid : array
+            A raster previously built for the same regions, resolution and
+            bounds. If `None`, the raster is built.
+
+        """
+        if bounds is None:
+            bounds = USA.bounds
+        self.index = _region_index(regions)
+        self.keys = self.index.keys
+        self.resolution = resolution
+        self.bounds = tuple(bounds)
+        self.nx = int(np.ceil((bounds[2] - bounds[0]) / resolution))
+        self.ny = int(np.ceil((bounds[3] - bounds[1]) / resolution))
+
+        envelopes = np.array([g.bounds for g in self.index.geometries])
+        self.extent = (envelopes[:, 0].min(), envelopes[:, 1].min(),
+                       envelopes[:, 2].max(), envelopes[:, 3].max())
+
+        if grid is None:
+            grid = self._build()
+        self.grid = grid
+
+    def _cell_box(self, iy0, iy1, ix0, ix1):
+        x0, y0 = self.bounds[:2]
+        r = self.resolution
+        return box(x0 + ix0 * r, y0 + iy0 * r, x0 + ix1 * r, y0 + iy1 * r)
+
+    def _build(self):
+        grid = np.empty((self.ny, self.nx), dtype=np.int32)
+        prepared = self.index.prepared
+
+        whole = self._cell_box(0, self.ny, 0, self.nx)
+        stack = [(0, self.ny, 0, self.nx, self.index.candidates(whole))]
+        while stack:
+            iy0, iy1, ix0, ix1, candidates = stack.pop()
+            block = self._cell_box(iy0, iy1, ix0, ix1)
+            hits = [i for i in candidates if prepared[i].intersects(block)]
+            if not hits:
+                grid[iy0:iy1, ix0:ix1] = NONE
+                continue
+            if len(hits) == 1 and prepared[hits[0]].contains_properly(block):
+                grid[iy0:iy1, ix0:ix1] = hits[0]
+                continue
+            if iy1 - iy0 == 1 and ix1 - ix0 == 1:
+                grid[iy0, ix0] = BOUNDARY
+                continue
+
+            # Split into quadrants, skipping empty halves of thin blocks.
+            iym = (iy0 + iy1 + 1) // 2 if iy1 - iy0 > 1 else iy1
+            ixm = (ix0 + ix1 + 1) // 2 if ix1 - ix0 > 1 else ix1
+            for ya, yb in ((iy0, iym), (iym, iy1)):
+                for xa, xb in ((ix0, ixm), (ixm, ix1)):
+                    if ya < yb and xa < xb:
+                        stack.append((ya, yb, xa, xb, hits))
+        return grid
+
+    def boundary_fraction(self):
+        """
+        Returns the fraction of cells that require an exact test.
+
+        """
+        return np.count_nonzero(self.grid == BOUNDARY) / self.grid.size
+
+    def _cells(self, lons, lats):
+        # The raster value for each point, with BOUNDARY for points that need
+        # an exact test.
+        x0, y0 = self.bounds[:2]
+        tx = (lons - x0) / self.resolution
+        ty = (lats - y0) / self.resolution
+        ix = np.floor(tx)
+        iy = np.floor(ty)
+        inside = (ix >= 0) & (ix < self.nx) & (iy >= 0) & (iy < self.ny)
+
+        values = np.full(lons.shape, NONE, dtype=np.int32)
+        values[inside] = self.grid[iy[inside].astype(np.intp),
+                                   ix[inside].astype(np.intp)]
+
+        # Rounding can put a point just outside its cell, so points near a
+        # cell edge, and points outside the raster but within the regions'
+        # extent, are tested exactly.
+        near_edge = ((tx - ix < EDGE_TOLERANCE) |
+                     (tx - ix > 1 - EDGE_TOLERANCE) |
+                     (ty - iy < EDGE_TOLERANCE) |
+                     (ty - iy > 1 - EDGE_TOLERANCE))
+        e = self.extent
+        in_extent = ((lons >= e[0]) & (lons <= e[2]) &
+                     (lats >= e[1]) & (lats <= e[3]))
+        values[in_extent & (near_edge | ~inside)] = BOUNDARY
+        return values
+
+    def _exact(self, lon, lat):
+        point = Point(lon, lat)
+        return [i for i in self.index.candidates(point)
+                if self.index.prepared[i].intersects(point)]
+
+    def positions(self, lons, lats):
+        """
+        Returns the position, in `keys`, of the first region containing each
+        point, or `NONE`, as an array.
+
+        """
+        lons = np.asarray(lons, dtype=float)
+        lats = np.asarray(lats, dtype=float)
+        out = self._cells(lons, lats)
+        for i in np.flatnonzero(out == BOUNDARY):
+            matches = self._exact(lons.flat[i], lats.flat[i])
+            out.flat[i] = matches[0] if matches else NONE
+        return out
+
+    def lookup(self, lons, lats):
+        """
+        Returns the key of the first region containing each point, or `None`.
+
+        This is `RegionIndex.lookup` for many points at once.
+
+        """
+        keys = self.keys + [None]
+        return [keys[p] for p in self.positions(lons, lats)]
+
+    def query(self, lons, lats):
+        """
+        Returns the keys of all regions containing each point.
+
+        This is `RegionIndex.query` for many points at once: a point on a
+        shared boundary belongs to each region that touches it, as with
+        `$geoWithin`.
+
+        """
+        lons = np.asarray(lons, dtype=float)
+        lats = np.asarray(lats, dtype=float)
+        values = self._cells(lons, lats).ravel()
+        keys = self.keys
+        out = [[keys[p]] if p >= 0 else [] for p in values.tolist()]
+        # Only points in boundary cells are tested against the polygons.
+        for i in np.flatnonzero(values == BOUNDARY):
+            positions = self._exact(lons.flat[i], lats.flat[i])
+            out[i] = [keys[p] for p in positions]
+        return out
+
+    def save(self, filename):
+        """
+        Saves the raster to `filename`, a `.npy` file, and its metadata to
+        `filename` with a `.json` suffix.
+
+        """
+        np.save(filename, self.grid)
+        meta = {'resolution': self.resolution, 'bounds': list(self.bounds),
+                'keys': self.keys}
+        with open(_meta_filename(filename), 'w') as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, filename, regions):
+        """
+        Loads a saved raster, memory-mapped, for the same regions.
+
+        """
+        with io.open(_meta_filename(filename), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta['keys'] != list(regions.keys()):
+            raise ValueError('The raster was built for other regions.')
+        grid = np.load(filename, mmap_mode='r')
+        return cls(regions, resolution=meta['resolution'],
+                   bounds=meta['bounds'], grid=grid)
+
+def _meta_filename(filename):
+    if filename.endswith('.npy'):
+        filename = filename[:-4]
+    return filename + '.json'
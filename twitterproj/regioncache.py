@@ -0,0 +1,288 @@
+"""
+A cache of TIGER/Line region geometries.
+
+Reading `tl_2014_us_county.shp` with fiona and building shapely geometries
+from its GeoJSON takes much longer than the work most scripts then do with
+it. The first read of a shapefile writes a cache beside it, e.g.
+`tl_2014_us_county.regions.npz`, holding for each region:
+
+    - its key, e.g. the county GEOID or state FIPS,
+    - its position among all features of the shapefile,
+    - its properties, as JSON,
+    - its bounding box,
+    - its full geometry and a simplified geometry, as WKB.
+
+Later reads load the cache instead, and rebuild it when the shapefile has
+changed. Geometries are only parsed from WKB when first used, and the
+STRtree over the bounding boxes is built from them on demand, as shapely
+trees cannot be saved.
+
+Only regions in the contiguous US are kept, but each feature from `regions`
+has the 'id' it had in the shapefile, as with fiona. Scripts that number
+jobs by shapefile position, such as `build_userstats_by_county` with
+`mod_filter`, number them from the 'id'.
+
+Examples
+--------
+>>> counties = county_cache('../tiger/tl_2014_us_county.shp')
+>>> counties.properties['53033']['NAMELSAD']
+u'King County'
+>>> counties.prepared()['53033'].contains(Point(-122.3, 47.6))
+True
+>>> counties.index.query(-122.3, 47.6)
+['53033']
+
+"""
+from __future__ import print_function
+
+from collections import OrderedDict
+import io
+import json
+import os
+
+import numpy as np
+from shapely import wkb
+from shapely.geometry import mapping, shape
+from shapely.prepared import prep
+
+from .partition import RegionIndex, county_regions, state_regions
+
+__all__ = [
+    'RegionCache',
+    'region_cache',
+    'county_cache',
+    'state_cache',
+]
+
+# Tolerance, in degrees, of the simplified geometries.
+SIMPLIFY_TOLERANCE = 0.005
+
+# Bump when the layout of the cache file changes.
+CACHE_VERSION = 2
+
+class RegionCache(object):
+    """
+    Region geometries and properties, keyed by region.
+
+    """
+    def __init__(self, keys, properties, bounds, full, simplified,
+                 meta=None, positions=None):
+        """
+        Parameters
+        ----------
+        keys : list
+            The key of each region.
+        properties : list of dict
+            The properties of each region.
+        bounds : array, shape (n, 4)
+            The (min lon, min lat, max lon, max lat) of each region.
+        full, simplified : list of bytes
+            The WKB of each region's full and simplified geometry.
+        meta : dict
+            Describes the source of the cache.
+        positions : list of int
+            The position of each region among all features of the source.
+            Defaults to the position among `keys`.
+
+        """
+        self.keys = list(keys)
+        if positions is None:
+            positions = range(len(self.keys))
+        self.positions = [int(position) for position in positions]
+        self.properties = OrderedDict(zip(self.keys, properties))
+        self.bounds = np.asarray(bounds, dtype=float).reshape(-1, 4)
+        self.meta = meta or {}
+        self._wkb = {False: list(full), True: list(simplified)}
+        self._geometries = {}
+        self._prepared = {}
+        self._index = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def geometries(self, simplified=False):
+        """
+        Returns an ordered dictionary from region keys to shapely geometries.
+
+        """
+        if simplified not in self._geometries:
+            self._geometries[simplified] = OrderedDict(
+                (key, wkb.loads(data))
+                for key, data in zip(self.keys, self._wkb[simplified]))
+        return self._geometries[simplified]
+
+    def prepared(self, simplified=False):
+        """
+        Returns an ordered dictionary from region keys to prepared geometries.
+
+        """
+        if simplified not in self._prepared:
+            self._prepared[simplified] = OrderedDict(
+                (key, prep(geometry))
+                for key, geometry in self.geometries(simplified).items())
+        return self._prepared[simplified]
+
+    @property
+    def index(self):
+        """
+        A `partition.RegionIndex` over the full geometries.
+
+        """
+        if self._index is None:
+            self._index = RegionIndex(self.keys,
+                                      self.geometries().values())
+        return self._index
+
+    def regions(self, simplified=False):
+        """
+        Returns the regions as features, like `partition.county_regions`.
+
+        The 'id' of each feature is its position in the shapefile, as a
+        string.
+
+        """
+        regions = OrderedDict()
+        geometries = self.geometries(simplified)
+        for key, position in zip(self.keys, self.positions):
+            regions[key] = {'id': str(position),
+                            'properties': self.properties[key],
+                            'geometry': mapping(geometries[key])}
+        return regions
+
+    @classmethod
+    def from_regions(cls, regions, tolerance=SIMPLIFY_TOLERANCE, meta=None):
+        """
+        Builds the cache from features, as returned by `county_regions`.
+
+        """
+        keys, properties, bounds, full, simplified = [], [], [], [], []
+        positions = []
+        for i, (key, feature) in enumerate(regions.items()):
+            geometry = shape(feature['geometry'])
+            keys.append(key)
+            # fiona numbers shapefile features by position.
+            positions.append(int(feature.get('id', i)))
+            properties.append(dict(feature['properties']))
+            bounds.append(geometry.bounds)
+            full.append(geometry.wkb)
+            simple = geometry.simplify(tolerance, preserve_topology=True)
+            simplified.append(simple.wkb)
+        meta = dict(meta or {}, tolerance=tolerance)
+        return cls(keys, properties, bounds, full, simplified, meta,
+                   positions)
+
+    def save(self, filename):
+        """
+        Saves the cache as a `.npz` file.
+
+        The WKB of all geometries is stored as one byte array, with the
+        offset of each geometry.
+
+        """
+        meta = dict(self.meta, version=CACHE_VERSION)
+        header = {'keys': self.keys,
+                  'positions': self.positions,
+                  'properties': list(self.properties.values()),
+                  'meta': meta}
+        arrays = {'header': _to_bytes(json.dumps(header).encode('utf-8')),
+                  'bounds': self.bounds}
+        for name, simplified in (('full', False), ('simplified', True)):
+            data = self._wkb[simplified]
+            offsets = np.cumsum([0] + [len(d) for d in data])
+            arrays[name] = _to_bytes(b''.join(data))
+            arrays[name + '_offsets'] = offsets.astype(np.int64)
+
+        # Write to a temporary name so that readers never see a partial file.
+        tmpname = filename + '.tmp'
+        with io.open(tmpname, 'wb') as f:
+            np.savez(f, **arrays)
+        os.rename(tmpname, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Loads a cache saved with `save`.
+
+        """
+        with np.load(filename) as npz:
+            header = json.loads(npz['header'].tobytes().decode('utf-8'))
+            bounds = npz['bounds']
+            wkbs = []
+            for name in ('full', 'simplified'):
+                data = npz[name].tobytes()
+                offsets = npz[name + '_offsets']
+                wkbs.append([data[a:b] for a, b in zip(offsets[:-1],
+                                                       offsets[1:])])
+        return cls(header['keys'], header['properties'], bounds,
+                   wkbs[0], wkbs[1], header['meta'], header.get('positions'))
+
+def _to_bytes(data):
+    return np.frombuffer(data, dtype=np.uint8)
+
+def _source_meta(shpfile, kind):
+    st = os.stat(shpfile)
+    return {'source': os.path.abspath(shpfile), 'size': st.st_size,
+            'mtime': st.st_mtime, 'kind': kind}
+
+def _cache_filename(shpfile):
+    return os.path.splitext(shpfile)[0] + '.regions.npz'
+
+def region_cache(shpfile, kind, tolerance=SIMPLIFY_TOLERANCE, filename=None):
+    """
+    Returns the cached regions of a shapefile, building the cache if needed.
+
+    Parameters
+    ----------
+    shpfile : str
+        The TIGER/Line shapefile.
+    kind : str
+        'counties' or 'states'. Counties are keyed by GEOID and states by
+        state FIPS, and only those in the contiguous US are kept.
+    tolerance : float
+        The tolerance, in degrees, of the simplified geometries.
+    filename : str
+        The cache file. If `None`, the shapefile's name with the suffix
+        '.regions.npz'.
+
+    Returns
+    -------
+    cache : RegionCache
+        The regions.
+
+    """
+    readers = {'counties': county_regions, 'states': state_regions}
+    if kind not in readers:
+        raise ValueError('Unknown regions: {0!r}'.format(kind))
+
+    if filename is None:
+        filename = _cache_filename(shpfile)
+    meta = _source_meta(shpfile, kind)
+
+    if os.path.exists(filename):
+        cache = RegionCache.load(filename)
+        expected = dict(meta, tolerance=tolerance, version=CACHE_VERSION)
+        if all(cache.meta.get(k) == v for k, v in expected.items()):
+            return cache
+
+    regions = readers[kind](shpfile)
+    cache = RegionCache.from_regions(regions, tolerance, meta)
+    try:
+        cache.save(filename)
+    except (IOError, OSError) as e:
+        # E.g. a read-only directory. The cache is only an optimization.
+        print("Could not save region cache: {0}".format(e))
+    return cache
+
+def county_cache(shpfile, **kwargs):
+    """
+    Returns the cached counties in the contiguous US, keyed by GEOID.
+
+    """
+    return region_cache(shpfile, 'counties', **kwargs)
+
+def state_cache(shpfile, **kwargs):
+    """
+    Returns the cached contiguous states, keyed by state FIPS.
+
+    """
+    return region_cache(shpfile, 'states', **kwargs)
@@ -0,0 +1,375 @@
+"""
+Region fields stamped on tweets: county GEOID, state FIPS and square id.
+
+Region queries with `$geoWithin` test every candidate tweet against the
+region's polygon. Instead, each tweet can be stamped once, at ingestion or
+with `backfill_regions`, with the keys of the regions containing it:
+
+    {'geoid': ['53033'], 'state_fips': ['53'], 'square_id': [1523], ...}
+
+Region queries are then indexed equality queries, such as
+`{'geoid': '53033'}`, and per-region counts are a single `$group`
+aggregation over the collection.
+
+Each field is a list, as with `RegionIndex.query`: a point on the boundary
+shared by two regions belongs to both, as with `$geoWithin`, and a point
+outside every region gets an empty list. Equality queries match any element
+of the list, and aggregations `$unwind` it.
+
+"""
+from __future__ import print_function
+
+from collections import OrderedDict, defaultdict
+import sys
+
+import numpy as np
+import pymongo
+
+from .partition import (county_regions, state_regions, square_regions,
+                        write_hashtag_grid, _region_index)
+from .raster import RegionRaster
+
+__all__ = [
+    'REGION_FIELDS',
+    'RegionStamper',
+    'backfill_regions',
+    'ensure_region_indexes',
+    'tweets_in_region_field',
+    'hashtag_counts_by_region',
+    'user_counts_by_region',
+    'build_hashtag_grids_from_fields',
+]
+
+# Maps each tweet field to the grid whose region keys it holds.
+REGION_FIELDS = OrderedDict([
+    ('geoid', 'counties'),
+    ('state_fips', 'states'),
+    ('square_id', 'squares'),
+])
+
+class RegionStamper(object):
+    """
+    Computes the region fields of tweets.
+
+    Examples
+    --------
+    >>> stamper = RegionStamper('../tiger/tl_2014_us_county.shp',
+    ...                         '../tiger/tl_2014_us_state.shp',
+    ...                         us_grid())
+    >>> stamper.stamp(tweet)
+    >>> tweet['geoid']
+    ['53033']
+    >>> stamper.stamp_many(tweets)
+
+    """
+    def __init__(self, county_shp=None, state_shp=None, cells=None,
+                 county_raster=None):
+        """
+        Parameters
+        ----------
+        county_shp : str
+            The TIGER/Line county shapefile. If `None`, 'geoid' is not
+            stamped.
+        state_shp : str
+            The TIGER/Line state shapefile. If `None`, 'state_fips' is not
+            stamped.
+        cells : iterable of shapely Polygon, or SquareGrid
+            The grid cells, as yielded by `usoutline.us_grid`. If `None`,
+            'square_id' is not stamped. With a `SquareGrid`, cells are
+            found arithmetically and each point gets exactly one cell.
+        county_raster : str
+            A `raster.RegionRaster` of the counties, saved with its `save`
+            method. If given, 'geoid' is resolved through the raster, and
+            only points near a county boundary are tested against the
+            polygons.
+
+        """
+        self.grids = OrderedDict()
+        if county_shp is not None:
+            self.grids['geoid'] = county_regions(county_shp)
+        if state_shp is not None:
+            self.grids['state_fips'] = state_regions(state_shp)
+        if cells is not None:
+            self.grids['square_id'] = square_regions(cells)
+        self.indexes = OrderedDict((field, _region_index(regions))
+                                   for field, regions in self.grids.items())
+        self.rasters = {}
+        if county_raster is not None:
+            self.rasters['geoid'] = RegionRaster.load(county_raster,
+                                                      self.grids['geoid'])
+
+    def fields(self, lon, lat):
+        """
+        Returns the region fields for the point (lon, lat).
+
+        """
+        fields = {}
+        for field, index in self.indexes.items():
+            if field in self.rasters:
+                fields[field] = self.rasters[field].query([lon], [lat])[0]
+            else:
+                fields[field] = index.query(lon, lat)
+        return fields
+
+    def fields_many(self, lons, lats):
+        """
+        Returns the region fields for many points, as a list of dictionaries.
+
+        Rasters and `SquareGrid` cells resolve all points at once with NumPy,
+        and only the other grids are queried point by point.
+
+        """
+        lons = np.asarray(lons, dtype=float).ravel()
+        lats = np.asarray(lats, dtype=float).ravel()
+        columns = OrderedDict()
+        for field, index in self.indexes.items():
+            if field in self.rasters:
+                columns[field] = self.rasters[field].query(lons, lats)
+            elif hasattr(index, 'cell_ids'):
+                ids = index.cell_ids(lons, lats).tolist()
+                columns[field] = [[key] if key >= 0 else [] for key in ids]
+            else:
+                columns[field] = [index.query(lon, lat) for lon, lat
+                                  in zip(lons.tolist(), lats.tolist())]
+        return [dict((field, column[i]) for field, column in columns.items())
+                for i in range(len(lons))]
+
+    def stamp(self, tweet):
+        """
+        Adds the region fields to a tweet, from its coordinates.
+
+        """
+        lon, lat = tweet['coordinates']
+        tweet.update(self.fields(lon, lat))
+        return tweet
+
+    def stamp_many(self, tweets):
+        """
+        Adds the region fields to a list of tweets, from their coordinates.
+
+        """
+        fields = self.fields_many(*_coordinates(tweets))
+        for tweet, tweet_fields in zip(tweets, fields):
+            tweet.update(tweet_fields)
+        return tweets
+
+def _coordinates(tweets):
+    # The longitudes and latitudes of a list of tweets, as arrays.
+    coords = np.array([tweet['coordinates'] for tweet in tweets],
+                      dtype=float).reshape(-1, 2)
+    return coords[:, 0], coords[:, 1]
+
+def _bulk_update(collection, updates):
+    # Like helpers.bulk_insert, support both pymongo 3 and pymongo 2.
+    if pymongo.version_tuple >= (3,):
+        requests = [pymongo.UpdateOne({'_id': _id}, {'$set': fields})
+                    for _id, fields in updates]
+        collection.bulk_write(requests, ordered=False)
+    else:
+        bulk = collection.initialize_unordered_bulk_op()
+        for _id, fields in updates:
+            bulk.find({'_id': _id}).update_one({'$set': fields})
+        bulk.execute()
+
+def backfill_regions(collection, stamper, batch_size=1000, force=False,
+                     log_every=10**6):
+    """
+    Stamps the region fields on tweets already in a collection.
+
+    Parameters
+    ----------
+    collection : MongoDB collection
+        The collection of tweets.
+    stamper : RegionStamper
+        Computes the fields.
+    batch_size : int
+        The number of tweets stamped together and updated per bulk write.
+    force : bool
+        If `True`, restamp every tweet. Otherwise only tweets lacking one of
+        the stamper's fields are updated, so an interrupted backfill can be
+        restarted.
+    log_every : int
+        Print progress after this many tweets.
+
+    Returns
+    -------
+    count : int
+        The number of tweets updated.
+
+    """
+    spec = {}
+    if not force:
+        spec = {'$or': [{field: {'$exists': False}}
+                        for field in stamper.indexes]}
+
+    def update(tweets):
+        fields = stamper.fields_many(*_coordinates(tweets))
+        _bulk_update(collection, [(tweet['_id'], f)
+                                  for tweet, f in zip(tweets, fields)])
+
+    count = 0
+    batch = []
+    for tweet in collection.find(spec, {'coordinates': True}):
+        batch.append(tweet)
+        if len(batch) == batch_size:
+            update(batch)
+            batch = []
+        count += 1
+        if log_every and count % log_every == 0:
+            print("\t{0}".format(count))
+            sys.stdout.flush()
+    if batch:
+        update(batch)
+    return count
+
+def ensure_region_indexes(collection, fields=None):
+    """
+    Creates a compound index on each region field and 'created_at'.
+
+    The indexes serve equality queries on a region, optionally restricted
+    to a time range.
+
+    """
+    if fields is None:
+        fields = list(REGION_FIELDS)
+    for field in fields:
+        keys = [(field, pymongo.ASCENDING), ('created_at', pymongo.ASCENDING)]
+        # create_index is in every pymongo; ensure_index is gone from
+        # pymongo 4.
+        collection.create_index(keys)
+
+def tweets_in_region_field(collection, field, key, fields=None):
+    """
+    Iterator over tweets stamped with region `key` in `field`.
+
+    This is the indexed equivalent of `geo.tweets_in_region` for a county,
+    state or square.
+
+    """
+    return collection.find({field: key}, fields)
+
+def _aggregate(collection, pipeline):
+    # pymongo 3 returns a cursor, pymongo 2 a dictionary with the results.
+    try:
+        result = collection.aggregate(pipeline, allowDiskUse=True)
+    except TypeError:
+        result = collection.aggregate(pipeline)
+    if isinstance(result, dict):
+        return result['result']
+    return result
+
+def _skipped_by_region(collection, field, skip_users):
+    skipped = defaultdict(int)
+    if not skip_users:
+        return skipped
+    pipeline = [
+        {'$match': {field: {'$exists': True},
+                    'user.id': {'$in': list(skip_users)}}},
+        {'$unwind': '$' + field},
+        {'$group': {'_id': '$' + field, 'count': {'$sum': 1}}},
+    ]
+    for doc in _aggregate(collection, pipeline):
+        skipped[doc['_id']] = doc['count']
+    return skipped
+
+def hashtag_counts_by_region(collection, field, skip_users=None):
+    """
+    Returns hashtag counts for every region, from one aggregation.
+
+    Parameters
+    ----------
+    collection : MongoDB collection
+        The collection of stamped tweets.
+    field : str
+        The region field: 'geoid', 'state_fips' or 'square_id'.
+    skip_users : list of int
+        A list of Twitter user ids. Any tweet from these user ids will be
+        skipped and not included in the counts.
+
+    Returns
+    -------
+    counts : dict
+        Maps region keys to the hashtag counts of the region. Regions
+        without hashtags are absent.
+    skipped : dict
+        Maps region keys to the number of tweets that were not counted, due
+        to `skip_users`.
+
+    """
+    skip_users = list(skip_users or [])
+    match = {field: {'$exists': True}, 'hashtags.0': {'$exists': True}}
+    if skip_users:
+        match['user.id'] = {'$nin': skip_users}
+    pipeline = [
+        {'$match': match},
+        {'$project': {field: True, 'hashtags': True}},
+        {'$unwind': '$' + field},
+        {'$unwind': '$hashtags'},
+        {'$group': {'_id': {'region': '$' + field, 'hashtag': '$hashtags'},
+                    'count': {'$sum': 1}}},
+    ]
+    counts = defaultdict(lambda: defaultdict(int))
+    for doc in _aggregate(collection, pipeline):
+        counts[doc['_id']['region']][doc['_id']['hashtag']] = doc['count']
+    return counts, _skipped_by_region(collection, field, skip_users)
+
+def user_counts_by_region(collection, field, skip_users=None):
+    """
+    Returns user tweet counts for every region, from one aggregation.
+
+    See `hashtag_counts_by_region`. The counts map user ids to the number
+    of tweets by that user in the region.
+
+    """
+    skip_users = list(skip_users or [])
+    match = {field: {'$exists': True}}
+    if skip_users:
+        match['user.id'] = {'$nin': skip_users}
+    pipeline = [
+        {'$match': match},
+        {'$project': {field: True, 'user.id': True}},
+        {'$unwind': '$' + field},
+        {'$group': {'_id': {'region': '$' + field, 'user': '$user.id'},
+                    'count': {'$sum': 1}}},
+    ]
+    counts = defaultdict(lambda: defaultdict(int))
+    for doc in _aggregate(collection, pipeline):
+        counts[doc['_id']['region']][doc['_id']['user']] = doc['count']
+    return counts, _skipped_by_region(collection, field, skip_users)
+
+def build_hashtag_grids_from_fields(tweet_collection, collections,
+                                    county_shp=None, state_shp=None,
+                                    cells=None, skip_users=None,
+                                    dry_run=True):
+    """
+    Builds the county, state and square grids from stamped tweets.
+
+    Like `partition.build_hashtag_grids`, but the counts come from one
+    aggregation per grid rather than a pass over the tweets.
+
+    Returns
+    -------
+    skips : dict
+        Maps grid names to the number of skipped tweets in each region.
+
+    """
+    grids = OrderedDict()
+    if county_shp is not None:
+        grids['counties'] = ('geoid', county_regions(county_shp))
+    if state_shp is not None:
+        grids['states'] = ('state_fips', state_regions(state_shp))
+    if cells is not None:
+        grids['squares'] = ('square_id', square_regions(cells))
+
+    skips = {}
+    for name, (field, regions) in grids.items():
+        counts, skipped = hashtag_counts_by_region(tweet_collection, field,
+                                                   skip_users=skip_users)
+        skips[name] = skipped
+        msg = "{0}: skipped {1} tweets due to user ids."
+        print(msg.format(name, sum(skipped.values())))
+        if not dry_run:
+            counts = dict((key, dict(c)) for key, c in counts.items())
+            write_hashtag_grid(name, regions, counts, collections[name])
+
+    return skips
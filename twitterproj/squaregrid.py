@@ -0,0 +1,268 @@
+"""
+Square grids whose cells are found arithmetically.
+
+`usoutline.us_grid` yields the cells of a grid as boxes, and the squares
+grid was built with one `$geoWithin` query per cell. The cells are
+axis-aligned, so the cell of a point is just
+
+    floor((lon - min lon) / resolution), floor((lat - min lat) / resolution)
+
+and a whole batch of tweets is assigned to cells with a few NumPy
+operations. The squares grid is then built in one pass over the tweets.
+
+Cells are enumerated as before: latitude increasing, then longitude, and
+with `outline`, only cells intersecting the outline are kept and numbered.
+So the `_id` of each square is the same as from `us_grid`.
+
+Unlike `$geoWithin`, which puts a point on an edge shared by two cells in
+both, each point belongs to exactly one cell: the cell whose minimum
+longitude and latitude are at or below the point. Points on the maximum
+edges of the grid belong to the last cells.
+
+"""
+from __future__ import division
+from __future__ import print_function
+
+from collections import defaultdict
+import math
+import sys
+
+import numpy as np
+from shapely.geometry import box, mapping
+from shapely.prepared import prep
+
+from .helpers import USA
+
+__all__ = [
+    'SquareGrid',
+    'square_hashtag_counts',
+    'build_square_grid',
+]
+
+class SquareGrid(object):
+    """
+    A grid of square cells over a bounding box.
+
+    The grid is also a mapping from cell ids to features, like
+    `partition.square_regions`, and has a `query` method, like
+    `partition.RegionIndex`, so it can be used wherever those are.
+
+    Examples
+    --------
+    >>> grid = SquareGrid(0.5)
+    >>> grid.cell_ids([-122.3, -73.9], [47.6, 40.7])
+    array([ 307, 5337])
+
+    """
+    def __init__(self, resolution=0.5, bounds=None, outline=None):
+        """
+        Parameters
+        ----------
+        resolution : float
+            The width and height of each cell, in degrees.
+        bounds : tuple
+            The (min lon, min lat, max lon, max lat) to cover. The grid
+            starts at the nearest degree below the minimums and covers the
+            nearest degree above the maximums. Defaults to the bounds of
+            `helpers.USA`.
+        outline : shapely geometry
+            If given, only cells that intersect the outline are kept.
+
+        """
+        if bounds is None:
+            bounds = USA.bounds
+        self.resolution = resolution
+        # Grid boundaries are determined by nearest degree.
+        self.min_lon = float(np.floor(bounds[0]))
+        self.min_lat = float(np.floor(bounds[1]))
+        # Round so that resolutions that evenly divide the range do not
+        # gain a cell from floating point error.
+        span_lon = round((np.ceil(bounds[2]) - self.min_lon) / resolution, 9)
+        span_lat = round((np.ceil(bounds[3]) - self.min_lat) / resolution, 9)
+        self.nx = int(np.ceil(span_lon))
+        self.ny = int(np.ceil(span_lat))
+        self.max_lon = self.min_lon + self.nx * resolution
+        self.max_lat = self.min_lat + self.ny * resolution
+
+        # Cells are enumerated with latitude increasing, then longitude.
+        if outline is None:
+            dense = np.arange(self.nx * self.ny)
+        else:
+            outline = prep(outline)
+            dense = [i for i in range(self.nx * self.ny)
+                     if outline.intersects(self._box(i))]
+            dense = np.array(dense, dtype=np.int64)
+        self._dense = dense
+        self._ids = np.full(self.nx * self.ny, -1, dtype=np.int64)
+        self._ids[dense] = np.arange(len(dense))
+
+    def _box(self, dense):
+        xi, yi = divmod(int(dense), self.ny)
+        r = self.resolution
+        return box(self.min_lon + xi * r, self.min_lat + yi * r,
+                   self.min_lon + (xi + 1) * r, self.min_lat + (yi + 1) * r)
+
+    def __len__(self):
+        return len(self._dense)
+
+    def __iter__(self):
+        return iter(range(len(self._dense)))
+
+    def __contains__(self, key):
+        return 0 <= key < len(self._dense)
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return {'properties': {}, 'geometry': mapping(self.cell(key))}
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def cell(self, key):
+        """
+        Returns the cell with id `key` as a shapely box.
+
+        """
+        return self._box(self._dense[key])
+
+    def cells(self):
+        """
+        Yields the cells as shapely boxes, in id order.
+
+        """
+        for key in self:
+            yield self.cell(key)
+
+    def cell_ids(self, lons, lats):
+        """
+        Returns the cell id of each point, or -1 if it is not in a cell.
+
+        """
+        lons = np.asarray(lons, dtype=float)
+        lats = np.asarray(lats, dtype=float)
+        xi = np.floor((lons - self.min_lon) / self.resolution)
+        yi = np.floor((lats - self.min_lat) / self.resolution)
+        # Points on the maximum edges belong to the last cells.
+        xi[lons == self.max_lon] = self.nx - 1
+        yi[lats == self.max_lat] = self.ny - 1
+
+        valid = (xi >= 0) & (xi < self.nx) & (yi >= 0) & (yi < self.ny)
+        ids = np.full(lons.shape, -1, dtype=np.int64)
+        dense = xi[valid].astype(np.int64) * self.ny + yi[valid].astype(np.int64)
+        ids[valid] = self._ids[dense]
+        return ids
+
+    def query(self, lon, lat):
+        """
+        Returns a list with the id of the cell containing (lon, lat), or an
+        empty list.
+
+        """
+        if lon == self.max_lon:
+            xi = self.nx - 1
+        else:
+            xi = int(math.floor((lon - self.min_lon) / self.resolution))
+        if lat == self.max_lat:
+            yi = self.ny - 1
+        else:
+            yi = int(math.floor((lat - self.min_lat) / self.resolution))
+        if not (0 <= xi < self.nx and 0 <= yi < self.ny):
+            return []
+        key = self._ids[xi * self.ny + yi]
+        return [int(key)] if key >= 0 else []
+
+def square_hashtag_counts(tweet_collection, grid, skip_users=None,
+                          batch_size=10**5, log_every=10**6):
+    """
+    Returns hashtag counts for every cell of a grid in a single pass.
+
+    Tweets are assigned to cells in batches of `batch_size`.
+
+    Returns
+    -------
+    counts : dict
+        Maps cell ids to the hashtag counts of the cell.
+    skipped : dict
+        Maps cell ids to the number of tweets that were not counted, due to
+        `skip_users`.
+
+    """
+    skip_users = set(skip_users or [])
+    counts = dict((key, defaultdict(int)) for key in grid)
+    skipped = dict((key, 0) for key in grid)
+
+    def count(batch):
+        coords = np.array([tweet['coordinates'] for tweet in batch],
+                          dtype=float).reshape(-1, 2)
+        ids = grid.cell_ids(coords[:, 0], coords[:, 1])
+        for tweet, key in zip(batch, ids.tolist()):
+            if key < 0:
+                continue
+            if tweet['user']['id'] in skip_users:
+                skipped[key] += 1
+            else:
+                cell_counts = counts[key]
+                for hashtag in tweet['hashtags']:
+                    cell_counts[hashtag] += 1
+
+    fields = {'coordinates': True, 'hashtags': True, 'user.id': True}
+    batch = []
+    for i, tweet in enumerate(tweet_collection.find({}, fields)):
+        if log_every and i % log_every == 0:
+            print("\t{0}".format(i))
+            sys.stdout.flush()
+        if not tweet['hashtags'] and tweet['user']['id'] not in skip_users:
+            # Nothing to count and nothing to record as skipped.
+            continue
+        batch.append(tweet)
+        if len(batch) == batch_size:
+            count(batch)
+            batch = []
+    if batch:
+        count(batch)
+
+    return counts, skipped
+
+def build_square_grid(tweet_collection, grid_collection, grid,
+                      skip_users=None, dry_run=False, drop=True):
+    """
+    Builds a `grids.squares*` collection from one pass over the tweets.
+
+    Parameters
+    ----------
+    tweet_collection : MongoDB collection
+        The collection containing the tweets to partition.
+    grid_collection : MongoDB collection
+        Where the squares are stored.
+    grid : SquareGrid
+        The grid.
+    skip_users : list of int
+        The set of user ids to skip.
+    dry_run : bool
+        If `True`, then we only build the counts, but nothing is saved.
+    drop : bool
+        If `True`, drop `grid_collection` before writing.
+
+    Returns
+    -------
+    skipped : dict
+        Maps cell ids to the number of skipped tweets.
+
+    """
+    from .partition import write_hashtag_grid
+
+    counts, skipped = square_hashtag_counts(tweet_collection, grid,
+                                            skip_users=skip_users)
+    msg = "squares: skipped {0} tweets due to user ids."
+    print(msg.format(sum(skipped.values())))
+    if not dry_run:
+        write_hashtag_grid('squares', grid, counts, grid_collection,
+                           drop=drop)
+    return skipped
@@ -16,6 +16,7 @@ import sys
 
 from .geo import hashtag_counts_in, tweets_in_region
 from .helpers import connect
+from .regioncache import county_cache, state_cache
 
 __all__ = [
     'hashtag_counts__states',
@@ -93,50 +94,50 @@ def build_hashtag_counts_by_county(tweet_collection, county_collection, shpfile,
 
     if not dry_run:
         county_collection.drop()
-    with fiona.open(shpfile, 'r') as f:
-        out = {}
-        for i, feature in enumerate(f):
-            doc = OrderedDict()
-            state_fips = feature['properties']['STATEFP']
-            if state_fips not in fips:
-                # Consider only counties in the contiguous US.
-                continue
-            name = feature['properties']['NAMELSAD']
-            msg = u"{0}, {1}".format(name, fips[state_fips])
-            print(msg.encode('utf-8'))
-
-            geometry = feature['geometry']
-            counts, skipped = hci(tweet_collection, geometry, skip_users)
-            print("\tSkipped {0} tweets due to user ids.".format(skipped))
-            all_skipped += skipped
-            skips[name] = skipped
-            doc = OrderedDict()
-            doc['name'] = name
-            doc['counts'] = counts
-            doc['state_fips'] = state_fips
-            doc['county_fips'] = feature['properties']['COUNTYFP']
-            doc['geoid'] = feature['properties']['GEOID']
-            doc['landarea'] = feature['properties']['ALAND']
-            doc['geometry'] = geometry
-            if dry_run:
-                continue
-
-            try:
-                county_collection.insert(doc)
-            except pymongo.errors.DocumentTooLarge:
-                # Hack for too large...probably won't happen.
-                # Split in two...must be careful to join when querying.
-                del doc['counts']
-                del doc['_id']
-                doc2 = doc.copy()
-                items = counts.items()
-                L = int(len(items)/2)
-                counts1 = dict(items[:L])
-                counts2 = dict(items[L:])
-                doc['counts'] = counts1
-                doc2['counts'] = counts2
-                county_collection.insert(doc)
-                county_collection.insert(doc2)
+    regions = county_cache(shpfile).regions()
+    out = {}
+    for i, feature in enumerate(regions.values()):
+        doc = OrderedDict()
+        state_fips = feature['properties']['STATEFP']
+        if state_fips not in fips:
+            # Consider only counties in the contiguous US.
+            continue
+        name = feature['properties']['NAMELSAD']
+        msg = u"{0}, {1}".format(name, fips[state_fips])
+        print(msg.encode('utf-8'))
+
+        geometry = feature['geometry']
+        counts, skipped = hci(tweet_collection, geometry, skip_users)
+        print("\tSkipped {0} tweets due to user ids.".format(skipped))
+        all_skipped += skipped
+        skips[name] = skipped
+        doc = OrderedDict()
+        doc['name'] = name
+        doc['counts'] = counts
+        doc['state_fips'] = state_fips
+        doc['county_fips'] = feature['properties']['COUNTYFP']
+        doc['geoid'] = feature['properties']['GEOID']
+        doc['landarea'] = feature['properties']['ALAND']
+        doc['geometry'] = geometry
+        if dry_run:
+            continue
+
+        try:
+            county_collection.insert(doc)
+        except pymongo.errors.DocumentTooLarge:
+            # Hack for too large...probably won't happen.
+            # Split in two...must be careful to join when querying.
+            del doc['counts']
+            del doc['_id']
+            doc2 = doc.copy()
+            items = counts.items()
+            L = int(len(items)/2)
+            counts1 = dict(items[:L])
+            counts2 = dict(items[L:])
+            doc['counts'] = counts1
+            doc2['counts'] = counts2
+            county_collection.insert(doc)
+            county_collection.insert(doc2)
 
     msg = "\nIn total, skipped {0} tweets due to user ids"
     print(msg.format(all_skipped))
@@ -175,46 +176,46 @@ def build_hashtag_counts_by_state(tweet_collection, state_collection, shpfile,
     desired = us.states.mapping('fips', 'abbr', us.STATES_CONTIGUOUS)
     if not dry_run:
         state_collection.drop()
-    with fiona.open(shpfile, 'r') as f:
-        out = {}
-        for i, feature in enumerate(f):
-            doc = OrderedDict()
-            if feature['properties']['STATEFP'] not in desired:
-                continue
-
-            name = feature['properties']['NAME']
-            print(name)
-            geometry = feature['geometry']
-            counts, skipped = hci(tweet_collection, geometry, skip_users)
-            print("\tSkipped {0} tweets due to user ids.".format(skipped))
-            all_skipped += skipped
-            skips[name] = skipped
-            doc = OrderedDict()
-            doc['name'] = feature['properties']['NAME']
-            doc['counts'] = counts
-            doc['fips'] = feature['properties']['STATEFP']
-            doc['abbrev'] = feature['properties']['STUSPS']
-            doc['landarea'] = feature['properties']['ALAND']
-            doc['geometry'] = geometry
-            if dry_run:
-                continue
-
-            try:
-                state_collection.insert(doc)
-            except pymongo.errors.DocumentTooLarge:
-                # Hack for CA.
-                # Split in two...must be careful to join when querying.
-                del doc['counts']
-                del doc['_id']
-                doc2 = doc.copy()
-                items = counts.items()
-                L = int(len(items)/2)
-                counts1 = dict(items[:L])
-                counts2 = dict(items[L:])
-                doc['counts'] = counts1
-                doc2['counts'] = counts2
-                state_collection.insert(doc)
-                state_collection.insert(doc2)
+    regions = state_cache(shpfile).regions()
+    out = {}
+    for i, feature in enumerate(regions.values()):
+        doc = OrderedDict()
+        if feature['properties']['STATEFP'] not in desired:
+            continue
+
+        name = feature['properties']['NAME']
+        print(name)
+        geometry = feature['geometry']
+        counts, skipped = hci(tweet_collection, geometry, skip_users)
+        print("\tSkipped {0} tweets due to user ids.".format(skipped))
+        all_skipped += skipped
+        skips[name] = skipped
+        doc = OrderedDict()
+        doc['name'] = feature['properties']['NAME']
+        doc['counts'] = counts
+        doc['fips'] = feature['properties']['STATEFP']
+        doc['abbrev'] = feature['properties']['STUSPS']
+        doc['landarea'] = feature['properties']['ALAND']
+        doc['geometry'] = geometry
+        if dry_run:
+            continue
+
+        try:
+            state_collection.insert(doc)
+        except pymongo.errors.DocumentTooLarge:
+            # Hack for CA.
+            # Split in two...must be careful to join when querying.
+            del doc['counts']
+            del doc['_id']
+            doc2 = doc.copy()
+            items = counts.items()
+            L = int(len(items)/2)
+            counts1 = dict(items[:L])
+            counts2 = dict(items[L:])
+            doc['counts'] = counts1
+            doc2['counts'] = counts2
+            state_collection.insert(doc)
+            state_collection.insert(doc2)
 
     msg = "\nIn total, skipped {0} tweets due to user ids"
     print(msg.format(all_skipped))
@@ -393,120 +394,122 @@ def build_userstats_by_county(tweet_collection, county_collection, shpfile,
 #    if not dry_run:
 #        county_collection.drop()
 
-    with fiona.open(shpfile, 'r') as f:
-        for i, feature in enumerate(f):
-
-            if mod_filter is not None and i % 10 != mod_filter:
-                continue
-
-            # This holds the documents for each user in the region.
-            docs = defaultdict(OrderedDict)
-
-            # Content common to every document.
-            state_fips = feature['properties']['STATEFP']
-            county_fips = feature['properties']['COUNTYFP']
-            geoid = feature['properties']['GEOID']
-
-            if state_fips not in fips:
-                # Consider only counties in the contiguous US.
-                continue
-
-            # Log info...
-            name = feature['properties']['NAMELSAD']
-            msg = u"{0}:\t{1}, {2}, {3}".format(i,
-                                                name,
-                                                mapping[state_fips],
-                                                geoid)
-            print(msg.encode('utf-8'))
-            sys.stdout.flush()
-
-            def process_tweet(tweet):
-                # Update to id_str eventually.
-                user_id = tweet['user']['id']
-                if user_id not in skip_users:
-                    # Store data.
-                    if user_id not in docs:
-                        doc = docs[user_id]
-                        doc['state_fips'] = state_fips
-                        doc['county_fips'] = county_fips
-                        doc['geoid'] = geoid
-                        doc['user_id'] = user_id
-                        # Prep collection
-                        doc['numHashtags'] = 0
-                        doc['numHashtagsUnique'] = 0
-                        doc['hashtags'] = []
-                        doc['numTweets'] = 0
-                        doc['numTweetsWithHashtags'] = 0
-                        doc['followers_count'] = []
-                        doc['friends_count'] = []
-                        doc['favourites_count'] = []
-                        doc['statuses_count'] = []
-                        doc['created_at'] = []
-
+    regions = county_cache(shpfile).regions()
+    for feature in regions.values():
+        # Number counties by shapefile position, as jobs always have been.
+        i = int(feature['id'])
+
+        if mod_filter is not None and i % 10 != mod_filter:
+            continue
+
+        # This holds the documents for each user in the region.
+        docs = defaultdict(OrderedDict)
+
+        # Content common to every document.
+        state_fips = feature['properties']['STATEFP']
+        county_fips = feature['properties']['COUNTYFP']
+        geoid = feature['properties']['GEOID']
+
+        if state_fips not in fips:
+            # Consider only counties in the contiguous US.
+            continue
+
+        # Log info...
+        name = feature['properties']['NAMELSAD']
+        msg = u"{0}:\t{1}, {2}, {3}".format(i,
+                                            name,
+                                            mapping[state_fips],
+                                            geoid)
+        print(msg.encode('utf-8'))
+        sys.stdout.flush()
+
+        def process_tweet(tweet):
+            # Update to id_str eventually.
+            user_id = tweet['user']['id']
+            if user_id not in skip_users:
+                # Store data.
+                if user_id not in docs:
                     doc = docs[user_id]
-                    doc['numTweets'] += 1
-                    doc['hashtags'].extend(tweet['hashtags'])
-                    if len(tweet['hashtags']):
-                        doc['numTweetsWithHashtags'] += 1
-                    doc['followers_count'].append(tweet['user']['followers_count'])
-                    doc['friends_count'].append(tweet['user']['friends_count'])
-                    doc['favourites_count'].append(tweet['user']['favourites_count'])
-                    doc['statuses_count'].append(tweet['user']['statuses_count'])
-                    doc['created_at'].append(tweet['created_at'])
-
-            geometry = feature['geometry']
-            try:
-                # This becomes prohibitively slow when the collection is large.
-                raise Exception
-
-
-                # Fetch all tweets in the region
-                tweets = tweets_in_region(tweet_collection, geometry)
-                for tweet in tweets.sort('created_at', 1):
-                    process_tweet(tweet)
-                do_sort = False
-            except (pymongo.errors.OperationFailure, Exception):
-                # Fetch all tweets in the region
-                print("Failed to sort in mongo. Manually sorting")
-                sys.stdout.flush()
-                tweets = tweets_in_region(tweet_collection, geometry)
-                do_sort = True
-                for tweet in tweets:
-                    process_tweet(tweet)
-
-            # The sort, to be efficient and use the index requires that the
-            # created_at be listed before the 2dspatial.
-            # See: http://blog.mongolab.com/2012/06/cardinal-ins/
-
-            # Finalize docs
-            for doc in docs.values():
-                doc['numHashtags'] = len(doc['hashtags'])
-                doc['numHashtagsUnique'] = len(set(doc['hashtags']))
-
-                # Now sort by datetime.
-                if do_sort:
-                    z = sorted(zip(doc['created_at'],
-                                   doc['statuses_count'],
-                                   doc['followers_count'],
-                                   doc['friends_count'],
-                                   doc['favourites_count']))
-                    z = list(zip(*z))
-                    doc['created_at'] = z[0]
-                    doc['statuses_count'] = z[1]
-                    doc['followers_count'] = z[2]
-                    doc['friends_count'] = z[3]
-                    doc['favourites_count'] = z[4]
-
-            print("\tDone finalizing")
+                    doc['state_fips'] = state_fips
+                    doc['county_fips'] = county_fips
+                    doc['geoid'] = geoid
+                    doc['user_id'] = user_id
+                    # Prep collection
+                    doc['numHashtags'] = 0
+                    doc['numHashtagsUnique'] = 0
+                    doc['hashtags'] = []
+                    doc['numTweets'] = 0
+                    doc['numTweetsWithHashtags'] = 0
+                    doc['followers_count'] = []
+                    doc['friends_count'] = []
+                    doc['favourites_count'] = []
+                    doc['statuses_count'] = []
+                    doc['created_at'] = []
+
+                doc = docs[user_id]
+                doc['numTweets'] += 1
+                doc['hashtags'].extend(tweet['hashtags'])
+                if len(tweet['hashtags']):
+                    doc['numTweetsWithHashtags'] += 1
+                doc['followers_count'].append(tweet['user']['followers_count'])
+                doc['friends_count'].append(tweet['user']['friends_count'])
+                doc['favourites_count'].append(tweet['user']['favourites_count'])
+                doc['statuses_count'].append(tweet['user']['statuses_count'])
+                doc['created_at'].append(tweet['created_at'])
+
+        geometry = feature['geometry']
+        try:
+            # This becomes prohibitively slow when the collection is large.
+            raise Exception
+
+
+            # Fetch all tweets in the region
+            tweets = tweets_in_region(tweet_collection, geometry)
+            for tweet in tweets.sort('created_at', 1):
+                process_tweet(tweet)
+            do_sort = False
+        except (pymongo.errors.OperationFailure, Exception):
+            # Fetch all tweets in the region
+            print("Failed to sort in mongo. Manually sorting")
             sys.stdout.flush()
-            if dry_run:
-                continue
-
-            try:
-                county_collection.insert(docs.values())
-            except pymongo.errors.DocumentTooLarge:
-                # This shouldn't happen. Fail hard.
-                raise
+            tweets = tweets_in_region(tweet_collection, geometry)
+            do_sort = True
+            for tweet in tweets:
+                process_tweet(tweet)
+
+        # The sort, to be efficient and use the index requires that the
+        # created_at be listed before the 2dspatial.
+        # See: http://blog.mongolab.com/2012/06/cardinal-ins/
+
+        # Finalize docs
+        for doc in docs.values():
+            doc['numHashtags'] = len(doc['hashtags'])
+            doc['numHashtagsUnique'] = len(set(doc['hashtags']))
+
+            # Now sort by datetime.
+            if do_sort:
+                z = sorted(zip(doc['created_at'],
+                               doc['statuses_count'],
+                               doc['followers_count'],
+                               doc['friends_count'],
+                               doc['favourites_count']))
+                z = list(zip(*z))
+                doc['created_at'] = z[0]
+                doc['statuses_count'] = z[1]
+                doc['followers_count'] = z[2]
+                doc['friends_count'] = z[3]
+                doc['favourites_count'] = z[4]
+
+        print("\tDone finalizing")
+        sys.stdout.flush()
+        if dry_run:
+            continue
+
+        try:
+            county_collection.insert(docs.values())
+        except pymongo.errors.DocumentTooLarge:
+            # This shouldn't happen. Fail hard.
+            raise
 
 
 
@@ -0,0 +1,446 @@
+"""
+Random access to tweets in raw, gzipped and zstd archives.
+
+An index holds the byte location of the start of each tweet in an archive,
+as a fixed-width array of unsigned 64-bit integers saved in NumPy's `.npy`
+format next to the archive. The array is memory-mapped when read, so any
+tweet can be fetched with a single seek, without scanning the archive.
+
+For gzipped archives, the locations are in uncompressed bytes. Alongside
+them, decompressor checkpoints are stored roughly every `SPACING` bytes so
+that reading a tweet only decompresses from the nearest checkpoint:
+
+    1) If the `indexed_gzip` package is available, zran-style checkpoints
+       (a compressed location, a bit offset and a 32 KiB window) are stored
+       in `<archive>.gzidx` and can be placed anywhere in the stream.
+
+    2) Otherwise, checkpoints are placed at gzip member boundaries and stored
+       in `<archive>.checkpoints.npy`. Archives written as many members, as
+       by `zipper.py`, are then fully seekable with the standard library.
+       A single-member archive only has a checkpoint at its start.
+
+zstd archives, as written by `zipper.py --zstd`, are sequences of
+independent frames, and checkpoints are placed at frame boundaries in the
+same way. Indexing and reading them requires the `zstandard` package.
+
+"""
+import io
+import os
+import warnings
+import zlib
+
+import numpy as np
+
+from .decoders import decode
+
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+__all__ = [
+    'create_index',
+    'index_filename',
+    'TweetIndex',
+    'CheckpointedGzipFile',
+    'CheckpointedZstdFile',
+]
+
+INDEX_SUFFIX = '.index.npy'
+CHECKPOINT_SUFFIX = '.checkpoints.npy'
+ZRAN_SUFFIX = '.gzidx'
+
+# Number of bytes scanned at once when building an index.
+BLOCK_SIZE = 2**24
+
+# Approximate number of uncompressed bytes between gzip checkpoints.
+SPACING = 2**24
+
+# Uncompressed size, in checkpoint spacings, above which indexing a gzip
+# archive with a single checkpoint warns.
+WARN_SPACINGS = 4
+
+# zlib window bits for reading a gzip member.
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+def index_filename(filename):
+    """
+    Returns the name of the index file for a tweet archive.
+
+    """
+    return filename + INDEX_SUFFIX
+
+def line_offsets(blocks):
+    """
+    Returns the byte location of the start of each line in a binary stream.
+
+    The stream is given as an iterable of consecutive blocks of bytes. The
+    last element is the size of the stream, so that line i spans the bytes
+    `offsets[i]:offsets[i+1]`.
+
+    """
+    offsets = [np.zeros(1, dtype=np.uint64)]
+    size = 0
+    last = b''
+    for block in blocks:
+        if not block:
+            continue
+        newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == 10)
+        offsets.append((newlines + (size + 1)).astype(np.uint64))
+        size += len(block)
+        last = block[-1:]
+    if size and last != b'\n':
+        # The last line has no trailing newline.
+        offsets.append(np.array([size], dtype=np.uint64))
+    return np.concatenate(offsets)
+
+def _read_blocks(fobj, block_size=BLOCK_SIZE):
+    return iter(lambda: fobj.read(block_size), b'')
+
+def _gzip_decompressor():
+    return zlib.decompressobj(GZIP_WBITS)
+
+def _zstd_decompressor():
+    import zstandard
+    return zstandard.ZstdDecompressor().decompressobj()
+
+def _gzip_blocks(fobj, checkpoints, spacing=SPACING, block_size=BLOCK_SIZE,
+                 decompressor=_gzip_decompressor):
+    """
+    Yields decompressed blocks of a gzip stream with one or more members.
+
+    Each member boundary at least `spacing` uncompressed bytes after the
+    last checkpoint is appended to `checkpoints` as a pair of
+    (compressed location, uncompressed location).
+
+    `decompressor` returns a new decompressor for each member. With
+    `_zstd_decompressor`, the members are the frames of a zstd stream.
+
+    """
+    checkpoints.append((0, 0))
+    size = 0
+    position = 0
+    d = decompressor()
+    for block in _read_blocks(fobj, block_size):
+        start = position
+        position += len(block)
+        while block:
+            out = d.decompress(block)
+            size += len(out)
+            yield out
+            unused = d.unused_data
+            if not (getattr(d, 'eof', False) or unused):
+                break
+            # The member ended. The next begins at the start of `unused`.
+            start += len(block) - len(unused)
+            block = unused
+            if not block.strip(b'\x00'):
+                # Trailing padding, not another member.
+                break
+            if size - checkpoints[-1][1] >= spacing:
+                checkpoints.append((start, size))
+            d = decompressor()
+    yield d.flush()
+
+def create_index(filename, force=False, spacing=SPACING):
+    """
+    Create an index from a text file of tweets.
+
+    Assumption: Each line corresponds to a tweet.
+
+    The index can be used to randomly access each tweet. It will contain seek
+    locations to each tweet. For example, the 3rd element of the index will
+    be the seek location of the 3rd tweet in the original file. The last
+    element is the size of the file. See `TweetIndex`.
+
+    Gzipped and zstd ('.zst') files are indexed in one streaming pass,
+    which also stores decompressor checkpoints every `spacing` bytes or so.
+    Without `indexed_gzip`, checkpoints can only be placed at gzip member
+    boundaries, so a single-member archive, such as one written by the
+    `gzip` command, gets a checkpoint at its start only, and every read
+    decompresses from there. A warning is issued when such an archive is
+    large. Install `indexed_gzip`, or recompress the archive with
+    `zipper.py`, to make it seekable.
+
+    Parameters
+    ----------
+    filename : str
+        The name of the tweet file.
+    force : bool
+        If true, then create the index file even if an index file
+        already exists.
+    spacing : int
+        The approximate number of uncompressed bytes between checkpoints in
+        a gzipped or zstd file.
+
+    Returns
+    -------
+    indexname : str
+        The name of the index file.
+
+    """
+    indexname = index_filename(filename)
+    if os.path.isfile(indexname) and not force:
+        return indexname
+
+    if filename.endswith('.zst'):
+        checkpoints = []
+        with io.open(filename, 'rb') as fobj:
+            blocks = _gzip_blocks(fobj, checkpoints, spacing,
+                                  decompressor=_zstd_decompressor)
+            offsets = line_offsets(blocks)
+        checkpoints = np.array(checkpoints, dtype=np.uint64)
+        _save(filename + CHECKPOINT_SUFFIX, checkpoints)
+    elif not filename.endswith('.gz'):
+        with io.open(filename, 'rb') as fobj:
+            offsets = line_offsets(_read_blocks(fobj))
+    elif indexed_gzip is not None:
+        # Checkpoints are created as the file is read.
+        fobj = indexed_gzip.IndexedGzipFile(filename, spacing=spacing)
+        with fobj:
+            offsets = line_offsets(_read_blocks(fobj))
+            fobj.export_index(filename + ZRAN_SUFFIX)
+    else:
+        checkpoints = []
+        with io.open(filename, 'rb') as fobj:
+            offsets = line_offsets(_gzip_blocks(fobj, checkpoints, spacing))
+        if len(checkpoints) == 1 and offsets[-1] > WARN_SPACINGS * spacing:
+            msg = ("{0} has no gzip member boundaries to checkpoint, so each "
+                   "read decompresses from the start. Install indexed_gzip "
+                   "or recompress it with zipper.py.")
+            warnings.warn(msg.format(filename))
+        checkpoints = np.array(checkpoints, dtype=np.uint64)
+        _save(filename + CHECKPOINT_SUFFIX, checkpoints)
+
+    _save(indexname, offsets)
+    return indexname
+
+def _save(filename, array):
+    # Write then rename, so a partial file is never read.
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'wb') as fobj:
+        np.save(fobj, array)
+    os.rename(tmpname, filename)
+
+class CheckpointedGzipFile(object):
+    """
+    A read-only gzip file that seeks from member-boundary checkpoints.
+
+    Positions are in uncompressed bytes. Seeking backwards, or far forwards,
+    restarts decompression from the nearest checkpoint at or before the
+    target, rather than from the start of the file.
+
+    """
+    def __init__(self, filename, checkpoints, block_size=2**16):
+        """
+        Parameters
+        ----------
+        filename : str
+            The name of the gzipped file.
+        checkpoints : array-like, shape (n, 2)
+            The (compressed, uncompressed) locations of member boundaries,
+            sorted, and beginning with (0, 0).
+
+        """
+        self.fobj = io.open(filename, 'rb')
+        checkpoints = np.asarray(checkpoints, dtype=np.uint64).reshape(-1, 2)
+        self.compressed = checkpoints[:, 0]
+        self.uncompressed = checkpoints[:, 1]
+        self.block_size = block_size
+        self._restart(0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.fobj.close()
+
+    def _decompressor(self):
+        return _gzip_decompressor()
+
+    def _restart(self, i):
+        self.fobj.seek(int(self.compressed[i]))
+        self.position = int(self.uncompressed[i])
+        self.d = self._decompressor()
+        self.buffer = b''
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset):
+        i = np.searchsorted(self.uncompressed, offset, side='right') - 1
+        if not (self.uncompressed[i] <= self.position <= offset):
+            # Only restart when no nearer than the current position.
+            self._restart(i)
+        self._skip(offset - self.position)
+        return self.position
+
+    def _skip(self, n):
+        while n > 0:
+            data = self.read(min(n, 2**20))
+            if not data:
+                break
+            n -= len(data)
+
+    def _fill(self):
+        while not self.buffer:
+            data = self.d.unused_data or self.fobj.read(self.block_size)
+            if self.d.unused_data:
+                if not data.strip(b'\x00'):
+                    return
+                # The member ended. Start the next one.
+                self.d = self._decompressor()
+            elif not data:
+                self.buffer = self.d.flush()
+                return
+            self.buffer = self.d.decompress(data)
+
+    def read(self, n=-1):
+        chunks = []
+        while n < 0 or n > 0:
+            self._fill()
+            if not self.buffer:
+                break
+            if n < 0:
+                chunk, self.buffer = self.buffer, b''
+            else:
+                chunk, self.buffer = self.buffer[:n], self.buffer[n:]
+                n -= len(chunk)
+            self.position += len(chunk)
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+class CheckpointedZstdFile(CheckpointedGzipFile):
+    """
+    A read-only zstd file that seeks from frame-boundary checkpoints.
+
+    """
+    def _decompressor(self):
+        return _zstd_decompressor()
+
+def _checkpoints(filename):
+    checkpoints = filename + CHECKPOINT_SUFFIX
+    if os.path.isfile(checkpoints):
+        return np.load(checkpoints)
+    return [(0, 0)]
+
+def open_indexed(filename):
+    """
+    Opens a tweet archive for random access by uncompressed location.
+
+    """
+    if filename.endswith('.zst'):
+        return CheckpointedZstdFile(filename, _checkpoints(filename))
+    if not filename.endswith('.gz'):
+        return io.open(filename, 'rb')
+
+    zran = filename + ZRAN_SUFFIX
+    if indexed_gzip is not None and os.path.isfile(zran):
+        fobj = indexed_gzip.IndexedGzipFile(filename)
+        fobj.import_index(zran)
+        return fobj
+
+    return CheckpointedGzipFile(filename, _checkpoints(filename))
+
+class TweetIndex(object):
+    """
+    Random access to the tweets of an archive through its index.
+
+    Gzipped and zstd archives are decompressed from the nearest checkpoint
+    only. Without `indexed_gzip`, a single-member gzip archive has only one
+    checkpoint, at its start; see `create_index`.
+
+    Examples
+    --------
+    >>> index = TweetIndex('tweets.2014-08-09_12')
+    >>> len(index)
+    4521987
+    >>> tweet = index[10]
+    >>> tweets = index[1000:1010]
+    >>> sample = index.sample(100)
+
+    """
+    def __init__(self, filename, build=True):
+        """
+        Parameters
+        ----------
+        filename : str
+            The name of the tweet file.
+        build : bool
+            If `True`, create the index if it does not exist yet.
+
+        """
+        if build:
+            create_index(filename)
+        self.filename = filename
+        self.offsets = np.load(index_filename(filename), mmap_mode='r')
+        self.fobj = open_indexed(filename)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.fobj.close()
+
+    def _read(self, start, stop):
+        self.fobj.seek(start)
+        return self.fobj.read(stop - start)
+
+    def line(self, i):
+        """
+        Returns the raw bytes of the i-th tweet.
+
+        """
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError('tweet index out of range')
+        start, stop = self.offsets[i:i+2]
+        return self._read(int(start), int(stop)).strip()
+
+    def lines(self, start=None, stop=None):
+        """
+        Returns the raw bytes of a contiguous range of tweets.
+
+        The whole range is fetched with one seek and one read.
+
+        """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        if start >= stop:
+            return []
+        data = self._read(int(self.offsets[start]), int(self.offsets[stop]))
+        return [line.strip() for line in data.splitlines()]
+
+    def __getitem__(self, key):
+        """
+        Returns the decoded i-th tweet, or a list of tweets for a slice.
+
+        """
+        if isinstance(key, slice):
+            if key.step not in (None, 1):
+                indexes = range(*key.indices(len(self)))
+                return [decode(self.line(i)) for i in indexes]
+            return [decode(line) for line in self.lines(key.start, key.stop)]
+        return decode(self.line(key))
+
+    def sample(self, n, prng=None):
+        """
+        Returns `n` tweets drawn uniformly without replacement.
+
+        The tweets are returned in archive order.
+
+        """
+        if prng is None:
+            prng = np.random.RandomState()
+        indexes = np.sort(prng.choice(len(self), size=n, replace=False))
+        return [decode(self.line(i)) for i in indexes]